@@ -21,9 +21,20 @@ parser.add_argument('--output_webcam', type=str)
 parser.add_argument('--output_spout', action='store_true')
 parser.add_argument('--output_size', type=str, default='512x512')
 parser.add_argument('--model', type=str, default='standard_float')
+parser.add_argument('--backend', type=str, default='eager')
+parser.add_argument('--int8_calibration', type=str)
+parser.add_argument('--channels_last', action='store_true')
+parser.add_argument('--incremental_editor', action='store_true')
+parser.add_argument('--incremental_threshold', type=float, default=0.5)
+parser.add_argument('--incremental_halo', type=int, default=64)
 parser.add_argument('--debug_input', action='store_true')
 parser.add_argument('--mouse_input', type=str)
+parser.add_argument('--pipeline_workers', type=int, default=2)
+parser.add_argument('--pipeline_depth', type=int, default=2)
+parser.add_argument('--output_fps', type=float, default=0)
+parser.add_argument('--interpolation', type=str, default='none')
 parser.add_argument('--perf', type=str)
+parser.add_argument('--perf_trace', type=str)
 parser.add_argument('--skip_model', action='store_true')
 parser.add_argument('--ifm', type=str)
 parser.add_argument('--osf', type=str)
@@ -31,17 +42,43 @@ parser.add_argument('--anime4k', action='store_true')
 parser.add_argument('--alpha_split', action='store_true')
 parser.add_argument('--bongo', action='store_true')
 parser.add_argument('--cache', type=str, default='256mb')
+parser.add_argument('--cache_codec', type=str, default='raw')
 parser.add_argument('--gpu_cache', type=str, default='512mb')
+parser.add_argument('--gpu_cache_host', type=str, default='1gb')
+parser.add_argument('--rotator_grid_cache', action='store_true')
+parser.add_argument('--disk_cache', type=str)
+parser.add_argument('--disk_cache_prewarm', type=str, default='1gb')
+parser.add_argument('--warmup', action='store_true')
+parser.add_argument('--warmup_batch', type=int, default=2)
 parser.add_argument('--simplify', type=int, default=1)
+parser.add_argument('--record', type=str)
+parser.add_argument('--record_raw', action='store_true')
+parser.add_argument('--replay', type=str)
+parser.add_argument('--replay_speed', type=float, default=1.0)
+parser.add_argument('--render_batch', type=int, default=4)
+parser.add_argument('--render_workers', type=int, default=2)
+parser.add_argument('--render_format', type=str, default='png')
 args = parser.parse_args()
 args.output_w = int(args.output_size.split('x')[0])
 args.output_h = int(args.output_size.split('x')[1])
 if args.cache is not None:
-    args.max_cache_len=int(convert_to_byte(args.cache)/262144/4)
+    args.cache_bytes=int(convert_to_byte(args.cache))
 else:
-    args.max_cache_len=0
+    args.cache_bytes=0
 if args.gpu_cache is not None:
     args.max_gpu_cache_len=int(convert_to_byte(args.gpu_cache)/589824/4)
+    args.gpu_cache_bytes=int(convert_to_byte(args.gpu_cache))
 else:
     args.max_gpu_cache_len=0
+    args.gpu_cache_bytes=0
+if args.gpu_cache_host is not None:
+    args.gpu_cache_host_bytes=int(convert_to_byte(args.gpu_cache_host))
+else:
+    args.gpu_cache_host_bytes=0
+if args.disk_cache is not None:
+    args.disk_cache_bytes=int(convert_to_byte(args.disk_cache))
+    args.disk_cache_prewarm_bytes=int(convert_to_byte(args.disk_cache_prewarm))
+else:
+    args.disk_cache_bytes=0
+    args.disk_cache_prewarm_bytes=0
 if args.output_webcam is None and args.output_dir is None and args.output_spout is None: args.debug = True
@@ -0,0 +1,172 @@
+import hashlib
+import os
+import time
+
+import torch
+import torch.nn as nn
+
+from benchmark import CREATORS, create_inputs
+
+BACKENDS = ['eager', 'torchscript', 'compile', 'onnxruntime']
+NETWORKS = list(CREATORS)
+ONNX_DIR = 'data/cache/onnx'
+ONNX_OPSET = 20
+
+INPUT_NAMES = {
+    'eyebrow_decomposer': ['image'],
+    'eyebrow_morphing_combiner': ['background_layer', 'eyebrow_layer', 'pose'],
+    'face_morpher': ['image', 'pose'],
+    'two_algo_face_body_rotator': ['image', 'pose'],
+    'editor': ['original_image', 'warped_image', 'grid_change', 'pose'],
+}
+
+
+def get_module_dtype(module):
+    return next(module.parameters()).dtype
+
+
+def get_module_device(module):
+    return next(module.parameters()).device
+
+
+def hash_state_dict(module):
+    digest = hashlib.sha1()
+    for name, tensor in module.state_dict().items():
+        digest.update(name.encode('utf-8'))
+        digest.update(tensor.detach().cpu().contiguous().view(torch.uint8).numpy().tobytes())
+    return digest.hexdigest()[:16]
+
+
+def export_torchscript(module, example_inputs):
+    with torch.no_grad():
+        traced = torch.jit.trace(module, tuple(example_inputs), check_trace=False)
+    return torch.jit.optimize_for_inference(torch.jit.freeze(traced.eval()))
+
+
+def export_onnx(module, network, example_inputs, file_name):
+    """
+    write one network to an ONNX file with a dynamic batch dimension
+    """
+    input_names = INPUT_NAMES[network]
+    with torch.no_grad():
+        output_count = len(module(*example_inputs))
+    output_names = ['output%d' % i for i in range(output_count)]
+    dynamic_axes = {name: {0: 'batch'} for name in input_names + output_names}
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    temp_file_name = file_name + '.tmp'
+    with torch.no_grad():
+        torch.onnx.export(module, tuple(example_inputs), temp_file_name, input_names=input_names,
+                          output_names=output_names, dynamic_axes=dynamic_axes, opset_version=ONNX_OPSET,
+                          dynamo=False)
+    os.replace(temp_file_name, file_name)
+
+
+class ONNXRuntimeModule(nn.Module):
+    """
+    drop-in replacement for a network that runs an exported ONNX graph, returning the same list of tensors
+    """
+
+    def __init__(self, file_name, device):
+        super().__init__()
+        try:
+            import onnxruntime
+        except ImportError:
+            raise RuntimeError("The onnxruntime backend needs the onnxruntime package (pip install onnxruntime)")
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        providers = ['CPUExecutionProvider']
+        if device.type == 'cuda' and 'CUDAExecutionProvider' in onnxruntime.get_available_providers():
+            providers.insert(0, 'CUDAExecutionProvider')
+        self.device = device
+        self.session = onnxruntime.InferenceSession(file_name, options, providers=providers)
+        self.input_names = [node.name for node in self.session.get_inputs()]
+
+    def forward(self, *inputs):
+        outputs = self.session.run(None, {name: tensor.detach().cpu().contiguous().numpy()
+                                          for name, tensor in zip(self.input_names, inputs)})
+        return [torch.from_numpy(output).to(self.device) for output in outputs]
+
+
+def create_backend(module, network, backend, model_name):
+    """
+    Args:
+        module (nn.Module): eager network already on its device in eval mode
+        network (str): key of CREATORS, decides the example inputs and ONNX input names
+        backend (str): one of BACKENDS
+        model_name (str): --model name, part of the exported file name
+
+    Returns:
+        module (nn.Module): module with the same call signature and outputs running on the chosen backend
+    """
+    if backend == 'eager':
+        return module
+    device = get_module_device(module)
+    dtype = get_module_dtype(module)
+    example_inputs = create_inputs(network, 1, dtype, device)
+    if backend == 'torchscript':
+        return export_torchscript(module, example_inputs)
+    elif backend == 'compile':
+        return torch.compile(module, dynamic=True)
+    elif backend == 'onnxruntime':
+        if dtype != torch.float:
+            raise RuntimeError("The onnxruntime backend only runs float models, not '%s'" % model_name)
+        file_name = os.path.join(ONNX_DIR, '%s_%s_%s.onnx' % (model_name, network, hash_state_dict(module)))
+        if not os.path.exists(file_name):
+            print("Exporting %s to ONNX ... " % network, end="")
+            export_onnx(module, network, example_inputs, file_name)
+            print("DONE!!!")
+        return ONNXRuntimeModule(file_name, device)
+    else:
+        raise RuntimeError("Invalid backend: '%s'" % backend)
+
+
+@torch.no_grad()
+def check_parity(reference, candidate, inputs):
+    """
+    Returns:
+        max_diff (float): largest absolute difference over every output of the two modules
+    """
+    reference_outputs = reference(*inputs)
+    candidate_outputs = candidate(*inputs)
+    return max((a.float() - b.float()).abs().max().item() for a, b in zip(reference_outputs, candidate_outputs))
+
+
+if __name__ == '__main__':
+    import argparse
+    import importlib
+
+    parser = argparse.ArgumentParser(description="Check every backend against eager PyTorch with random weights")
+    parser.add_argument('--mode', type=str, default='standard_float')
+    parser.add_argument('--networks', type=str, default=','.join(NETWORKS))
+    parser.add_argument('--backends', type=str, default=','.join(BACKENDS[1:]))
+    parser.add_argument('--batch', type=int, default=2)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--tolerance', type=float, default=1e-3)
+    check_args = parser.parse_args()
+
+    mode = importlib.import_module('tha3.poser.modes.' + check_args.mode)
+    failed = False
+    for network in check_args.networks.split(','):
+        torch.manual_seed(0)
+        module = getattr(mode, CREATORS[network])().eval()
+        inputs = create_inputs(network, check_args.batch, get_module_dtype(module), torch.device('cpu'))
+        timings = {}
+        for backend in ['eager'] + check_args.backends.split(','):
+            try:
+                candidate = create_backend(module, network, backend, check_args.mode + '_random')
+            except RuntimeError as e:
+                print("%-28s %-12s skipped: %s" % (network, backend, e))
+                continue
+            max_diff = check_parity(module, candidate, inputs)
+            with torch.no_grad():
+                tic = time.perf_counter()
+                for i in range(check_args.repeat):
+                    candidate(*inputs)
+                timings[backend] = (time.perf_counter() - tic) * 1000 / check_args.repeat
+            ok = max_diff <= check_args.tolerance
+            failed = failed or not ok
+            print("%-28s %-12s max diff %.2e %s %10.2f ms %6.2fx" % (
+                network, backend, max_diff, 'OK  ' if ok else 'FAIL', timings[backend],
+                timings['eager'] / timings[backend]))
+    if failed:
+        raise SystemExit(1)
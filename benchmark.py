@@ -0,0 +1,241 @@
+import argparse
+import importlib
+import json
+import platform
+import statistics
+import time
+
+import torch
+
+from fusion import OpCounter, fuse_model
+from tha3.nn.editor.editor_07 import Editor07
+from tha3.nn.eyebrow_morphing_combiner.eyebrow_morphing_combiner_00 import EyebrowMorphingCombiner00
+from tha3.nn.pose_input_buffer import use_input_buffer
+from tha3.nn.two_algo_body_rotator.two_algo_face_body_rotator_05 import TwoAlgoFaceBodyRotator05
+from tha3.poser.general_poser_02 import GeneralPoser02
+
+MODES = ['standard_float', 'standard_half', 'separable_float', 'separable_half']
+NETWORKS = ['eyebrow_decomposer', 'eyebrow_morphing_combiner', 'face_morpher', 'two_algo_face_body_rotator', 'editor',
+            'poser']
+
+CREATORS = {
+    'eyebrow_decomposer': 'create_eyebrow_decomposer',
+    'eyebrow_morphing_combiner': 'create_eyebrow_morphing_combiner',
+    'face_morpher': 'create_face_morpher',
+    'two_algo_face_body_rotator': 'create_two_algo_generator',
+    'editor': 'create_editor',
+}
+
+
+def get_mode_dtype(mode):
+    return torch.half if mode.endswith('_half') else torch.float
+
+
+def create_random_poser(mode, device):
+    """
+    build the full GeneralPoser02 pipeline of a mode with randomly initialised weights instead of loading data/models
+    """
+    mode_module = importlib.import_module('tha3.poser.modes.' + mode)
+    loaders = {network: getattr(mode_module, creator) for network, creator in CREATORS.items()}
+    return GeneralPoser02(
+        image_size=512,
+        module_loaders=loaders,
+        pose_parameters=mode_module.get_pose_parameters().get_pose_parameter_groups(),
+        output_list_func=mode_module.FiveStepPoserComputationProtocol(
+            EyebrowMorphingCombiner00.EYEBROW_IMAGE_NO_COMBINE_ALPHA_INDEX).compute_func(),
+        subrect=None,
+        device=device,
+        output_length=29,
+        default_output_index=0,
+        dtype=get_mode_dtype(mode))
+
+
+def create_inputs(network, batch, dtype, device):
+    """
+    Returns:
+        inputs (list): random tensors with the shapes the network sees inside the poser
+    """
+    def image(channels, size):
+        return torch.rand(batch, channels, size, size, dtype=dtype, device=device) * 2 - 1
+
+    def pose(count):
+        return torch.rand(batch, count, dtype=dtype, device=device)
+
+    if network == 'eyebrow_decomposer':
+        return [image(4, 128)]
+    elif network == 'eyebrow_morphing_combiner':
+        return [image(4, 128), image(4, 128), pose(12)]
+    elif network == 'face_morpher':
+        return [image(4, 192), pose(27)]
+    elif network == 'two_algo_face_body_rotator':
+        return [image(4, 256), pose(6)]
+    elif network == 'editor':
+        return [image(4, 512), image(4, 512), image(2, 512), pose(6)]
+    elif network == 'poser':
+        return [image(4, 512), pose(45)]
+    else:
+        raise RuntimeError("Invalid network: '%s'" % network)
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+@torch.no_grad()
+def time_function(func, inputs, device, warmup, repeat):
+    """
+    Returns:
+        timings (list): wall time of each timed call in milliseconds
+    """
+    for i in range(warmup):
+        func(*inputs)
+    synchronize(device)
+    timings = []
+    for i in range(repeat):
+        tic = time.perf_counter()
+        func(*inputs)
+        synchronize(device)
+        timings.append((time.perf_counter() - tic) * 1000)
+    return timings
+
+
+@torch.no_grad()
+def count_allocations(func, inputs, device):
+    """
+    Returns:
+        allocations (int): tensors newly allocated by one call, after a warm-up call
+        peak_bytes (int): most memory held at once by the call on top of what was allocated before it
+    """
+    func(*inputs)
+    synchronize(device)
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+        base_bytes = torch.cuda.memory_allocated(device)
+    with OpCounter() as counter:
+        func(*inputs)
+    synchronize(device)
+    if device.type == 'cuda':
+        return counter.allocations, torch.cuda.max_memory_allocated(device) - base_bytes
+    return counter.allocations, counter.peak_bytes
+
+
+def prepare_inference(module, channels_last):
+    """
+    apply the load time rewrites of TalkingAnime3: fused conv blocks and reused pose input buffers
+    """
+    fuse_model(module)
+    memory_format = torch.channels_last if channels_last else torch.contiguous_format
+    for submodule in module.modules():
+        if isinstance(submodule, (Editor07, TwoAlgoFaceBodyRotator05)):
+            use_input_buffer(submodule, memory_format)
+    return module
+
+
+def summarize(timings):
+    return {
+        'mean_ms': statistics.mean(timings),
+        'median_ms': statistics.median(timings),
+        'min_ms': min(timings),
+        'max_ms': max(timings),
+        'stdev_ms': statistics.stdev(timings) if len(timings) > 1 else 0.0,
+    }
+
+
+def benchmark_mode(mode, networks, device, batch, warmup, repeat, inference=False, channels_last=False):
+    mode_module = importlib.import_module('tha3.poser.modes.' + mode)
+    dtype = get_mode_dtype(mode)
+    results = {}
+    for network in networks:
+        torch.manual_seed(0)
+        inputs = create_inputs(network, batch, dtype, device)
+        if network == 'poser':
+            poser = create_random_poser(mode, device)
+            modules = poser.get_modules().values()
+            func = poser.pose
+        else:
+            module = getattr(mode_module, CREATORS[network])().to(device).eval()
+            modules = [module]
+            func = module.forward
+        if inference:
+            for module in modules:
+                prepare_inference(module, channels_last)
+        result = summarize(time_function(func, inputs, device, warmup, repeat))
+        result['params'] = sum(p.numel() for m in modules for p in m.parameters())
+        result['fps'] = 1000 * batch / result['median_ms']
+        result['allocations'], result['peak_bytes'] = count_allocations(func, inputs, device)
+        results[network] = result
+        print("%-16s %-28s %10.2f ms %8.2f fps %6d allocs %8.1f MB peak" % (
+            mode, network, result['median_ms'], result['fps'], result['allocations'], result['peak_bytes'] / 2 ** 20))
+    return results
+
+
+def compare(results, baseline):
+    print("%-16s %-28s %10s %10s %8s" % ('mode', 'network', 'baseline', 'current', 'speedup'))
+    for mode, networks in results.items():
+        for network, result in networks.items():
+            if network not in baseline.get(mode, {}):
+                continue
+            old = baseline[mode][network]['median_ms']
+            print("%-16s %-28s %10.2f %10.2f %7.2fx" % (mode, network, old, result['median_ms'],
+                                                        old / result['median_ms']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the THA3 networks with random weights")
+    parser.add_argument('--modes', type=str, default=','.join(MODES))
+    parser.add_argument('--networks', type=str, default=','.join(NETWORKS))
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--threads', type=int, default=0, help="torch intra-op threads, 0 keeps the default")
+    parser.add_argument('--batch', type=int, default=1)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--inference', action='store_true',
+                        help="fuse conv blocks and reuse pose input buffers like TalkingAnime3 does")
+    parser.add_argument('--channels_last', action='store_true',
+                        help="with --inference, run the editor and rotator in channels-last memory format")
+    parser.add_argument('--output', type=str, default='benchmark.json')
+    parser.add_argument('--baseline', type=str, help="previous JSON output to compare against")
+    benchmark_args = parser.parse_args()
+
+    modes = benchmark_args.modes.split(',')
+    networks = benchmark_args.networks.split(',')
+    for mode in modes:
+        if mode not in MODES:
+            raise RuntimeError("Invalid mode: '%s'" % mode)
+    for network in networks:
+        if network not in NETWORKS:
+            raise RuntimeError("Invalid network: '%s'" % network)
+    if benchmark_args.threads > 0:
+        torch.set_num_threads(benchmark_args.threads)
+    device = torch.device(benchmark_args.device)
+
+    report = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'torch': torch.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'device': str(device),
+        'threads': torch.get_num_threads(),
+        'batch': benchmark_args.batch,
+        'warmup': benchmark_args.warmup,
+        'repeat': benchmark_args.repeat,
+        'inference': benchmark_args.inference,
+        'channels_last': benchmark_args.channels_last,
+        'results': {},
+    }
+    for mode in modes:
+        report['results'][mode] = benchmark_mode(mode, networks, device, benchmark_args.batch, benchmark_args.warmup,
+                                                 benchmark_args.repeat, benchmark_args.inference,
+                                                 benchmark_args.channels_last)
+    with open(benchmark_args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print("Results written to", benchmark_args.output)
+
+    if benchmark_args.baseline is not None:
+        with open(benchmark_args.baseline) as f:
+            compare(report['results'], json.load(f)['results'])
+
+
+if __name__ == '__main__':
+    main()
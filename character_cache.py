@@ -0,0 +1,165 @@
+import hashlib
+import os
+import struct
+
+import numpy as np
+import torch
+from PIL import Image
+
+from utils import ingest_character_image
+
+CACHE_DIR = 'data/cache'
+EVTCHAR_MAGIC = b'EVTCHAR\0'
+EVTCHAR_VERSION = 1
+EVTCHAR_HEADER = struct.Struct('=8sI16s4I3I')
+EVTCHAR_ALIGN = 64
+
+STORAGE_DTYPES = {
+    'float': (torch.float, torch.int32, np.int32),
+    'half': (torch.half, torch.int16, np.int16),
+    'bf16': (torch.bfloat16, torch.int16, np.int16),
+}
+
+
+def get_model_dtype_name(model):
+    """
+    map a --model name to the dtype its networks run in
+    Args:
+        model (str): model name, e.g. standard_float, separable_half, standard_bf16
+
+    Returns:
+        dtype name (str): key of STORAGE_DTYPES
+    """
+    if model.endswith('half'):
+        return 'half'
+    elif model.endswith('bf16'):
+        return 'bf16'
+    return 'float'
+
+
+def get_model_dtype(model):
+    return STORAGE_DTYPES[get_model_dtype_name(model)][0]
+
+
+def hash_file(file_name):
+    digest = hashlib.sha256()
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _align(offset):
+    return (offset + EVTCHAR_ALIGN - 1) // EVTCHAR_ALIGN * EVTCHAR_ALIGN
+
+
+def save_evtchar(file_name, input_image, extra_image, dtype_name):
+    """
+    write a ready-to-upload character tensor and its body strip into an .evtchar file
+    Args:
+        file_name (str): destination path, written atomically
+        input_image (tensor): 1x4xHxW model input in the model dtype
+        extra_image (numpy array): HxWx4 uint8 body strip or None
+        dtype_name (str): key of STORAGE_DTYPES
+    """
+    _, storage_dtype, _ = STORAGE_DTYPES[dtype_name]
+    extra_shape = extra_image.shape if extra_image is not None else (0, 0, 0)
+    header = EVTCHAR_HEADER.pack(EVTCHAR_MAGIC, EVTCHAR_VERSION, dtype_name.encode('ascii'),
+                                 *input_image.shape, *extra_shape)
+    input_bytes = input_image.contiguous().view(storage_dtype).numpy().tobytes()
+    input_offset = _align(len(header))
+    extra_offset = _align(input_offset + len(input_bytes))
+
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    tmp_file_name = file_name + '.tmp%d' % os.getpid()
+    with open(tmp_file_name, 'wb') as f:
+        f.write(header)
+        f.seek(input_offset)
+        f.write(input_bytes)
+        if extra_image is not None:
+            f.seek(extra_offset)
+            f.write(np.ascontiguousarray(extra_image).tobytes())
+    os.replace(tmp_file_name, file_name)
+
+
+def load_evtchar(file_name):
+    """
+    memory-map an .evtchar file without copying its payload
+    Args:
+        file_name (str): .evtchar path
+
+    Returns:
+        input_image (tensor): 1x4xHxW model input backed by the file mapping
+        extra_image (numpy array): HxWx4 uint8 body strip backed by the file mapping, or None
+    """
+    with open(file_name, 'rb') as f:
+        header = f.read(EVTCHAR_HEADER.size)
+    if len(header) != EVTCHAR_HEADER.size:
+        raise RuntimeError("Truncated character cache: " + file_name)
+    magic, version, dtype_name, n, c, h, w, extra_h, extra_w, extra_c = EVTCHAR_HEADER.unpack(header)
+    if magic != EVTCHAR_MAGIC or version != EVTCHAR_VERSION:
+        raise RuntimeError("Invalid character cache: " + file_name)
+    dtype, _, storage_np_dtype = STORAGE_DTYPES[dtype_name.rstrip(b'\0').decode('ascii')]
+
+    input_offset = _align(EVTCHAR_HEADER.size)
+    # copy-on-write mapping keeps the file untouched while giving torch a writable array
+    input_array = np.memmap(file_name, dtype=storage_np_dtype, mode='c', offset=input_offset, shape=(n, c, h, w))
+    input_image = torch.from_numpy(input_array).view(dtype)
+    extra_image = None
+    if extra_h > 0:
+        extra_offset = _align(input_offset + input_array.nbytes)
+        extra_image = np.memmap(file_name, dtype=np.uint8, mode='c', offset=extra_offset,
+                                shape=(extra_h, extra_w, extra_c))
+    return input_image, extra_image
+
+
+def build_character(image_file_name, dtype, width=512):
+    input_image, extra_image = ingest_character_image(Image.open(image_file_name), width)
+    input_image = torch.from_numpy(input_image).to(dtype) * 2.0 - 1
+    return input_image.unsqueeze(0), extra_image
+
+
+def get_character_file(image_file_name, model, width=512, cache_dir=CACHE_DIR):
+    """
+    return the .evtchar file for a character image, building it on the first use
+    Args:
+        image_file_name (str): source character png
+        model (str): --model name, selects the stored dtype
+        width (int): model input width
+        cache_dir (str): directory holding .evtchar files
+
+    Returns:
+        file name (str): path of the content-addressed .evtchar file
+    """
+    dtype_name = get_model_dtype_name(model)
+    file_name = os.path.join(cache_dir, '%s_%d_%s.evtchar' % (hash_file(image_file_name), width, dtype_name))
+    if not os.path.exists(file_name):
+        input_image, extra_image = build_character(image_file_name, STORAGE_DTYPES[dtype_name][0], width)
+        save_evtchar(file_name, input_image, extra_image, dtype_name)
+    return file_name
+
+
+if __name__ == '__main__':
+    import tempfile
+    import time
+
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        image_file_name = os.path.join(tmp_dir, 'character.png')
+        raw = rng.integers(0, 256, (1024, 512, 4), dtype=np.uint8)
+        Image.fromarray(raw, mode='RGBA').save(image_file_name)
+        for model in ['standard_float', 'standard_half', 'standard_bf16']:
+            dtype = get_model_dtype(model)
+
+            tic = time.perf_counter()
+            expected_input, expected_extra = build_character(image_file_name, dtype)
+            build_time = time.perf_counter() - tic
+
+            get_character_file(image_file_name, model, cache_dir=tmp_dir)
+            tic = time.perf_counter()
+            input_image, extra_image = load_evtchar(get_character_file(image_file_name, model, cache_dir=tmp_dir))
+            load_time = time.perf_counter() - tic
+
+            assert input_image.dtype == dtype and torch.equal(input_image, expected_input)
+            assert np.array_equal(extra_image, expected_extra)
+            print("%s: build %.1f ms, cached %.1f ms" % (model, build_time * 1000, load_time * 1000))
@@ -0,0 +1,178 @@
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+DEFAULT_GRID_STEPS = 1000
+FACE_CACHE_STATS = ('hits', 'host_hits', 'misses', 'demotions', 'evictions', 'entries', 'device_bytes', 'host_bytes')
+
+
+def tensor_bytes(tensor):
+    if isinstance(tensor, (list, tuple)):
+        return sum(tensor_bytes(item) for item in tensor)
+    return tensor.numel() * tensor.element_size()
+
+
+def map_tensors(func, tensor):
+    if isinstance(tensor, (list, tuple)):
+        return type(tensor)(func(item) for item in tensor)
+    return func(tensor)
+
+
+class PoseKeyPacker:
+    """
+    turn a pose vector into a compact hashable key by packing its position on the simplify grid
+
+    simplify rounds parameter i to a multiple of 1/grid[i], so round(value * grid[i]) is an exact integer code for it.
+    Parameters without a grid step (0 in simplify_arr) fall back to DEFAULT_GRID_STEPS.
+    """
+
+    def __init__(self, grid):
+        grid = np.asarray(grid, dtype=np.float64)
+        self.steps = np.where(grid > 0, grid, DEFAULT_GRID_STEPS)
+
+    def __call__(self, values):
+        """
+        Args:
+            values (numpy array): parameters laid out like the grid
+
+        Returns:
+            key (bytes): packed int32 codes
+        """
+        return np.rint(np.asarray(values, dtype=np.float64) * self.steps).astype(np.int32).tobytes()
+
+
+class TensorCache:
+    """
+    two-tier LRU cache of network outputs (a tensor or a list of tensors) sized in bytes
+
+    Entries live on the model device until the device tier is over budget, then the least recently used ones are
+    demoted to pinned host memory, which is cheap to copy back without a sync. Entries falling out of the host tier
+    are dropped. On CPU both tiers would be the same memory, so they are merged into one.
+    """
+
+    def __init__(self, device, device_bytes, host_bytes):
+        self.device = torch.device(device)
+        self.tiered = self.device.type != 'cpu'
+        self.device_budget = device_bytes if self.tiered else device_bytes + host_bytes
+        self.host_budget = host_bytes if self.tiered else 0
+        self.device_entries = OrderedDict()
+        self.host_entries = OrderedDict()
+        self.device_bytes = 0
+        self.host_bytes = 0
+        self.hits = 0
+        self.host_hits = 0
+        self.misses = 0
+        self.demotions = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.device_entries) + len(self.host_entries)
+
+    @property
+    def lookups(self):
+        return self.hits + self.host_hits + self.misses
+
+    @property
+    def hit_ratio(self):
+        return (self.hits + self.host_hits) / self.lookups if self.lookups > 0 else 0.0
+
+    def get(self, key):
+        """
+        Returns:
+            tensor (tensor): cached output on the model device, None on a miss
+        """
+        tensor = self.device_entries.get(key)
+        if tensor is not None:
+            self.device_entries.move_to_end(key)
+            self.hits += 1
+            return tensor
+        tensor = self.host_entries.get(key)
+        if tensor is not None:
+            self.host_hits += 1
+            device_tensor = map_tensors(lambda item: item.to(self.device, non_blocking=True), tensor)
+            if tensor_bytes(tensor) > self.device_budget:
+                # never fits the device tier, it stays on the host
+                self.host_entries.move_to_end(key)
+                return device_tensor
+            del self.host_entries[key]
+            self.host_bytes -= tensor_bytes(tensor)
+            self.insert(key, device_tensor)
+            return device_tensor
+        self.misses += 1
+        return None
+
+    def put(self, key, tensor):
+        if key in self.device_entries or key in self.host_entries:
+            return
+        self.insert(key, map_tensors(lambda item: item.detach(), tensor))
+
+    def insert(self, key, tensor):
+        size = tensor_bytes(tensor)
+        if size > self.device_budget:
+            # bigger than the whole device tier, the host tier may still have room
+            self.demote(key, tensor)
+            return
+        self.device_entries[key] = tensor
+        self.device_bytes += size
+        while self.device_bytes > self.device_budget:
+            old_key, old_tensor = self.device_entries.popitem(last=False)
+            self.device_bytes -= tensor_bytes(old_tensor)
+            self.demote(old_key, old_tensor)
+
+    def demote(self, key, tensor):
+        size = tensor_bytes(tensor)
+        if size > self.host_budget:
+            self.evictions += 1
+            return
+        self.host_entries[key] = map_tensors(
+            lambda item: torch.empty(item.shape, dtype=item.dtype, pin_memory=True).copy_(item), tensor)
+        self.host_bytes += size
+        self.demotions += 1
+        while self.host_bytes > self.host_budget:
+            old_key, old_tensor = self.host_entries.popitem(last=False)
+            self.host_bytes -= tensor_bytes(old_tensor)
+            self.evictions += 1
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'host_hits': self.host_hits,
+            'misses': self.misses,
+            'demotions': self.demotions,
+            'evictions': self.evictions,
+            'entries': len(self),
+            'device_bytes': self.device_bytes,
+            'host_bytes': self.host_bytes,
+        }
+
+
+if __name__ == '__main__':
+    import time
+
+    rng = np.random.default_rng(0)
+    grid = np.full(39, 200)
+    poses = np.rint(rng.uniform(-1, 1, (1000, 39)) * grid) / grid
+    pack = PoseKeyPacker(grid)
+    repeat = 10
+
+    tic = time.perf_counter()
+    for i in range(repeat):
+        for pose in poses:
+            hash(tuple(pose.tolist()))
+    print("hash(tuple): %.2f us/key" % ((time.perf_counter() - tic) * 1e6 / repeat / len(poses)))
+
+    tic = time.perf_counter()
+    for i in range(repeat):
+        for pose in poses:
+            hash(pack(pose))
+    print("PoseKeyPacker: %.2f us/key" % ((time.perf_counter() - tic) * 1e6 / repeat / len(poses)))
+    assert len(set(pack(pose) for pose in poses)) == len(set(tuple(pose) for pose in poses))
+
+    entry = torch.zeros(1, 4, 192, 192)
+    cache = TensorCache('cpu', tensor_bytes(entry) * 64, tensor_bytes(entry) * 64)
+    for i in range(256):
+        key = pack(poses[rng.integers(0, 200)])
+        if cache.get(key) is None:
+            cache.put(key, entry.clone())
+    print(cache.stats(), "hit ratio %.2f" % cache.hit_ratio)
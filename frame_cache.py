@@ -0,0 +1,172 @@
+import time
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+
+class RawCodec:
+    """
+    keep frames as they are, costs nothing to decode
+    """
+
+    def encode(self, frame):
+        return frame, frame.nbytes
+
+    def decode(self, payload):
+        return payload
+
+    def release(self, payload):
+        return payload.nbytes
+
+
+class ZlibCodec:
+    def __init__(self, level=1):
+        self.level = level
+
+    def encode(self, frame):
+        payload = (zlib.compress(frame, self.level), frame.shape, frame.dtype)
+        return payload, len(payload[0])
+
+    def decode(self, payload):
+        data, shape, dtype = payload
+        return np.frombuffer(zlib.decompress(data), dtype=dtype).reshape(shape)
+
+    def release(self, payload):
+        return len(payload[0])
+
+
+class LZ4Codec:
+    def __init__(self):
+        try:
+            import lz4.block
+        except ImportError:
+            raise RuntimeError("The lz4 frame cache codec needs the lz4 package (pip install lz4)")
+        self.block = lz4.block
+
+    def encode(self, frame):
+        payload = (self.block.compress(frame, store_size=False), frame.shape, frame.dtype)
+        return payload, len(payload[0])
+
+    def decode(self, payload):
+        data, shape, dtype = payload
+        return np.frombuffer(self.block.decompress(data, uncompressed_size=int(np.prod(shape)) * dtype.itemsize),
+                             dtype=dtype).reshape(shape)
+
+    def release(self, payload):
+        return len(payload[0])
+
+
+def create_codec(name):
+    if name == 'raw':
+        return RawCodec()
+    elif name == 'zlib':
+        return ZlibCodec()
+    elif name == 'lz4':
+        return LZ4Codec()
+    else:
+        raise RuntimeError("Invalid cache codec: '%s'" % name)
+
+
+class FrameCache:
+    """
+    LRU cache of finished output frames with a budget in bytes of stored (possibly compressed) data
+    """
+
+    def __init__(self, budget, codec='raw'):
+        self.budget = budget
+        self.codec = create_codec(codec) if isinstance(codec, str) else codec
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.raw_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.encode_time = 0.0
+        self.decode_time = 0.0
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def hit_ratio(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+    def get(self, key):
+        """
+        Returns:
+            frame (numpy array): cached frame, None on a miss. Treat it as read-only, it may be shared with the cache.
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        tic = time.perf_counter()
+        frame = self.codec.decode(entry[0])
+        self.decode_time += time.perf_counter() - tic
+        return frame
+
+    def put(self, key, frame):
+        if self.budget <= 0 or key in self.entries:
+            return
+        tic = time.perf_counter()
+        payload, size = self.codec.encode(frame)
+        self.encode_time += time.perf_counter() - tic
+        self.entries[key] = (payload, frame.nbytes)
+        self.bytes += size
+        self.raw_bytes += frame.nbytes
+        while self.bytes > self.budget and len(self.entries) > 0:
+            old_payload, old_raw_bytes = self.entries.popitem(last=False)[1]
+            self.bytes -= self.codec.release(old_payload)
+            self.raw_bytes -= old_raw_bytes
+            self.evictions += 1
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self),
+            'bytes': self.bytes,
+            'raw_bytes': self.raw_bytes,
+            'compression_ratio': self.raw_bytes / self.bytes if self.bytes > 0 else 1.0,
+            'encode_ms': self.encode_time * 1000 / (len(self) + self.evictions) if len(self) + self.evictions > 0
+            else 0.0,
+            'decode_ms': self.decode_time * 1000 / self.hits if self.hits > 0 else 0.0,
+        }
+
+
+if __name__ == '__main__':
+    import sys
+
+    import cv2
+
+    # frames with the layout of a real output: a character on a transparent background drifting between frames
+    rng = np.random.default_rng(0)
+    base = np.zeros((512, 512, 4), dtype=np.uint8)
+    cv2.ellipse(base, (256, 300), (150, 220), 0, 0, 360, (230, 200, 190, 255), -1)
+    base[:, :, :3] = cv2.add(base[:, :, :3], rng.integers(0, 8, (512, 512, 3), dtype=np.uint8))
+    base[base[:, :, 3] == 0] = 0
+    frames = []
+    for i in range(64):
+        rm = np.float32([[1, 0, np.sin(i / 8) * 6], [0, 1, 0]])
+        frames.append(cv2.warpAffine(base, rm, (512, 512)))
+
+    codecs = sys.argv[1:] if len(sys.argv) > 1 else ['raw', 'zlib', 'lz4']
+    for codec in codecs:
+        try:
+            cache = FrameCache(1 << 40, codec)
+        except RuntimeError as e:
+            print(codec, e)
+            continue
+        for i, frame in enumerate(frames):
+            cache.put(i, frame)
+        for i, frame in enumerate(frames):
+            assert np.array_equal(cache.get(i), frame)
+        stats = cache.stats()
+        print("%-10s %6.2fx  %7.1f KB/frame  encode %6.2f ms  decode %6.2f ms" % (
+            codec, stats['compression_ratio'], stats['bytes'] / len(frames) / 1024, stats['encode_ms'],
+            stats['decode_ms']))
@@ -0,0 +1,210 @@
+import os
+import queue
+import threading
+import time
+from collections import deque
+
+import numpy as np
+import torch
+
+from utils import frame_postprocessor
+
+OUTPUT_BUFFERS = 2
+
+
+class AsyncFrameOutput:
+    """
+    double-buffered path from rendered model outputs to a frame sink, overlapped with the next inference
+
+    On CUDA a frame is postprocessed to uint8 on the device and copied into one of `buffers` pinned host buffers
+    by a non_blocking copy on a side stream, so submit returns as soon as the work is queued. On the CPU there is
+    nothing to copy and the postprocess itself is handed over. Either way a worker thread finishes the frame (waits
+    for the copy's event, or postprocesses) and passes it to the sink, in submission order, while the caller already
+    renders the next one. With `buffers` frames in flight submit waits for the oldest to finish.
+
+    A single CPU core has nothing to overlap with, there the frames are finished inline unless threaded is forced.
+
+    Frames published with keep_frames, and the time the worker spent on them, come back through completed() on the
+    submitting thread, for the consumers that aren't thread safe.
+    """
+
+    def __init__(self, sink, device, buffers=OUTPUT_BUFFERS, keep_frames=False, threaded=None):
+        """
+        Args:
+            sink (callable): sink(frame, timestamp) with an HxWx4 uint8 numpy frame, valid only during the call
+            device (torch.device): device the model outputs live on
+            buffers (int): frames in flight at most
+            keep_frames (bool): hand copies of the frames submitted with a key back through completed()
+            threaded (bool): finish frames on the worker thread, by default on CUDA or with more than one CPU core
+        """
+        self.sink = sink
+        self.device = torch.device(device)
+        self.keep_frames = keep_frames
+        self.cuda = self.device.type == 'cuda'
+        self.stream = torch.cuda.Stream(self.device) if self.cuda else None
+        self.host_buffers = [None] * buffers
+        self.free_slots = queue.Queue()
+        for slot in range(buffers):
+            self.free_slots.put(slot)
+        self.pending = queue.Queue()
+        self.finished = deque()
+        self.error = None
+        if threaded is None:
+            threaded = self.cuda or (os.cpu_count() or 1) > 1
+        self.worker = None
+        if threaded:
+            self.worker = threading.Thread(target=self.run, daemon=True)
+            self.worker.start()
+
+    def acquire_slot(self):
+        slot = self.free_slots.get()
+        if self.error is not None:
+            self.free_slots.put(slot)
+            raise RuntimeError("Frame output worker failed") from self.error
+        return slot
+
+    def submit(self, image, timestamp=0.0, key=None):
+        """
+        Args:
+            image (tensor): 4xHxW model output in [-1, 1] on the device
+            timestamp (float): passed on to the sink
+            key (bytes): pose key the frame is kept under when keep_frames is set
+        """
+        slot = self.acquire_slot()
+        event = None
+        if self.cuda:
+            frame = frame_postprocessor(image.detach())
+            host_buffer = self.host_buffers[slot]
+            if host_buffer is None or host_buffer.shape != frame.shape:
+                host_buffer = torch.empty(frame.shape, dtype=frame.dtype, pin_memory=True)
+                self.host_buffers[slot] = host_buffer
+            self.stream.wait_stream(torch.cuda.current_stream(self.device))
+            with torch.cuda.stream(self.stream):
+                host_buffer.copy_(frame, non_blocking=True)
+                # the caching allocator mustn't hand frame to the next inference before the copy has read it
+                frame.record_stream(self.stream)
+                event = torch.cuda.Event()
+                event.record(self.stream)
+            image = None
+        self.put((slot, event, image, timestamp, key))
+
+    def submit_frame(self, frame, timestamp=0.0):
+        """
+        pass an already postprocessed frame (numpy array) to the sink after the frames submitted before it
+        """
+        slot = self.acquire_slot()
+        self.put((slot, None, frame, timestamp, None))
+
+    def put(self, item):
+        if self.worker is not None:
+            self.pending.put(item)
+        else:
+            self.finish(item)
+
+    def run(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                break
+            self.finish(item)
+
+    @torch.no_grad()
+    def finish(self, item):
+        slot, event, image, timestamp, key = item
+        try:
+            start = time.perf_counter_ns()
+            stage = None
+            if event is not None:
+                event.synchronize()
+                frame = self.host_buffers[slot].numpy()
+                stage = 'd2h_copy'
+            elif isinstance(image, torch.Tensor):
+                frame = frame_postprocessor(image.detach()).numpy()
+                stage = 'postprocess'
+            else:
+                frame = image
+            end = time.perf_counter_ns()
+            self.sink(frame, timestamp)
+            if stage is not None or (key is not None and self.keep_frames):
+                kept = frame.copy() if key is not None and self.keep_frames else None
+                self.finished.append((key, kept, stage, start, end))
+        except Exception as e:
+            if self.worker is None:
+                raise
+            self.error = e
+        finally:
+            self.free_slots.put(slot)
+
+    def completed(self):
+        """
+        Returns:
+            completed (list): (key, frame, stage, start, end) of the frames finished since the last call. frame is a
+                copy if keep_frames was set and the frame had a key, None otherwise; stage, start and end time the
+                postprocess or the wait for the copy (perf_counter_ns), stage is None for frames submitted as is.
+        """
+        completed = []
+        while len(self.finished) > 0:
+            completed.append(self.finished.popleft())
+        return completed
+
+    def flush(self):
+        """
+        wait until every submitted frame reached the sink
+        """
+        slots = [self.acquire_slot() for _ in self.host_buffers]
+        for slot in slots:
+            self.free_slots.put(slot)
+
+    def close(self):
+        if self.worker is not None:
+            self.pending.put(None)
+            self.worker.join()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Compare synchronous and double-buffered output with a fake model")
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--frames', type=int, default=50)
+    parser.add_argument('--buffers', type=int, default=OUTPUT_BUFFERS)
+    parser.add_argument('--threaded', action='store_true', help="use the worker thread even on a single CPU core")
+    output_args = parser.parse_args()
+
+    device = torch.device(output_args.device)
+    torch.manual_seed(0)
+    # a conv stack standing in for the poser, heavy enough that the postprocess is a fraction of a frame
+    model = torch.nn.Sequential(*[torch.nn.Conv2d(4, 4, 3, padding=1) for _ in range(4)], torch.nn.Tanh()).to(device)
+    poses = torch.rand(output_args.frames, 1, 4, 512, 512, device=device) * 2 - 1
+
+    def render(pose):
+        with torch.no_grad():
+            return model(pose)[0]
+
+    def run_sync():
+        frames = []
+        for pose in poses:
+            frames.append(frame_postprocessor(render(pose)).cpu().numpy())
+        return frames
+
+    def run_async():
+        frames = []
+        output = AsyncFrameOutput(lambda frame, timestamp: frames.append(frame.copy()), device, output_args.buffers,
+                                  threaded=output_args.threaded or None)
+        for pose in poses:
+            output.submit(render(pose))
+        output.flush()
+        output.close()
+        return frames
+
+    run_sync()
+    timings = []
+    for run in [run_sync, run_async]:
+        tic = time.perf_counter()
+        results = run()
+        timings.append((time.perf_counter() - tic) * 1000 / output_args.frames)
+        if run is run_sync:
+            reference = results
+    assert len(results) == len(reference) and all(np.array_equal(a, b) for a, b in zip(reference, results))
+    print("%s, %d CPU cores: synchronous %.2f ms/frame, double-buffered %.2f ms/frame (%.2fx), frames identical and "
+          "in order" % (device, os.cpu_count() or 1, timings[0], timings[1], timings[0] / timings[1]))
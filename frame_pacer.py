@@ -0,0 +1,202 @@
+import threading
+import time
+from collections import deque
+
+import cv2
+import numpy as np
+
+INTERPOLATIONS = ['none', 'blend']
+PACER_WINDOW = 600
+
+
+class FramePacer:
+    """
+    send frames to a sink at the sink's own fixed rate, however unevenly they arrive
+
+    A thread ticks at `fps` on absolute deadlines and sends the newest frame each tick, repeating it when nothing
+    new arrived (a duplicate) and skipping frames that were replaced before a tick came (drops). With 'blend'
+    interpolation the output runs one source frame interval behind the newest frame and ticks that fall between the
+    last two frames get a cross fade of them, so a 25 fps model moves on every tick of a 60 fps stream.
+    """
+
+    def __init__(self, sink, fps, interpolation='none'):
+        """
+        Args:
+            sink (callable): sink(frame) with an HxWxC uint8 numpy frame, called on the pacer thread
+            fps (float): output rate
+            interpolation (str): one of INTERPOLATIONS
+        """
+        if interpolation not in INTERPOLATIONS:
+            raise RuntimeError("Invalid interpolation: '%s'" % interpolation)
+        self.sink = sink
+        self.interval = 1.0 / fps
+        self.interpolation = interpolation
+        self.lock = threading.Lock()
+        self.latest = None
+        self.previous = None
+        self.latest_shown = False
+        self.source_interval = None
+        self.latency = 0.0
+        self.sent_times = deque(maxlen=PACER_WINDOW)
+        self.ticks = 0
+        self.received = 0
+        self.fresh = 0
+        self.duplicated = 0
+        self.interpolated = 0
+        self.dropped = 0
+        self.missed_ticks = 0
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def push(self, frame, key=None, timestamp=None):
+        """
+        hand over the newest frame, the pacer keeps a reference to it until two more frames arrived
+
+        Args:
+            frame (numpy array): HxWxC uint8 frame, mustn't be written to afterwards
+            key: source frame the frame was made from, a frame with the same key as the newest one replaces it in
+                place (newer pixels, e.g. moved to a new position, but the same moment of the source)
+            timestamp (float): perf_counter time the frame's latency is measured from, when it is first sent
+        """
+        now = time.perf_counter()
+        with self.lock:
+            if key is not None and self.latest is not None and self.latest[2] == key:
+                self.latest = (frame, self.latest[1], key, self.latest[3])
+                return
+            if self.latest is not None:
+                if not self.latest_shown:
+                    self.dropped += 1
+                gap = now - self.latest[1]
+                self.source_interval = gap if self.source_interval is None else \
+                    self.source_interval * 0.9 + gap * 0.1
+            self.previous = self.latest
+            self.latest = (frame, now, key, timestamp)
+            self.latest_shown = False
+            self.received += 1
+
+    def select(self, now):
+        with self.lock:
+            latest, previous, source_interval = self.latest, self.previous, self.source_interval
+            if latest is None:
+                return None
+            if self.interpolation == 'blend' and previous is not None and previous[0].shape == latest[0].shape:
+                # show the moment one source interval ago, somewhere between the last two frames
+                weight = (now - source_interval - previous[1]) / (latest[1] - previous[1])
+                if weight <= 0:
+                    # still at or before the older frame, which was sent already
+                    self.duplicated += 1
+                    return previous[0]
+                if weight < 1:
+                    self.interpolated += 1
+                    self.mark_shown(latest, now)
+                    return cv2.addWeighted(previous[0], 1 - weight, latest[0], weight, 0)
+            if self.latest_shown:
+                self.duplicated += 1
+            else:
+                self.fresh += 1
+                self.mark_shown(latest, now)
+            return latest[0]
+
+    def mark_shown(self, latest, now):
+        if not self.latest_shown and latest[3] is not None:
+            self.latency = now - latest[3]
+        self.latest_shown = True
+
+    def run(self):
+        deadline = time.perf_counter()
+        while not self.closed:
+            time.sleep(max(deadline - time.perf_counter(), 0))
+            now = time.perf_counter()
+            frame = self.select(now)
+            if frame is not None:
+                self.sink(frame)
+                with self.lock:
+                    self.sent_times.append(time.perf_counter())
+            self.ticks += 1
+            deadline += self.interval
+            behind = time.perf_counter() - deadline
+            if behind > self.interval:
+                # a slow sink or a stall, start again from now instead of bursting out the missed ticks
+                missed = int(behind / self.interval)
+                self.missed_ticks += missed
+                deadline += missed * self.interval
+
+    def stats(self):
+        """
+        Returns:
+            stats (dict): tick and frame counters, output fps and jitter (standard deviation of the time between
+                sends, ms) over the last PACER_WINDOW sends
+        """
+        with self.lock:
+            sent_times = np.array(self.sent_times)
+        intervals = np.diff(sent_times)
+        return {
+            'ticks': self.ticks,
+            'received': self.received,
+            'fresh': self.fresh,
+            'duplicated': self.duplicated,
+            'interpolated': self.interpolated,
+            'dropped': self.dropped,
+            'missed_ticks': self.missed_ticks,
+            'fps': 1 / intervals.mean() if len(intervals) > 0 else 0.0,
+            'jitter_ms': intervals.std() * 1000 if len(intervals) > 0 else 0.0,
+            'latency_ms': self.latency * 1000,
+        }
+
+    def close(self):
+        self.closed = True
+        self.thread.join()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Pace an uneven frame source to a fixed output rate")
+    parser.add_argument('--source_fps', type=float, default=25.0)
+    parser.add_argument('--source_jitter_ms', type=float, default=8.0)
+    parser.add_argument('--fps', type=float, default=60.0)
+    parser.add_argument('--seconds', type=float, default=3.0)
+    pacer_args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    # a bright square moving 6 pixels per source frame, to see how often and how far the sent frames move
+    frames = []
+    for i in range(int(pacer_args.source_fps * pacer_args.seconds) + 1):
+        frame = np.zeros((256, 512, 4), dtype=np.uint8)
+        x = i * 6 % 448
+        frame[96:160, x:x + 64] = 255
+        frames.append(frame)
+
+    def play(push):
+        start = time.perf_counter()
+        for i, frame in enumerate(frames):
+            due = start + i / pacer_args.source_fps + rng.uniform(0, pacer_args.source_jitter_ms / 1000)
+            time.sleep(max(due - time.perf_counter(), 0))
+            push(frame)
+
+    def position(frame):
+        row = frame[128, :, 0].astype(np.float64)
+        return (row * np.arange(len(row))).sum() / max(row.sum(), 1)
+
+    def motion(positions):
+        steps = np.abs(np.diff(positions))
+        steps = steps[(steps > 0) & (steps < 100)]
+        return len(steps) / pacer_args.seconds, steps.mean()
+
+    sent = []
+    play(lambda frame: sent.append((time.perf_counter(), position(frame))))
+    times, positions = np.array(sent).T
+    print("unpaced:  %5.1f fps, jitter %5.2f ms, %5.1f moves/s of %4.1f px" % (
+        (1 / np.diff(times).mean(), np.diff(times).std() * 1000) + motion(positions)))
+
+    for interpolation in INTERPOLATIONS:
+        positions = []
+        pacer = FramePacer(lambda frame: positions.append(position(frame)), pacer_args.fps, interpolation)
+        play(pacer.push)
+        pacer.close()
+        stats = pacer.stats()
+        print("%-8s  %5.1f fps, jitter %5.2f ms, %5.1f moves/s of %4.1f px, %d fresh, %d duplicated, "
+              "%d interpolated, %d dropped" % ((interpolation + ':', stats['fps'], stats['jitter_ms']) +
+                                               motion(positions) + (stats['fresh'], stats['duplicated'],
+                                                                    stats['interpolated'], stats['dropped'])))
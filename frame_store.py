@@ -0,0 +1,351 @@
+import mmap
+import os
+import struct
+import threading
+import time
+
+import numpy as np
+
+from character_cache import CACHE_DIR
+
+if os.name == 'nt':
+    import msvcrt
+else:
+    import fcntl
+
+FRAME_STORE_MAGIC = b'EVTFRAME'
+FRAME_STORE_VERSION = 1
+FRAME_STORE_HEADER = struct.Struct('<8sHHIII')
+RECORD_MAGIC = b'EVTR'
+RECORD_HEADER = struct.Struct('<4sIq')
+FRAME_STORE_ALIGN = 64
+COMPACT_RATIO = 0.75
+
+
+def _align(offset):
+    return (offset + FRAME_STORE_ALIGN - 1) // FRAME_STORE_ALIGN * FRAME_STORE_ALIGN
+
+
+class FileLock:
+    """
+    exclusive advisory lock on a sidecar file, serializes writers of one store across processes
+    """
+
+    def __init__(self, file_name):
+        self.file = open(file_name, 'a+b')
+
+    def __enter__(self):
+        if os.name == 'nt':
+            self.file.seek(0)
+            msvcrt.locking(self.file.fileno(), msvcrt.LK_LOCK, 1)
+        else:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if os.name == 'nt':
+            self.file.seek(0)
+            msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+
+    def close(self):
+        self.file.close()
+
+
+class FrameStore:
+    """
+    persistent append-only pose -> frame store backed by one memory-mapped file
+
+    The file is a header followed by fixed-size records: a 16 byte record header (magic, reserved, last use time),
+    the pose key and the frame, each record aligned to 64 bytes. A record is written with a blank magic that is set
+    last, so readers scanning the file concurrently never pick up a half written frame. Appends and last use updates
+    happen under a file lock, reads go straight through the map and only rescan the tail when a key is missing.
+    An append cut short (the console closed mid-write) leaves an unmarked or partial record, the next append pads it
+    to the record grid and scans skip it once anything follows it, since only the last record can still be written.
+    When the file outgrows max_bytes it is compacted on open, keeping the most recently used records. During a
+    session the store stops taking new frames once it is full, the next open makes room again.
+    """
+
+    def __init__(self, file_name, shape, key_size, max_bytes, dtype=np.uint8, readonly=False):
+        self.file_name = file_name
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.key_size = key_size
+        self.max_bytes = max_bytes
+        self.readonly = readonly
+        self.frame_bytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self.frame_offset = _align(RECORD_HEADER.size + key_size)
+        self.record_size = _align(self.frame_offset + self.frame_bytes)
+        self.data_offset = _align(FRAME_STORE_HEADER.size)
+        self.index = {}
+        self.touched = set()
+        self.map = None
+        self.scanned = self.data_offset
+        self.hits = 0
+        self.misses = 0
+        self.appended = 0
+        self.full = False
+
+        os.makedirs(os.path.dirname(file_name) or '.', exist_ok=True)
+        self.lock = FileLock(file_name + '.lock')
+        with self.lock:
+            if not os.path.exists(file_name) or os.path.getsize(file_name) < self.data_offset:
+                self.create()
+            self.check_header()
+            if not readonly and os.path.getsize(file_name) + self.record_size > max_bytes:
+                self.compact()
+        self.open()
+
+    def header(self):
+        return FRAME_STORE_HEADER.pack(FRAME_STORE_MAGIC, FRAME_STORE_VERSION, self.key_size,
+                                       *self.shape).ljust(self.data_offset, b'\0')
+
+    def create(self):
+        with open(self.file_name, 'wb') as f:
+            f.write(self.header())
+
+    def check_header(self):
+        with open(self.file_name, 'rb') as f:
+            header = f.read(self.data_offset)
+        if header != self.header():
+            # a different frame size or key layout can't share the file, start over but keep the old frames around
+            old_file_name = self.file_name + '.old'
+            try:
+                os.replace(self.file_name, old_file_name)
+                print("Frame store %s doesn't match this frame size or pose key, moved to %s and starting over" % (
+                    self.file_name, old_file_name))
+            except OSError:
+                print("Frame store %s doesn't match this frame size or pose key, starting over" % self.file_name)
+            self.create()
+
+    def open(self):
+        self.file = open(self.file_name, 'rb' if self.readonly else 'r+b')
+        self.inode = os.fstat(self.file.fileno()).st_ino
+        self.index = {}
+        self.map = None
+        self.scanned = self.data_offset
+        self.refresh()
+
+    def reopen_if_replaced(self):
+        try:
+            replaced = os.stat(self.file_name).st_ino != self.inode
+        except FileNotFoundError:
+            return
+        if replaced:
+            self.file.close()
+            self.open()
+
+    def refresh(self):
+        """
+        map the current file size and index records appended since the last scan
+        """
+        size = os.fstat(self.file.fileno()).st_size
+        if self.map is None or len(self.map) < size:
+            # views handed out keep the old map alive, so it is dropped rather than closed
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        offset = self.scanned
+        while offset + self.record_size <= len(self.map):
+            magic = self.map[offset:offset + 4]
+            if magic != RECORD_MAGIC:
+                if offset + self.record_size == len(self.map):
+                    # the last record may still be being written, look at it again on the next scan
+                    break
+                # appends are serialized, one followed by another was cut short and never will be marked
+                offset += self.record_size
+                continue
+            key_start = offset + RECORD_HEADER.size
+            self.index[bytes(self.map[key_start:key_start + self.key_size])] = offset
+            offset += self.record_size
+        self.scanned = offset
+        self.full = len(self.map) + self.record_size > self.max_bytes
+
+    def frame(self, offset):
+        start = offset + self.frame_offset
+        return np.frombuffer(self.map, dtype=self.dtype, count=int(np.prod(self.shape)),
+                             offset=start).reshape(self.shape)
+
+    def get(self, key):
+        """
+        Returns:
+            frame (numpy array): read-only view into the map, None if the pose was never stored
+        """
+        offset = self.index.get(key)
+        if offset is None or offset + self.record_size > len(self.map):
+            self.refresh()
+            offset = self.index.get(key)
+            if offset is None:
+                self.misses += 1
+                return None
+        self.hits += 1
+        if not self.readonly and key not in self.touched:
+            self.touched.add(key)
+            with self.lock:
+                self.file.seek(offset + 8)
+                self.file.write(struct.pack('<q', int(time.time())))
+        return self.frame(offset)
+
+    def put(self, key, frame):
+        if self.readonly or key in self.index:
+            return
+        if len(key) != self.key_size or frame.shape != self.shape:
+            raise RuntimeError("Frame store record doesn't match %s" % self.file_name)
+        record = bytearray(self.record_size)
+        RECORD_HEADER.pack_into(record, 0, b'\0\0\0\0', 0, int(time.time()))
+        record[RECORD_HEADER.size:RECORD_HEADER.size + self.key_size] = key
+        record[self.frame_offset:self.frame_offset + self.frame_bytes] = np.ascontiguousarray(frame, self.dtype).data
+        if self.full:
+            return
+        with self.lock:
+            self.reopen_if_replaced()
+            self.file.seek(0, os.SEEK_END)
+            offset = self.file.tell()
+            partial = (offset - self.data_offset) % self.record_size
+            if offset - partial + (2 if partial > 0 else 1) * self.record_size > self.max_bytes:
+                self.full = True
+                print("Frame store full (%d frames), new frames are stored again after it is compacted on the next "
+                      "start" % len(self))
+                return
+            if partial > 0:
+                # the tail of an append that was cut short, blank it to a whole unmarked record so the grid holds
+                self.file.seek(offset - partial)
+                self.file.write(bytes(self.record_size))
+                offset += self.record_size - partial
+            self.file.write(record)
+            self.file.flush()
+            self.file.seek(offset)
+            self.file.write(RECORD_MAGIC)
+            self.file.flush()
+        self.index[key] = offset
+        self.touched.add(key)
+        self.appended += 1
+
+    def compact(self):
+        """
+        rewrite the file with the most recently used records that fit in COMPACT_RATIO of max_bytes
+        """
+        records = []
+        with open(self.file_name, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            offset = self.data_offset
+            while offset + self.record_size <= size:
+                f.seek(offset)
+                magic, _, last_used = RECORD_HEADER.unpack(f.read(RECORD_HEADER.size))
+                if magic == RECORD_MAGIC:
+                    records.append((last_used, offset))
+                offset += self.record_size
+            records.sort(reverse=True)
+            keep = max(int(self.max_bytes * COMPACT_RATIO - self.data_offset) // self.record_size, 0)
+            temp_file_name = self.file_name + '.compact'
+            with open(temp_file_name, 'wb') as out:
+                out.write(self.header())
+                for last_used, offset in sorted(records[:keep], key=lambda record: record[1]):
+                    f.seek(offset)
+                    out.write(f.read(self.record_size))
+        try:
+            os.replace(temp_file_name, self.file_name)
+            print("Frame store compacted: %d of %d frames kept" % (min(keep, len(records)), len(records)))
+        except OSError:
+            # another process still has the file mapped (Windows), try again on the next start
+            os.remove(temp_file_name)
+
+    def prewarm(self, max_bytes):
+        """
+        page in the most recently used frames on a background thread so early hits don't wait for the disk
+        """
+        # picked here, index and map change under put and refresh while the thread runs
+        self.refresh()
+        order = sorted(self.index.values(), key=lambda offset: -RECORD_HEADER.unpack_from(self.map, offset)[2])
+        offsets = order[:max(max_bytes // self.record_size, 0)]
+        record_size = self.record_size
+
+        def run():
+            # the page cache is shared, a mapping of its own warms the same pages
+            with open(self.file_name, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as own_map:
+                for offset in offsets:
+                    if offset + record_size > len(own_map):
+                        continue
+                    own_map[offset:offset + record_size:mmap.PAGESIZE]
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    def __len__(self):
+        return len(self.index)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'appended': self.appended,
+            'frames': len(self),
+            'bytes': self.scanned,
+        }
+
+    def close(self):
+        self.file.close()
+        self.lock.close()
+
+
+def get_frame_store_file(character_file, model, simplify_level, eyebrow, approximations=(), cache_dir=CACHE_DIR):
+    """
+    Args:
+        character_file (str): .evtchar file of the character, its name already identifies the image
+        approximations (list): names of the enabled approximations whose frames differ from full renders, their
+            frames are kept apart from the exact ones
+
+    Returns:
+        file name (str): store shared by every session with the same character, model, simplify level, eyebrow and
+            approximations
+    """
+    character = os.path.splitext(os.path.basename(character_file))[0]
+    return os.path.join(cache_dir, 'frames', '%s_%s_s%d%s%s.evtframe' % (
+        character, model, simplify_level, '_eyebrow' if eyebrow else '',
+        ''.join('_' + name for name in sorted(approximations))))
+
+
+if __name__ == '__main__':
+    import sys
+    import tempfile
+
+    shape = (512, 512, 4)
+    rng = np.random.default_rng(0)
+    frames = [rng.integers(0, 256, shape, dtype=np.uint8) for _ in range(4)]
+    file_name = os.path.join(tempfile.mkdtemp(), 'test.evtframe')
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    store = FrameStore(file_name, shape, 180, 1 << 40)
+    tic = time.perf_counter()
+    for i in range(count):
+        store.put(np.int32([i] * 45).tobytes(), frames[i % len(frames)])
+    print("put: %.3f ms/frame" % ((time.perf_counter() - tic) * 1000 / count))
+
+    reader = FrameStore(file_name, shape, 180, 1 << 40, readonly=True)
+    tic = time.perf_counter()
+    for i in range(count):
+        assert np.array_equal(reader.get(np.int32([i] * 45).tobytes()), frames[i % len(frames)])
+    print("get: %.3f ms/frame" % ((time.perf_counter() - tic) * 1000 / count))
+    reader.close()
+    store.close()
+
+    store = FrameStore(file_name, shape, 180, store.record_size * count // 2)
+    print(store.stats())
+    store.close()
+
+    # an append cut short, followed by more appends in a new session: only the cut record is lost
+    file_name = os.path.join(tempfile.mkdtemp(), 'interrupted.evtframe')
+    store = FrameStore(file_name, shape, 180, 1 << 40)
+    store.put(np.int32([0] * 45).tobytes(), frames[0])
+    store.close()
+    with open(file_name, 'ab') as f:
+        f.write(RECORD_MAGIC + bytes(996))
+    store = FrameStore(file_name, shape, 180, 1 << 40)
+    for i in range(1, 5):
+        store.put(np.int32([i] * 45).tobytes(), frames[i % len(frames)])
+    store.close()
+    store = FrameStore(file_name, shape, 180, 1 << 40, readonly=True)
+    assert len(store) == 5, len(store)
+    for i in range(5):
+        assert np.array_equal(store.get(np.int32([i] * 45).tobytes()), frames[i % len(frames)])
+    store.close()
+    print("interrupted append: %d of 5 frames indexed after reopening" % len(store))
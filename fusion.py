@@ -0,0 +1,244 @@
+import weakref
+
+import torch
+import torch.nn as nn
+from torch.nn.functional import group_norm, leaky_relu_
+from torch.utils._python_dispatch import TorchDispatchMode
+from torch.utils._pytree import tree_leaves
+
+from tha3.nn.normalization import Bias2d
+from tha3.nn.pass_through import PassThrough
+
+CONV_TYPES = (nn.Conv2d, nn.ConvTranspose2d)
+
+
+class FusedConvNormAct(nn.Module):
+    """
+    one conv block of the THA3 networks, conv then optional InstanceNorm then optional activation in a single call
+
+    InstanceNorm is group_norm with one channel per group, which runs as a single kernel with the affine parameters
+    applied inside it, while InstanceNorm2d reshapes to a batch norm and repeats its weights for every image. The
+    activation then works in place on the freshly allocated norm output.
+    """
+
+    def __init__(self, conv, norm=None, activation=None):
+        super().__init__()
+        self.conv = conv
+        self.norm = norm is not None
+        self.num_features = norm.num_features if norm is not None else 0
+        self.eps = norm.eps if norm is not None else 0.0
+        self.weight = norm.weight if norm is not None and norm.affine else None
+        self.bias = norm.bias if norm is not None and norm.affine else None
+        self.activation = None
+        self.negative_slope = 0.0
+        if isinstance(activation, nn.ReLU):
+            self.activation = 'relu'
+        elif isinstance(activation, nn.LeakyReLU):
+            self.activation = 'leaky_relu'
+            self.negative_slope = activation.negative_slope
+        elif isinstance(activation, nn.Sigmoid):
+            self.activation = 'sigmoid'
+        elif isinstance(activation, nn.Tanh):
+            self.activation = 'tanh'
+        # the incremental editor keeps the statistics of a full frame and normalizes regions of it with them
+        self.record_statistics = False
+        self.recorded_statistics = None
+        self.statistics = None
+
+    def normalize(self, x):
+        if self.statistics is not None:
+            mean, rstd = self.statistics
+            scale = rstd if self.weight is None else rstd * self.weight.view(1, -1, 1, 1)
+            shift = -mean * scale if self.bias is None else self.bias.view(1, -1, 1, 1) - mean * scale
+            return torch.addcmul(shift, x, scale)
+        if self.record_statistics:
+            n, c, h, w = x.shape
+            x, mean, rstd = torch.native_group_norm(x, self.weight, self.bias, n, c, h * w, c, self.eps)
+            self.recorded_statistics = (mean.view(n, c, 1, 1), rstd.view(n, c, 1, 1))
+            return x
+        return group_norm(x, self.num_features, self.weight, self.bias, self.eps)
+
+    def forward(self, x):
+        x = self.conv(x)
+        if self.norm:
+            x = self.normalize(x)
+        if self.activation == 'relu':
+            x = torch.relu_(x)
+        elif self.activation == 'leaky_relu':
+            x = leaky_relu_(x, self.negative_slope)
+        elif self.activation == 'sigmoid':
+            x = x.sigmoid_()
+        elif self.activation == 'tanh':
+            x = x.tanh_()
+        return x
+
+
+def is_conv(module):
+    """
+    a plain convolution or a separable one (depthwise then pointwise Sequential)
+    """
+    if isinstance(module, CONV_TYPES):
+        return True
+    return isinstance(module, nn.Sequential) and len(module) > 0 and all(
+        isinstance(item, CONV_TYPES) for item in module)
+
+
+def last_conv(module):
+    return module[-1] if isinstance(module, nn.Sequential) else module
+
+
+def is_foldable_norm(module):
+    return isinstance(module, nn.InstanceNorm2d) and not module.track_running_stats
+
+
+def is_fusable_activation(module):
+    return isinstance(module, (nn.ReLU, nn.LeakyReLU, nn.Sigmoid, nn.Tanh))
+
+
+def strip_training_wrappers(module):
+    """
+    bake spectral norm into plain weights, it recomputes the same weight from weight_orig on every call otherwise
+
+    Returns:
+        count (int): number of layers unwrapped
+    """
+    count = 0
+    for layer in module.modules():
+        for hook in list(layer._forward_pre_hooks.values()):
+            if isinstance(hook, nn.utils.spectral_norm.SpectralNorm):
+                nn.utils.remove_spectral_norm(layer, hook.name)
+                count += 1
+    return count
+
+
+def fuse_sequential(sequential):
+    """
+    Returns:
+        modules (list): the items of sequential with conv, norm and activation runs merged into FusedConvNormAct
+    """
+    items = [item for item in sequential if not isinstance(item, PassThrough)]
+    fused = []
+    i = 0
+    while i < len(items):
+        item = items[i]
+        if not is_conv(item):
+            fused.append(item)
+            i += 1
+            continue
+        conv = item
+        i += 1
+        if i < len(items) and isinstance(items[i], Bias2d) and last_conv(conv).bias is None:
+            # a bias right after the conv is the conv's own bias
+            last_conv(conv).bias = nn.Parameter(items[i].bias.detach().reshape(-1).clone())
+            i += 1
+        norm = None
+        if i < len(items) and is_foldable_norm(items[i]):
+            norm = items[i]
+            if last_conv(conv).bias is not None:
+                # any per channel constant is removed again by the mean subtraction of the norm
+                last_conv(conv).bias = None
+            i += 1
+        activation = None
+        if i < len(items) and is_fusable_activation(items[i]):
+            activation = items[i]
+            i += 1
+        if norm is None and activation is None:
+            fused.append(conv)
+        else:
+            fused.append(FusedConvNormAct(conv, norm, activation))
+    return fused
+
+
+def fuse_model(module):
+    """
+    rewrite module in place for inference: strip training wrappers, then fuse every conv block it contains
+
+    Returns:
+        count (int): number of FusedConvNormAct blocks created
+    """
+    strip_training_wrappers(module)
+    return _fuse(module)
+
+
+def _fuse(module):
+    count = 0
+    for name, child in module.named_children():
+        if isinstance(child, nn.Sequential) and not is_conv(child):
+            fused = fuse_sequential(child)
+            count += sum(isinstance(item, FusedConvNormAct) for item in fused)
+            child = fused[0] if len(fused) == 1 else nn.Sequential(*fused)
+            setattr(module, name, child)
+        count += _fuse(child)
+    return count
+
+
+class OpCounter(TorchDispatchMode):
+    """
+    count the aten ops (kernel launches) and the new output tensors (allocations) of everything run inside it
+
+    peak_bytes is the most memory held at once by those tensors, each released when its Python object goes away.
+    Scratch memory inside a kernel isn't seen, on CUDA torch.cuda.max_memory_allocated covers that.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.ops = 0
+        self.allocations = 0
+        self.live_bytes = 0
+        self.peak_bytes = 0
+
+    def release(self, size):
+        self.live_bytes -= size
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        output = func(*args, **(kwargs or {}))
+        self.ops += 1
+        # outputs aliasing an input are views or in place results, everything else is a new buffer
+        if all(ret.alias_info is None for ret in func._schema.returns):
+            for tensor in tree_leaves(output):
+                if isinstance(tensor, torch.Tensor):
+                    size = tensor.untyped_storage().nbytes()
+                    self.allocations += 1
+                    self.live_bytes += size
+                    self.peak_bytes = max(self.peak_bytes, self.live_bytes)
+                    weakref.finalize(tensor, self.release, size)
+        return output
+
+
+if __name__ == '__main__':
+    import argparse
+    import copy
+    import importlib
+    import time
+
+    from backends import get_module_dtype
+    from benchmark import CREATORS, create_inputs
+
+    parser = argparse.ArgumentParser(description="Compare fused and unfused networks with random weights")
+    parser.add_argument('--modes', type=str, default='standard_float,separable_float')
+    parser.add_argument('--networks', type=str, default=','.join(CREATORS))
+    parser.add_argument('--batch', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=3)
+    fusion_args = parser.parse_args()
+
+    for mode_name in fusion_args.modes.split(','):
+        mode = importlib.import_module('tha3.poser.modes.' + mode_name)
+        for network in fusion_args.networks.split(','):
+            torch.manual_seed(0)
+            module = getattr(mode, CREATORS[network])().eval()
+            fused = copy.deepcopy(module)
+            blocks = fuse_model(fused)
+            inputs = create_inputs(network, fusion_args.batch, get_module_dtype(module), torch.device('cpu'))
+            results = []
+            with torch.no_grad():
+                for candidate in [module, fused]:
+                    with OpCounter() as counter:
+                        outputs = candidate(*inputs)
+                    tic = time.perf_counter()
+                    for i in range(fusion_args.repeat):
+                        candidate(*inputs)
+                    results.append((outputs, counter, (time.perf_counter() - tic) * 1000 / fusion_args.repeat))
+            max_diff = max((a - b).abs().max().item() for a, b in zip(results[0][0], results[1][0]))
+            print("%-16s %-28s %3d blocks  ops %5d -> %5d  allocs %5d -> %5d  %8.2f -> %8.2f ms  max diff %.2e" % (
+                mode_name, network, blocks, results[0][1].ops, results[1][1].ops, results[0][1].allocations,
+                results[1][1].allocations, results[0][2], results[1][2], max_diff))
@@ -0,0 +1,210 @@
+import torch
+from torch.nn.functional import affine_grid, grid_sample, interpolate, max_pool2d
+
+from fusion import FusedConvNormAct
+from tha3.nn.image_processing_util import apply_color_change
+
+EDITOR_TILE = 32
+EDITOR_ALIGN = 16
+DIRTY_TOLERANCE = 1e-3
+
+
+def _align_down(value, align):
+    return value // align * align
+
+
+def _align_up(value, align):
+    return (value + align - 1) // align * align
+
+
+class IncrementalEditor:
+    """
+    run Editor07 only on the part of the frame whose inputs changed since the frame it last rendered
+
+    The editor inputs (character image with the morphed face pasted in, rotator warped image and grid change) are
+    compared with the ones behind the previous output, tile by tile. The U-Net runs on the bounding box of the dirty
+    tiles grown by a halo, aligned to EDITOR_ALIGN so its four downsamplings stay on the full frame grid, and only the
+    dirty tiles of the result are pasted into the previous output.
+
+    The U-Net sees the whole frame through its InstanceNorms and receptive field, so this is an approximation: regions
+    are normalized with the statistics recorded on the last full frame and the halo hides the zero padding at the
+    region border. A full frame resets it whenever the pose vector changes, the batch isn't a single image, or more
+    than `threshold` of the tiles are dirty.
+    """
+
+    def __init__(self, editor, threshold=0.5, halo=64, tile=EDITOR_TILE, tolerance=DIRTY_TOLERANCE):
+        self.editor = editor
+        self.threshold = threshold
+        self.halo = _align_up(halo, EDITOR_ALIGN)
+        self.tile = _align_up(tile, EDITOR_ALIGN)
+        self.tolerance = tolerance
+        self.norms = [module for module in editor.body.modules() if isinstance(module, FusedConvNormAct) and module.norm]
+        self.statistics = None
+        self.previous_inputs = None
+        self.previous_output = None
+        self.base_grid = None
+        self.frames = 0
+        self.full_frames = 0
+        self.skipped_frames = 0
+        self.recomputed_pixels = 0
+        self.total_pixels = 0
+
+    @property
+    def recompute_ratio(self):
+        return self.recomputed_pixels / self.total_pixels if self.total_pixels > 0 else 0.0
+
+    def stats(self):
+        return {
+            'frames': self.frames,
+            'full_frames': self.full_frames,
+            'skipped_frames': self.skipped_frames,
+            'recompute_ratio': self.recompute_ratio,
+        }
+
+    def is_full_frame(self, original_image, pose):
+        if self.previous_output is None or original_image.shape[0] != 1 or len(self.norms) == 0:
+            return True
+        previous_image, _, _, previous_pose = self.previous_inputs
+        return previous_image.shape != original_image.shape or not torch.equal(previous_pose, pose)
+
+    def dirty_tiles(self, inputs):
+        """
+        Returns:
+            dirty (tensor): N x 1 x H/tile x W/tile, True where any input pixel of the tile moved past the tolerance
+        """
+        diff = None
+        for current, previous in zip(inputs[:3], self.previous_inputs[:3]):
+            channel_diff = (current - previous).abs().amax(dim=1, keepdim=True)
+            diff = channel_diff if diff is None else torch.maximum(diff, channel_diff)
+        return max_pool2d(diff.float(), self.tile) > self.tolerance
+
+    def __call__(self, original_image, warped_image, grid_change, pose):
+        """
+        Returns:
+            output_image (tensor): the color changed image, output 0 of Editor07
+        """
+        inputs = (original_image, warped_image, grid_change, pose)
+        n, _, h, w = original_image.shape
+        self.frames += 1
+        self.total_pixels += n * h * w
+        if not self.is_full_frame(original_image, pose):
+            dirty = self.dirty_tiles(inputs)
+            fraction = dirty.float().mean().item()
+            if fraction == 0:
+                self.skipped_frames += 1
+                return self.previous_output
+            if fraction <= self.threshold:
+                return self.render_region(inputs, dirty)
+        return self.render_full(inputs)
+
+    def render_full(self, inputs):
+        for norm in self.norms:
+            norm.record_statistics = True
+        try:
+            output_image = self.editor(*inputs)[0]
+        finally:
+            for norm in self.norms:
+                norm.record_statistics = False
+        self.statistics = [norm.recorded_statistics for norm in self.norms]
+        self.previous_inputs = inputs
+        self.previous_output = output_image
+        self.full_frames += 1
+        self.recomputed_pixels += output_image.shape[0] * output_image.shape[2] * output_image.shape[3]
+        return output_image
+
+    def get_base_grid(self, image):
+        n, c, h, w = image.shape
+        if self.base_grid is None or self.base_grid.shape[1:3] != (h, w) or self.base_grid.dtype != image.dtype or \
+                self.base_grid.device != image.device:
+            identity = torch.tensor([[[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]]], dtype=image.dtype, device=image.device)
+            self.base_grid = affine_grid(identity, [1, c, h, w], align_corners=False)
+        return self.base_grid
+
+    def render_region(self, inputs, dirty):
+        original_image, warped_image, grid_change, pose = inputs
+        n, _, h, w = original_image.shape
+        rows, columns = torch.nonzero(dirty[0, 0], as_tuple=True)
+        rows, columns = rows.tolist(), columns.tolist()
+        y0 = max(_align_down(min(rows) * self.tile - self.halo, EDITOR_ALIGN), 0)
+        y1 = min(_align_up((max(rows) + 1) * self.tile + self.halo, EDITOR_ALIGN), h)
+        x0 = max(_align_down(min(columns) * self.tile - self.halo, EDITOR_ALIGN), 0)
+        x1 = min(_align_up((max(columns) + 1) * self.tile + self.halo, EDITOR_ALIGN), w)
+
+        editor = self.editor
+        if editor.input_buffer is not None:
+            feature = editor.input_buffer.fill([original_image, warped_image, grid_change], pose)
+        else:
+            c = pose.shape[1]
+            feature = torch.cat([original_image, warped_image, grid_change,
+                                 pose.view(n, c, 1, 1).expand(n, c, h, w)], dim=1)
+        for norm, statistics in zip(self.norms, self.statistics):
+            norm.statistics = statistics
+        try:
+            feature = editor.body(feature[:, :, y0:y1, x0:x1])[-1]
+        finally:
+            for norm in self.norms:
+                norm.statistics = None
+        # same as Editor07.forward, but sampling the full frame at the region's positions of the full frame grid
+        region_grid_change = grid_change[:, :, y0:y1, x0:x1] + editor.grid_change_creator(feature)
+        color_change = editor.color_change_creator(feature)
+        color_change_alpha = editor.alpha_creator(feature)
+        grid = self.get_base_grid(original_image)[:, y0:y1, x0:x1] + region_grid_change.permute(0, 2, 3, 1)
+        warped_region = grid_sample(original_image, grid, mode='bilinear', padding_mode='border', align_corners=False)
+        region = apply_color_change(color_change_alpha, color_change, warped_region)
+
+        mask = interpolate(dirty.to(region.dtype), scale_factor=self.tile, mode='nearest')[:, :, y0:y1, x0:x1] > 0
+        output_image = self.previous_output.clone()
+        output_image[:, :, y0:y1, x0:x1] = torch.where(mask, region, output_image[:, :, y0:y1, x0:x1])
+        # only the dirty tiles now correspond to the current inputs, the rest still to the older ones
+        full_mask = interpolate(dirty.to(region.dtype), scale_factor=self.tile, mode='nearest') > 0
+        self.previous_inputs = tuple(torch.where(full_mask, current, previous)
+                                     for current, previous in zip(inputs[:3], self.previous_inputs[:3])) + (pose,)
+        self.previous_output = output_image
+        self.recomputed_pixels += n * (y1 - y0) * (x1 - x0)
+        return output_image
+
+
+if __name__ == '__main__':
+    import argparse
+    import time
+
+    import tha3.poser.modes.standard_float
+    from fusion import fuse_model
+    from utils import psnr
+
+    parser = argparse.ArgumentParser(description="Compare the incremental editor with full frames on random weights")
+    parser.add_argument('--frames', type=int, default=8)
+    parser.add_argument('--threshold', type=float, default=0.5)
+    parser.add_argument('--halo', type=int, default=64)
+    parser.add_argument('--mouth', type=int, default=48, help="side of the square that changes every frame")
+    incremental_args = parser.parse_args()
+
+    torch.manual_seed(0)
+    editor = tha3.poser.modes.standard_float.create_editor().eval()
+    fuse_model(editor)
+    incremental = IncrementalEditor(editor, incremental_args.threshold, incremental_args.halo)
+    image = torch.rand(1, 4, 512, 512) * 2 - 1
+    warped_image = torch.rand(1, 4, 512, 512) * 2 - 1
+    grid_change = torch.zeros(1, 2, 512, 512)
+    pose = torch.rand(1, 6)
+    full_times, incremental_times, scores = [], [], []
+    with torch.no_grad():
+        for i in range(incremental_args.frames):
+            # only a mouth sized patch in the face box changes, like a face-only expression change
+            image = image.clone()
+            warped_image = warped_image.clone()
+            size = incremental_args.mouth
+            image[:, :, 160:160 + size, 232:232 + size] = torch.rand(1, 4, size, size) * 2 - 1
+            warped_image[:, :, 160:160 + size, 232:232 + size] = image[:, :, 160:160 + size, 232:232 + size]
+            tic = time.perf_counter()
+            full = editor(image, warped_image, grid_change, pose)[0]
+            full_times.append(time.perf_counter() - tic)
+            tic = time.perf_counter()
+            output = incremental(image, warped_image, grid_change, pose)
+            incremental_times.append(time.perf_counter() - tic)
+            if i > 0:
+                scores.append(psnr(full, output))
+    print("full %.1f ms, incremental %.1f ms per frame after the first" % (
+        sum(full_times[1:]) * 1000 / (len(full_times) - 1), sum(incremental_times[1:]) * 1000 / (len(full_times) - 1)))
+    print("PSNR vs full frame: mean %.2f dB, min %.2f dB" % (sum(scores) / len(scores), min(scores)))
+    print(incremental.stats())
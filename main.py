@@ -9,10 +9,26 @@ from PIL import Image
 import spout
 
 import tha2.poser.modes.mode_20_wx
-from models import TalkingAnimeLight, TalkingAnime3
+from models import TalkingAnimeLight, TalkingAnime3, CACHE_STAGES
+from quantize import is_quantized_model
+from face_cache import FACE_CACHE_STATS
+from frame_cache import FrameCache
+from frame_store import FrameStore, get_frame_store_file
+from warmup import PoseHistogram, HitRateMeter, WarmupPlanner
 from pose import get_pose
-from utils import preprocessing_image, postprocessing_image
-
+from utils import postprocessing_image, postprocess_model_output, EMASmoother, PoseSmoother, \
+    convert_webcam_pose
+from character_cache import get_character_file, get_model_dtype, load_evtchar
+from shared_frame import SharedFrameRing
+from frame_output import AsyncFrameOutput
+from stage_pipeline import StagePipeline
+from frame_pacer import FramePacer
+from pose_mailbox import PoseMailbox
+from pose_log import PoseLogWriter, PoseLogPlayer
+import profiler
+from profiler import SpanProfiler
+
+import atexit
 import errno
 import json
 import os
@@ -22,8 +38,7 @@ import time
 import math
 from pynput.mouse import Button, Controller
 import re
-from collections import OrderedDict
-from multiprocessing import Value, Process, Queue
+from multiprocessing import Value, Array, Process, Queue
 
 from pyanime4k import ac
 
@@ -31,39 +46,27 @@ from tha2.mocap.ifacialmocap_constants import *
 
 from args import args
 
-from simplify import simplify
+from simplify import simplify, simplify_view
 
-from tha3.util import torch_linear_to_srgb, resize_PIL_image, extract_PIL_image_from_filelike, \
-    extract_pytorch_image_from_PIL_image
+from tha3.util import resize_PIL_image, extract_PIL_image_from_filelike, extract_pytorch_image_from_PIL_image
 
 import collections
 
-class EMASmoother:
-    def __init__(self, rate=0.5, dimension=45, precision=8, threshold=0.0, tag=""):
-        self.rate = rate
-        self.dimension = dimension
-        self.precision = precision
-        self.threshold = threshold * threshold
-        self.tag = tag
-        self.initial = False
-        self.value = np.zeros(dimension)
-
-    def forward(self, value):
-        npvalue = np.asarray(value)
-        if self.initial:
-            offset = np.square(self.value - npvalue).sum()
-            # print(self.tag, offset)
-            if offset > self.threshold:
-                self.value = self.value * (1 - self.rate) + npvalue * self.rate
-        else:
-            self.value = npvalue
-            self.initial = True
-        self.value = self.value.round(self.precision)
-        return self.value
+class CPUUsage:
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.wall_time = time.perf_counter()
+        self.cpu_time = time.process_time()
+        self.value = 0.0
 
-def convert_linear_to_srgb(image: torch.Tensor) -> torch.Tensor:
-    rgb_image = torch_linear_to_srgb(image[0:3, :, :])
-    return torch.cat([rgb_image, image[3:4, :, :]], dim=0)
+    def __call__(self):
+        wall_time = time.perf_counter()
+        if wall_time - self.wall_time >= self.interval:
+            cpu_time = time.process_time()
+            self.value = (cpu_time - self.cpu_time) / (wall_time - self.wall_time) * 100
+            self.wall_time = wall_time
+            self.cpu_time = cpu_time
+        return self.value
 
 
 class FPS:
@@ -78,7 +81,44 @@ class FPS:
             return 0.0
 
 
-device = torch.device('cuda') if torch.cuda.is_available() and not args.skip_model else torch.device('cpu')
+def get_approximations():
+    """
+    Returns:
+        approximations (list): names of the enabled options whose frames depend on more than the pose
+    """
+    approximations = []
+    if args.incremental_editor:
+        approximations.append('incremental')
+    if args.rotator_grid_cache:
+        approximations.append('rotator_grid')
+    return approximations
+
+
+# covers loading the model before the first frame
+REPLAY_RENDER_TIMEOUT = 120.0
+
+
+class LoopClock:
+    """
+    sleep to deadlines 1 / fps apart, after a stall it starts again from now instead of running the missed ticks
+    """
+
+    def __init__(self, fps):
+        self.interval = 1.0 / fps
+        self.deadline = time.perf_counter()
+
+    def tick(self):
+        self.deadline += self.interval
+        now = time.perf_counter()
+        if self.deadline > now:
+            time.sleep(self.deadline - now)
+        elif now - self.deadline > self.interval:
+            self.deadline = now
+
+
+# int8 models only have CPU kernels
+device = torch.device('cuda') if torch.cuda.is_available() and not args.skip_model and \
+                                 not is_quantized_model(args.model) else torch.device('cpu')
 
 
 def create_default_blender_data():
@@ -343,129 +383,161 @@ class MouseClientProcess(Process):
 
 
 class ModelClientProcess(Process):
-    def __init__(self, input_image):
+    def __init__(self, character_file, span_profiler=None):
         super().__init__()
+        self.profiler = span_profiler
         self.should_terminate = Value('b', False)
         self.updated = Value('b', False)
         self.data = None
-        self.input_image = input_image
-        self.output_queue = Queue()
-        self.input_queue = Queue()
+        self.character_file = character_file
+        input_image, _ = load_evtchar(character_file)
+        _, c, h, w = input_image.shape
+        self.output_ring = SharedFrameRing((h, w, c))
+        self.pose_mailbox = PoseMailbox(45)
         self.gpu_fps_number = Value('f', 0.0)
+        self.cpu_usage = Value('f', 0.0)
         self.cache_hit_ratio = Value('f', 0.0)
         self.gpu_cache_hit_ratio = Value('f', 0.0)
+        self.editor_recompute_ratio = Value('f', 1.0)
+        self.gpu_cache_stats = Array('q', len(CACHE_STAGES) * len(FACE_CACHE_STATS), lock=False)
+        self.disk_cache_hit_ratio = Value('f', 0.0)
+        self.warmup_rendered = Value('q', 0)
 
     def run(self):
+        if self.profiler is not None:
+            self.profiler.bind('model')
         model = None
         if not args.skip_model:
             model = TalkingAnime3().to(device)
             model = model.eval()
-            model = model
+            model = model.apply_backend()
             print("Pretrained Model Loaded")
 
-        if args.model.endswith('half'):
-            dtype = torch.half
-        elif args.model.endswith('bf16'):
-            dtype = torch.bfloat16
-        else:
-            dtype = torch.float
-
-        eyebrow_vector = torch.empty(1, 12, dtype=dtype)
-        mouth_eye_vector = torch.empty(1, 27, dtype=dtype)
-        pose_vector = torch.empty(1, 6, dtype=dtype)
-
-        input_image = self.input_image.to(device)
-        eyebrow_vector = eyebrow_vector.to(device)
-        mouth_eye_vector = mouth_eye_vector.to(device)
-        pose_vector = pose_vector.to(device)
+        dtype = get_model_dtype(args.model)
+
+        input_image, _ = load_evtchar(self.character_file)
+        input_image = input_image.to(device)
+        session = None
+        if model is not None:
+            session = model.create_session(input_image)
+
+        frame_store = None
+        if model is not None and args.disk_cache_bytes > 0:
+            frame_store = FrameStore(
+                get_frame_store_file(self.character_file, args.model, args.simplify, args.eyebrow,
+                                     get_approximations()),
+                self.output_ring.shape, len(simplify_view) * 4, args.disk_cache_bytes)
+            frame_store.prewarm(args.disk_cache_prewarm_bytes)
+            print("Disk Cache Loaded: %d frames" % len(frame_store))
+        # every frame goes through frame_output so the ring gets them in order, it is the ring's only writer
+        frame_output = AsyncFrameOutput(self.output_ring.write, device, keep_frames=frame_store is not None)
+        hit_rate = HitRateMeter()
+        planner = None
+        if args.warmup:
+            if frame_store is None:
+                raise RuntimeError("--warmup renders into the disk cache, pass --disk_cache as well")
+            histogram = PoseHistogram(frame_store.file_name + '.hist', frame_store.key_size)
+            planner = WarmupPlanner(histogram, frame_store, model.pose_key_packer)
 
         gpu_fps = FPS()
+        cpu_usage = CPUUsage()
+        pose_seq = 0
         while True:
-            model_input = None
-            try:
-                while not self.input_queue.empty():
-                    model_input = self.input_queue.get_nowait()
-            except queue.Empty:
+            # with warm-up work queued only peek at the mailbox, planning and rendering happen while no live pose waits
+            warmup_queued = planner is not None and len(planner.queue) > 0
+            pose_seq, model_input, pose_time = self.pose_mailbox.get(pose_seq, timeout=0 if warmup_queued else 0.1)
+            self.drain_output(frame_output, frame_store)
+            if args.debug:
+                self.cpu_usage.value = cpu_usage()
+            if model_input is None:
+                if planner is not None and planner.pending():
+                    self.warm_up(model, session, dtype, planner, frame_store, pose_seq)
                 continue
-            if model_input is None: continue
 
-            eyebrow_vector_c = [0.0] * 12
-            mouth_eye_vector_c = [0.0] * 27
+            if model is not None:
+                pose_key = model.pose_key(model_input)
+            if frame_store is not None:
+                stored_image = frame_store.get(pose_key)
+                self.disk_cache_hit_ratio.value = frame_store.hits / (frame_store.hits + frame_store.misses)
+                if hit_rate.update(stored_image is not None) and planner is not None:
+                    print("Disk cache hit rate %.1f%% over the last %.0fs, %d poses warmed up" % (
+                        hit_rate.last * 100, hit_rate.window, self.warmup_rendered.value))
+                if planner is not None:
+                    planner.histogram.add(pose_key)
+                    planner.histogram.save()
+                if stored_image is not None:
+                    frame_output.submit_frame(stored_image, pose_time)
+                    if args.debug:
+                        self.gpu_fps_number.value = gpu_fps()
+                    continue
 
-            if args.perf == 'model':
-                tic = time.perf_counter()
-            if args.eyebrow:
-                for i in range(12):
-                    eyebrow_vector[0, i] = model_input[i]
-                    eyebrow_vector_c[i] = model_input[i]
-            for i in range(27):
-                mouth_eye_vector[0, i] = model_input[i + 12]
-                mouth_eye_vector_c[i] = model_input[i + 12]
-            for i in range(6):
-                pose_vector[0, i] = model_input[i + 27 + 12]
             if model is None:
                 output_image = input_image
             else:
-                output_image = model(input_image, mouth_eye_vector, pose_vector, eyebrow_vector, mouth_eye_vector_c,
-                                     eyebrow_vector_c,
+                pose = torch.from_numpy(model_input).to(device, dtype).unsqueeze(0)
+                output_image = model(session, pose[:, 12:39], pose[:, 39:45], pose[:, :12], pose_key,
                                      self.gpu_cache_hit_ratio)
-            if args.perf == 'model':
-                torch.cuda.synchronize()
-                print("model", (time.perf_counter() - tic) * 1000)
-                tic = time.perf_counter()
-            postprocessed_image = output_image[0].float().detach().cpu()
-            if args.perf == 'model':
-                print("cpu()", (time.perf_counter() - tic) * 1000)
-                tic = time.perf_counter()
-            postprocessed_image = convert_linear_to_srgb((postprocessed_image + 1.0) / 2.0)
-            c, h, w = postprocessed_image.shape
-            postprocessed_image = 255.0 * torch.transpose(postprocessed_image.reshape(c, h * w), 0, 1).reshape(h, w,
-                                                                                                               c)
-            postprocessed_image = postprocessed_image.byte().numpy()
-            if args.perf == 'model':
-                print("postprocess", (time.perf_counter() - tic) * 1000)
-                tic = time.perf_counter()
-
-            self.output_queue.put_nowait(postprocessed_image)
+                self.editor_recompute_ratio.value = model.editor_recompute_ratio()
+                for i, stage in enumerate(CACHE_STAGES):
+                    stats = model.cache_stats().get(stage)
+                    if stats is not None:
+                        self.gpu_cache_stats[i * len(FACE_CACHE_STATS):(i + 1) * len(FACE_CACHE_STATS)] = \
+                            [stats[name] for name in FACE_CACHE_STATS]
+            # postprocessed where it was rendered and copied back while the next pose renders
+            frame_output.submit(output_image[0], pose_time, pose_key if frame_store is not None else None)
             if args.debug:
                 self.gpu_fps_number.value = gpu_fps()
 
+    def drain_output(self, frame_output, frame_store):
+        """
+        store the frames frame_output finished on its worker and record its spans, neither is thread safe
+        """
+        for key, frame, stage, start, end in frame_output.completed():
+            if frame is not None:
+                frame_store.put(key, frame)
+            if args.perf and stage is not None:
+                profiler.record_span(stage, start, end)
+
+    @torch.no_grad()
+    def warm_up(self, model, session, dtype, planner, frame_store, pose_seq):
+        """
+        render up to warmup_batch planned lattice poses into the frame store, one at a time, and give up the rest as
+        soon as a live pose arrives
+        Args:
+            pose_seq (int): mailbox sequence number of the last live pose
+        """
+        keys, poses = planner.next_batch(args.warmup_batch)
+        for i, key in enumerate(keys):
+            if self.pose_mailbox.seq.value != pose_seq:
+                planner.requeue(keys[i:])
+                break
+            output_image = model.forward_poses(session, torch.from_numpy(poses[i:i + 1]).to(device, dtype))
+            frame_store.put(key, postprocess_model_output(output_image)[0])
+            self.warmup_rendered.value += 1
+        planner.histogram.save()
+
 
 @torch.no_grad()
 def main():
-    img = Image.open(f"data/images/{args.character}.png")
-    img = img.convert('RGBA')
     IMG_WIDTH = 512
-    wRatio = img.size[0] / IMG_WIDTH
-    img = img.resize((IMG_WIDTH, int(img.size[1] / wRatio)))
-    for i, px in enumerate(img.getdata()):
-        if px[3] <= 0:
-            y = i // IMG_WIDTH
-            x = i % IMG_WIDTH
-            img.putpixel((x, y), (0, 0, 0, 0))
-    input_image = preprocessing_image(img.crop((0, 0, IMG_WIDTH, IMG_WIDTH)))
-    if args.model.endswith('half'):
-        input_image = torch.from_numpy(input_image).half() * 2.0 - 1
-    elif args.model.endswith('bf16'):
-        input_image = torch.from_numpy(input_image).bfloat16() * 2.0 - 1
-    else:
-        input_image = torch.from_numpy(input_image).float() * 2.0 - 1
-    input_image = input_image.unsqueeze(0)
-    extra_image = None
-    if img.size[1] > IMG_WIDTH:
-        extra_image = np.array(img.crop((0, IMG_WIDTH, img.size[0], img.size[1])))
+    character_file = get_character_file(f"data/images/{args.character}.png", args.model, IMG_WIDTH)
+    _, extra_image = load_evtchar(character_file)
 
     print("Character Image Loaded:", args.character)
     cap = None
 
     output_fps = FPS()
-    model_cache = OrderedDict()
-    model_cache_hit = 0
-    model_cache_total = 0
+    cpu_usage = CPUUsage()
+    pose_latency = 0.0
+    model_cache = FrameCache(args.cache_bytes, args.cache_codec)
 
     if not args.debug_input:
 
-        if args.ifm is not None:
+        if args.replay is not None:
+            pose_player = PoseLogPlayer(args.replay, args.replay_speed)
+            print("Replaying Pose Log:", args.replay)
+
+        elif args.ifm is not None:
             client_process = IFMClientProcess()
             client_process.daemon = True
             client_process.start()
@@ -506,18 +578,13 @@ def main():
         if args.alpha_split:
             cam_width_scale = 2
         cam = pyvirtualcam.Camera(width=args.output_w * cam_scale * cam_width_scale, height=args.output_h * cam_scale,
-                                  fps=60,
+                                  fps=args.output_fps or 60,
                                   backend=args.output_webcam,
                                   fmt=
                                   {'unitycapture': pyvirtualcam.PixelFormat.RGBA, 'obs': pyvirtualcam.PixelFormat.RGB}[
                                       args.output_webcam])
         print(f'Using virtual camera: {cam.device}')
 
-    if args.output_spout:
-        spout_instance = spout.Spout(use_opengl=True)
-        spout_instance.set_sender_name("EasyVtuber Sender")
-        print(f'Using Spout: {spout_instance.get_spout_version()}')
-
     a = None
 
     if args.anime4k:
@@ -539,6 +606,97 @@ def main():
         a.set_arguments(parameters)
         print("Anime4K Loaded")
 
+    def warp_frame(frame, context):
+        if extra_image is not None:
+            frame = cv2.vconcat([frame, extra_image])
+        position_vector = context['position_vector']
+        k_scale = 1
+        rotate_angle = 0
+        dx = 0
+        dy = 0
+        if args.extend_movement:
+            k_scale = position_vector[2] * math.sqrt(args.extend_movement) + 1
+            rotate_angle = -position_vector[0] * 10 * args.extend_movement
+            dx = position_vector[0] * 400 * k_scale * args.extend_movement
+            dy = -position_vector[1] * 600 * k_scale * args.extend_movement
+        if args.bongo:
+            rotate_angle -= 5
+        rm = cv2.getRotationMatrix2D((IMG_WIDTH / 2, IMG_WIDTH / 2), rotate_angle, k_scale)
+        rm[0, 2] += dx + args.output_w / 2 - IMG_WIDTH / 2
+        rm[1, 2] += dy + args.output_h / 2 - IMG_WIDTH / 2
+        return cv2.warpAffine(frame, rm, (args.output_w, args.output_h))
+
+    def upscale_frame(frame, context):
+        alpha_channel = frame[:, :, 3]
+        alpha_channel = cv2.resize(alpha_channel, None, fx=2, fy=2)
+
+        # a.load_image_from_numpy(cv2.cvtColor(postprocessed_image, cv2.COLOR_RGBA2RGB), input_type=ac.AC_INPUT_RGB)
+        # img = cv2.imread("character/test41.png")
+        img1 = cv2.cvtColor(frame, cv2.COLOR_RGBA2BGR)
+        # a.load_image_from_numpy(img, input_type=ac.AC_INPUT_BGR)
+        a.load_image_from_numpy(img1, input_type=ac.AC_INPUT_BGR)
+        a.process()
+        frame = a.save_image_to_numpy()
+        frame = cv2.merge((frame, alpha_channel))
+        return cv2.cvtColor(frame, cv2.COLOR_BGRA2RGBA)
+
+    def split_alpha(frame, context):
+        alpha_image = cv2.merge([frame[:, :, 3], frame[:, :, 3], frame[:, :, 3]])
+        alpha_image = cv2.cvtColor(alpha_image, cv2.COLOR_RGB2RGBA)
+        return cv2.hconcat([frame, alpha_image])
+
+    outputs = {}
+    frame_pacer = None
+
+    def send_frame(frame, context):
+        if args.output_webcam:
+            # result_image = np.zeros([720, 1280, 3], dtype=np.uint8)
+            # result_image[720 - 512:, 1280 // 2 - 256:1280 // 2 + 256] = cv2.resize(
+            #     cv2.cvtColor(postprocessing_image(output_image.cpu()), cv2.COLOR_RGBA2RGB), (512, 512))
+            result_image = frame
+            if args.output_webcam == 'obs':
+                result_image = cv2.cvtColor(result_image, cv2.COLOR_RGBA2RGB)
+            cam.send(result_image)
+            if frame_pacer is None:
+                cam.sleep_until_next_frame()
+        if args.output_spout:
+            if 'spout' not in outputs:
+                # the OpenGL context of the sender belongs to the thread that created it
+                spout_instance = spout.Spout(use_opengl=True)
+                spout_instance.set_sender_name("EasyVtuber Sender")
+                print(f'Using Spout: {spout_instance.get_spout_version()}')
+                outputs['spout'] = spout_instance
+            result_image = frame
+            # width = result_image.shape[1]
+            # height = result_image.shape[0]
+            # data = result_image.tobytes()
+
+            # spout_instance.send_image(data, width, height, 0x1908, False)
+            outputs['spout'].send_image_ndarray(result_image, 0x1908, False)
+            if frame_pacer is None:
+                outputs['spout'].hold_fps(60)
+        return frame
+
+    def pace_frame(frame, context):
+        frame_pacer.push(frame, context['seq'], context['pose_time'])
+        return frame
+
+    # model frames go through the output stages on their own threads, the newest frame wins when a stage falls behind
+    render_pipeline = StagePipeline()
+    render_pipeline.add_stage('warp_affine', warp_frame, args.pipeline_workers, args.pipeline_depth, drop_oldest=True)
+    if args.anime4k:
+        render_pipeline.add_stage('anime4k', upscale_frame, 1, args.pipeline_depth)
+    if args.alpha_split:
+        render_pipeline.add_stage('alpha_split', split_alpha, args.pipeline_workers, args.pipeline_depth)
+    if (args.output_webcam or args.output_spout) and args.output_fps > 0:
+        # the sinks tick at output_fps on the pacer's thread, however fast the model goes
+        frame_pacer = FramePacer(lambda frame: send_frame(frame, None), args.output_fps, args.interpolation)
+        render_pipeline.add_stage('pace', pace_frame, 1, args.pipeline_depth, drop_oldest=True)
+    elif args.output_webcam or args.output_spout:
+        render_pipeline.add_stage('send', send_frame, 1, args.pipeline_depth, drop_oldest=True)
+    render_pipeline.start()
+    postprocessed_image = None
+
     position_vector = [0, 0, 0, 1]
     position_vector_0 = None
     pose_vector_0 = None
@@ -558,25 +716,48 @@ def main():
         'z_angle': 0,
     }
 
+    span_profiler = None
+    if args.perf:
+        span_profiler = SpanProfiler(keep_trace=args.perf_trace is not None)
+        span_profiler.bind('main')
+        if args.perf_trace is not None:
+            atexit.register(span_profiler.export_chrome_trace, args.perf_trace)
+
     model_output = None
-    model_process = ModelClientProcess(input_image)
+    model_process = ModelClientProcess(character_file, span_profiler)
     model_process.daemon = True
     model_process.start()
+    atexit.register(model_process.output_ring.unlink)
 
     print("Ready. Close this console to exit.")
 
-    eyebrow_smoother = EMASmoother(0.4, 12, 8, 0.1, "eyebrow")
-    eye_mouth_smoother = EMASmoother(0.9, 27, 8, 5e-2, "eyemouth")
-    pose_smoother = EMASmoother(0.2, 6, 8, 4e-2, "pose")
+    pose_smoother = PoseSmoother()
     position_smoother = EMASmoother(0.25, 4, 12, 4e-4, "position")
 
+    pose_recorder = None
+    if args.record is not None:
+        pose_recorder = PoseLogWriter(args.record, args.record_raw)
+        atexit.register(pose_recorder.close)
+        print("Recording Pose Log:", args.record)
+    replay_frames = 0
+    # the sends don't pace the loop any more, it runs at the output rate so the smoothers see the same rate as before.
+    # Replays poll the player at that rate too, or render pose by pose at --replay_speed 0.
+    loop_clock = LoopClock(args.output_fps or 60) if args.replay is None or args.replay_speed > 0 else None
+    submitted_seq = 0
+    shown_seq = 0
+    submitted_position = None
+
     while True:
+        if loop_clock is not None:
+            loop_clock.tick()
+        # trackers feeding a queue only have a new sample when something arrived since the last pass
+        new_sample = True
         # ret, frame = cap.read()
         # input_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
         # results = facemesh.process(input_frame)
 
-        if args.perf == 'main':
-            tic = time.perf_counter()
+        if args.perf:
+            tic = time.perf_counter_ns()
         if args.debug_input:
             eyebrow_vector_c = [0.0] * 12
             mouth_eye_vector_c = [0.0] * 27
@@ -597,11 +778,41 @@ def main():
             eyebrow_vector_c[6]=math.sin(time.perf_counter() * 1.1)
             eyebrow_vector_c[7]=math.sin(time.perf_counter() * 1.1)
 
+        elif args.replay is not None:
+            replay_input, replay_position, new_sample = pose_player.next()
+            if replay_input is None:
+                replay_time = time.perf_counter() - pose_player.start_time
+                print("Replay finished: %d frames in %.2fs, %.1f fps" % (
+                    replay_frames, replay_time, replay_frames / replay_time))
+                if args.cache_bytes > 0:
+                    print("MEMCACHED: %.1f%%" % (model_cache.hit_ratio * 100), model_cache.stats())
+                if args.gpu_cache_bytes > 0:
+                    print("GPUCACHED: %.1f%%" % (model_process.gpu_cache_hit_ratio.value * 100))
+                    for i, stage in enumerate(CACHE_STAGES):
+                        print(" - %s" % stage, dict(zip(FACE_CACHE_STATS, model_process.gpu_cache_stats[
+                            i * len(FACE_CACHE_STATS):(i + 1) * len(FACE_CACHE_STATS)])))
+                if args.incremental_editor:
+                    print("EDITOR RECOMPUTED: %.1f%%" % (model_process.editor_recompute_ratio.value * 100))
+                if args.disk_cache_bytes > 0:
+                    print("DISKCACHED: %.1f%%" % (model_process.disk_cache_hit_ratio.value * 100))
+                for stage, stats in render_pipeline.occupancy().items():
+                    print(" - %s" % stage, stats)
+                if frame_pacer is not None:
+                    print("PACER:", frame_pacer.stats())
+                break
+            replay_frames += new_sample
+            eyebrow_vector_c = list(replay_input[:12])
+            mouth_eye_vector_c = list(replay_input[12:39])
+            pose_vector_c = list(replay_input[39:45])
+            position_vector = replay_position
+
         elif args.osf is not None:
+            new_sample = False
             try:
                 new_blender_data = blender_data
                 while not client_process.should_terminate.value and not client_process.queue.empty():
                     new_blender_data = client_process.queue.get_nowait()
+                new_sample = new_blender_data is not blender_data
                 blender_data = new_blender_data
             except queue.Empty:
                 pass
@@ -657,10 +868,12 @@ def main():
 
         elif args.ifm is not None:
             # get pose from ifm
+            new_sample = False
             try:
                 new_blender_data = blender_data
                 while not client_process.should_terminate.value and not client_process.queue.empty():
                     new_blender_data = client_process.queue.get_nowait()
+                new_sample = new_blender_data is not blender_data
                 blender_data = new_blender_data
             except queue.Empty:
                 pass
@@ -700,10 +913,12 @@ def main():
 
         elif args.mouse_input is not None:
 
+            new_sample = False
             try:
                 new_blender_data = mouse_data
                 while not client_process.queue.empty():
                     new_blender_data = client_process.queue.get_nowait()
+                new_sample = new_blender_data is not mouse_data
                 mouse_data = new_blender_data
             except queue.Empty:
                 pass
@@ -758,40 +973,26 @@ def main():
 
             np_pose = np.average(np.array(pose_queue), axis=0, weights=[0.6, 0.3, 0.1])
 
-            eye_l_h_temp = np_pose[0]
-            eye_r_h_temp = np_pose[1]
-            mouth_ratio = np_pose[2]
-            eye_y_ratio = np_pose[3]
-            eye_x_ratio = np_pose[4]
-            x_angle = np_pose[5]
-            y_angle = np_pose[6]
-            z_angle = np_pose[7]
-
-            eyebrow_vector_c = [0.0] * 12
-            mouth_eye_vector_c = [0.0] * 27
-            pose_vector_c = [0.0] * 6
-
-            mouth_eye_vector_c[2] = eye_l_h_temp
-            mouth_eye_vector_c[3] = eye_r_h_temp
-
-            mouth_eye_vector_c[14] = mouth_ratio * 1.5
-
-            mouth_eye_vector_c[25] = eye_y_ratio
-            mouth_eye_vector_c[26] = eye_x_ratio
-
-            pose_vector_c[0] = (x_angle - 1.5) * 1.6
-            pose_vector_c[1] = y_angle * 2.0  # temp weight
-            pose_vector_c[2] = (z_angle + 1.5) * 2  # temp weight
+            eyebrow_vector_c, mouth_eye_vector_c, pose_vector_c = convert_webcam_pose(np_pose)
 
         pose_vector_c[3] = pose_vector_c[1]
         pose_vector_c[4] = pose_vector_c[2]
 
-        eyebrow_smoothed = eyebrow_smoother.forward(eyebrow_vector_c)
-        mouth_eye_smoothed = eye_mouth_smoother.forward(mouth_eye_vector_c)
-        pose_smoothed = pose_smoother.forward(pose_vector_c)
-        model_input_arr = np.concatenate((eyebrow_smoothed, mouth_eye_smoothed, pose_smoothed), axis=0)
+        if args.perf:
+            tic = profiler.record('input', tic)
+
+        if pose_recorder is not None and new_sample:
+            pose_recorder.write(eyebrow_vector_c + mouth_eye_vector_c + pose_vector_c, position_vector,
+                                blender_data if args.ifm is not None or args.osf is not None else None)
+
+        model_input_arr = pose_smoother.forward(eyebrow_vector_c, mouth_eye_vector_c, pose_vector_c)
+        position_vector = list(position_smoother.forward(position_vector))
+        if args.perf:
+            tic = profiler.record('smoothing', tic)
 
         model_input_arr = simplify(tuple(model_input_arr))
+        if args.perf:
+            tic = profiler.record('simplify', tic)
 
         # model_input_arr = eyebrow_smoother.forward(eyebrow_vector_c)
         # model_input_arr.extend(eye_mouth_smoother.forward(mouth_eye_vector_c))
@@ -799,120 +1000,63 @@ def main():
         # model_input_arr.extend(pose_smoother.forward(pose_vector_c))
         # np.concatenate((model_input_arr, pose_vector_c), axis=0)
 
-        position_vector = list(position_smoother.forward(position_vector))
-
         if args.extend_movement:
-            input_hash_items = np.concatenate((model_input_arr, position_vector), axis=0)
-            input_hash = hash(tuple(input_hash_items))
+            input_hash = np.concatenate((model_input_arr, position_vector), axis=0).tobytes()
         else:
-            input_hash = hash(tuple(model_input_arr))
+            input_hash = model_input_arr.tobytes()
 
         cached = model_cache.get(input_hash)
-        model_cache_total += 1
+        if args.perf:
+            tic = profiler.record('cache_lookup', tic)
 
         if cached is not None:
             postprocessed_image = cached
-            model_cache.move_to_end(input_hash)
-            model_cache_hit += 1
         else:
-            model_process.input_queue.put_nowait(model_input_arr)
-
-            has_model_output = 0
-            try:
-                new_model_output = model_output
-                while not model_process.output_queue.empty():
-                    has_model_output += 1
-                    new_model_output = model_process.output_queue.get_nowait()
-                model_output = new_model_output
-            except queue.Empty:
-                pass
-            if model_output is None:
+            posted = model_process.pose_mailbox.put(model_input_arr)
+            if posted and args.replay is not None and args.replay_speed <= 0:
+                # at full speed every replayed pose has to be rendered, otherwise the run is not reproducible
+                wait_start = time.perf_counter()
+                while (model_process.output_ring.timestamp(model_process.output_ring.latest_seq.value) or 0.0) < \
+                        model_process.pose_mailbox.timestamp.value:
+                    if not model_process.is_alive():
+                        raise RuntimeError("Model process exited during the replay")
+                    if time.perf_counter() - wait_start > REPLAY_RENDER_TIMEOUT:
+                        print("No frame for the replayed pose after %.0fs, going on without it" %
+                              REPLAY_RENDER_TIMEOUT)
+                        break
+                    time.sleep(0.001)
+
+            if model_process.output_ring.latest_seq.value == 0:
                 time.sleep(1)
                 continue
-            # print(has_model_output)
-            # should_output=should_output or has_model_output
-            # if not should_output:
-            #     continue
-
-            postprocessed_image = model_output
-
-            if args.perf == 'main':
-                print('===')
-                print("input", time.perf_counter() - tic)
-                tic = time.perf_counter()
-
-            if extra_image is not None:
-                postprocessed_image = cv2.vconcat([postprocessed_image, extra_image])
-
-            k_scale = 1
-            rotate_angle = 0
-            dx = 0
-            dy = 0
-            if args.extend_movement:
-                k_scale = position_vector[2] * math.sqrt(args.extend_movement) + 1
-                rotate_angle = -position_vector[0] * 10 * args.extend_movement
-                dx = position_vector[0] * 400 * k_scale * args.extend_movement
-                dy = -position_vector[1] * 600 * k_scale * args.extend_movement
-            if args.bongo:
-                rotate_angle -= 5
-            rm = cv2.getRotationMatrix2D((IMG_WIDTH / 2, IMG_WIDTH / 2), rotate_angle, k_scale)
-            rm[0, 2] += dx + args.output_w / 2 - IMG_WIDTH / 2
-            rm[1, 2] += dy + args.output_h / 2 - IMG_WIDTH / 2
-
-            postprocessed_image = cv2.warpAffine(
-                postprocessed_image,
-                rm,
-                (args.output_w, args.output_h))
-
-            if args.perf == 'main':
-                print("extendmovement", (time.perf_counter() - tic) * 1000)
-                tic = time.perf_counter()
-
-            if args.anime4k:
-                alpha_channel = postprocessed_image[:, :, 3]
-                alpha_channel = cv2.resize(alpha_channel, None, fx=2, fy=2)
-
-                # a.load_image_from_numpy(cv2.cvtColor(postprocessed_image, cv2.COLOR_RGBA2RGB), input_type=ac.AC_INPUT_RGB)
-                # img = cv2.imread("character/test41.png")
-                img1 = cv2.cvtColor(postprocessed_image, cv2.COLOR_RGBA2BGR)
-                # a.load_image_from_numpy(img, input_type=ac.AC_INPUT_BGR)
-                a.load_image_from_numpy(img1, input_type=ac.AC_INPUT_BGR)
-                a.process()
-                postprocessed_image = a.save_image_to_numpy()
-                postprocessed_image = cv2.merge((postprocessed_image, alpha_channel))
-                postprocessed_image = cv2.cvtColor(postprocessed_image, cv2.COLOR_BGRA2RGBA)
-                if args.perf == 'main':
-                    print("anime4k", (time.perf_counter() - tic) * 1000)
-                    tic = time.perf_counter()
-            if args.alpha_split:
-                alpha_image = cv2.merge(
-                    [postprocessed_image[:, :, 3], postprocessed_image[:, :, 3], postprocessed_image[:, :, 3]])
-                alpha_image = cv2.cvtColor(alpha_image, cv2.COLOR_RGB2RGBA)
-                postprocessed_image = cv2.hconcat([postprocessed_image, alpha_image])
-
-            if args.max_cache_len > 0:
-                model_cache[input_hash] = postprocessed_image
-                if len(model_cache) > args.max_cache_len:
-                    model_cache.popitem(last=False)
-
-            if args.output_webcam:
-                # result_image = np.zeros([720, 1280, 3], dtype=np.uint8)
-                # result_image[720 - 512:, 1280 // 2 - 256:1280 // 2 + 256] = cv2.resize(
-                #     cv2.cvtColor(postprocessing_image(output_image.cpu()), cv2.COLOR_RGBA2RGB), (512, 512))
-                result_image = postprocessed_image
-                if args.output_webcam == 'obs':
-                    result_image = cv2.cvtColor(result_image, cv2.COLOR_RGBA2RGB)
-                cam.send(result_image)
-                cam.sleep_until_next_frame()
-            if args.output_spout:
-                result_image = postprocessed_image
-                # width = result_image.shape[1]
-                # height = result_image.shape[0]
-                # data = result_image.tobytes()
-
-                # spout_instance.send_image(data, width, height, 0x1908, False)
-                spout_instance.send_image_ndarray(result_image, 0x1908, False)
-                spout_instance.hold_fps(60)
+            # the same frame only goes through the pipeline again to move it to a new position
+            if model_process.output_ring.latest_seq.value != submitted_seq or \
+                    (args.extend_movement and position_vector != submitted_position):
+                # a copy, the ring slot is reused two frames later and the pipeline may still be behind by then
+                model_output_seq, model_output, model_output_time = model_process.output_ring.read_latest()
+                render_pipeline.submit(model_output, {'input_hash': input_hash, 'position_vector': position_vector,
+                                                      'seq': model_output_seq, 'pose_time': model_output_time})
+                submitted_seq = model_output_seq
+                submitted_position = position_vector
+
+                if args.perf:
+                    tic = profiler.record('handoff', tic)
+
+        for item in render_pipeline.completed():
+            model_cache.put(item.context['input_hash'], item.frame)
+            postprocessed_image = item.frame
+            if item.context['seq'] != shown_seq and frame_pacer is None:
+                # pose to pixels: from posting the pose to sending its frame, once per model frame
+                shown_seq = item.context['seq']
+                pose_latency = (item.spans[-1][2] / 1e9 - item.context['pose_time']) * 1000
+            if args.perf:
+                for stage, start, end in item.spans:
+                    profiler.record_span(stage, start, end)
+        if frame_pacer is not None:
+            # the pacer sends frames later on its own clock and measures them when it first does
+            pose_latency = frame_pacer.latency * 1000
+        if postprocessed_image is None:
+            continue
 
         output_fps_number = output_fps()
 
@@ -929,21 +1073,41 @@ def main():
             if args.ifm is not None:
                 cv2.putText(output_frame, str('IFM_FPS:%.1f' % client_process.ifm_fps_number.value), (0, 48),
                             cv2.FONT_HERSHEY_PLAIN, 1, (0, 255, 0), 1)
-            if args.max_cache_len > 0:
-                cv2.putText(output_frame, str('MEMCACHED:%.1f%%' % ((model_cache_hit / model_cache_total) * 100)),
+            if args.cache_bytes > 0:
+                cv2.putText(output_frame, str('MEMCACHED:%.1f%% %.0fMB' % (model_cache.hit_ratio * 100,
+                                                                         model_cache.bytes / 1048576)),
                             (0, 64),
                             cv2.FONT_HERSHEY_PLAIN, 1, (0, 255, 0), 1)
-            if args.max_gpu_cache_len > 0:
+            if args.gpu_cache_bytes > 0:
                 cv2.putText(output_frame, str('GPUCACHED:%.1f%%' % (model_process.gpu_cache_hit_ratio.value * 100)),
                             (0, 80),
                             cv2.FONT_HERSHEY_PLAIN, 1, (0, 255, 0), 1)
+            cv2.putText(output_frame, str('CPU:%.0f%%/%.0f%%' % (cpu_usage(), model_process.cpu_usage.value)),
+                        (0, 96),
+                        cv2.FONT_HERSHEY_PLAIN, 1, (0, 255, 0), 1)
+            cv2.putText(output_frame, str('LATENCY:%.1fms' % pose_latency),
+                        (0, 112),
+                        cv2.FONT_HERSHEY_PLAIN, 1, (0, 255, 0), 1)
+            occupancy = ' '.join(
+                '%s:%d/%d' % (stage, stats['queued'] + stats['busy'], stats['capacity'] + stats['workers'])
+                for stage, stats in render_pipeline.occupancy().items())
+            cv2.putText(output_frame, 'PIPELINE:' + occupancy,
+                        (0, 128),
+                        cv2.FONT_HERSHEY_PLAIN, 1, (0, 255, 0), 1)
+            if frame_pacer is not None:
+                pacer_stats = frame_pacer.stats()
+                cv2.putText(output_frame, 'PACER:%.1ffps JITTER:%.1fms DUP:%d DROP:%d INTERP:%d' % (
+                    pacer_stats['fps'], pacer_stats['jitter_ms'], pacer_stats['duplicated'], pacer_stats['dropped'],
+                    pacer_stats['interpolated']),
+                            (0, 144),
+                            cv2.FONT_HERSHEY_PLAIN, 1, (0, 255, 0), 1)
             cv2.imshow("frame", output_frame)
             # cv2.imshow("camera", debug_image)
             cv2.waitKey(1)
 
-        if args.perf == 'main':
-            print("output", (time.perf_counter() - tic) * 1000)
-            tic = time.perf_counter()
+        if args.perf:
+            profiler.record('debug_output', tic)
+            span_profiler.report()
 
 
 if __name__ == '__main__':
@@ -1,20 +1,33 @@
+import importlib
 import time
 
+import numpy as np
+import torch
 import torch.nn as nn
 
 import tha2.poser.modes.mode_20
-import tha3.poser.modes.standard_float
-import tha3.poser.modes.separable_float
-import tha3.poser.modes.standard_half
-import tha3.poser.modes.separable_half
-import tha3.poser.modes.standard_bfloat16
 from torch.nn.functional import interpolate
 
+import profiler
 from args import args
+from backends import create_backend
+from fusion import fuse_model
+from incremental import IncrementalEditor
+from quantize import QUANTIZED_MODELS, get_int8_cache_file, load_calibration_poses, quantize_model
+from face_cache import TensorCache, PoseKeyPacker
+from simplify import simplify_view
+from tha3.nn.image_processing_util import GridChangeApplier
+from tha3.nn.pose_input_buffer import use_input_buffer
 
 from collections import OrderedDict
 
 
+def sync_record(stage, start, tensor):
+    if tensor.is_cuda:
+        torch.cuda.synchronize(tensor.device)
+    return profiler.record(stage, start)
+
+
 class TalkingAnimeLight(nn.Module):
     def __init__(self):
         super(TalkingAnimeLight, self).__init__()
@@ -27,8 +40,8 @@ class TalkingAnimeLight(nn.Module):
 
     def forward(self, image, mouth_eye_vector, pose_vector, mouth_eye_vector_c, ratio=None):
         x = image.clone()
-        if args.perf == 'model':
-            tic = time.perf_counter()
+        if args.perf:
+            tic = time.perf_counter_ns()
         input_hash = hash(tuple(mouth_eye_vector_c))
         cached = self.face_cache.get(input_hash)
         self.tot += 1
@@ -41,136 +54,276 @@ class TalkingAnimeLight(nn.Module):
             self.hit += 1
             mouth_eye_morp_image = cached
             self.face_cache.move_to_end(input_hash)
-        if args.debug and ratio is not None:
+        if ratio is not None:
             ratio.value = self.hit / self.tot
-        if args.perf == 'model':
-            print(" - face_morpher", (time.perf_counter() - tic) * 1000)
-            tic = time.perf_counter()
+        if args.perf:
+            tic = sync_record('face_morpher', tic, x)
         x[:, :, 32:224, 32:224] = mouth_eye_morp_image
         rotate_image = self.two_algo_face_rotator(x, pose_vector)[:2]
-        if args.perf == 'model':
-            print(" - rotator", (time.perf_counter() - tic) * 1000)
-            tic = time.perf_counter()
+        if args.perf:
+            tic = sync_record('rotator', tic, x)
         output_image = self.combiner(rotate_image[0], rotate_image[1], pose_vector)
-        if args.perf == 'model':
-            print(" - combiner", (time.perf_counter() - tic) * 1000)
-            tic = time.perf_counter()
+        if args.perf:
+            tic = sync_record('editor', tic, x)
         return output_image
 
 
+CACHE_STAGES = ['eyebrow', 'face_morpher', 'rotator', 'editor']
+# share of --gpu_cache/--gpu_cache_host per stage, roughly the size of one entry of each
+CACHE_STAGE_SHARES = {
+    'eyebrow': 1,
+    'face_morpher': 4,
+    'rotator': 2,
+    'editor': 8,
+}
+
+MODEL_MODES = {
+    'standard_float': ('tha3.poser.modes.standard_float', 'pt'),
+    'standard_half': ('tha3.poser.modes.standard_half', 'pt'),
+    'separable_float': ('tha3.poser.modes.separable_float', 'pt'),
+    'separable_half': ('tha3.poser.modes.separable_half', 'pt'),
+    'standard_bf16': ('tha3.poser.modes.standard_bfloat16', 'safetensors'),
+    'standard_int8': ('tha3.poser.modes.standard_float', 'pt'),
+    'separable_int8': ('tha3.poser.modes.separable_float', 'pt'),
+}
+
+
 class TalkingAnime3(nn.Module):
-    def __init__(self):
+    def __init__(self, model=None, pretrained=True):
         super(TalkingAnime3, self).__init__()
-        if args.model == "standard_float":
-            if args.eyebrow:
-                self.eyebrow_decomposer = tha3.poser.modes.standard_float.load_eyebrow_decomposer(
-                    'data/models/standard_float/eyebrow_decomposer.pt')
-                self.eyebrow_morphing_combiner = tha3.poser.modes.standard_float.load_eyebrow_morphing_combiner(
-                    'data/models/standard_float/eyebrow_morphing_combiner.pt')
-            self.face_morpher = tha3.poser.modes.standard_float.load_face_morpher(
-                'data/models/standard_float/face_morpher.pt')
-            self.two_algo_face_body_rotator = tha3.poser.modes.standard_float.load_two_algo_generator(
-                'data/models/standard_float/two_algo_face_body_rotator.pt')
-            self.editor = tha3.poser.modes.standard_float.load_editor('data/models/standard_float/editor.pt')
-        elif args.model == "standard_half":
-            if args.eyebrow:
-                self.eyebrow_decomposer = tha3.poser.modes.standard_half.load_eyebrow_decomposer(
-                    'data/models/standard_half/eyebrow_decomposer.pt')
-                self.eyebrow_morphing_combiner = tha3.poser.modes.standard_half.load_eyebrow_morphing_combiner(
-                    'data/models/standard_half/eyebrow_morphing_combiner.pt')
-
-            self.face_morpher = tha3.poser.modes.standard_half.load_face_morpher(
-                'data/models/standard_half/face_morpher.pt')
-            self.two_algo_face_body_rotator = tha3.poser.modes.standard_half.load_two_algo_generator(
-                'data/models/standard_half/two_algo_face_body_rotator.pt')
-            self.editor = tha3.poser.modes.standard_half.load_editor('data/models/standard_half/editor.pt')
-        elif args.model == "separable_float":
-            if args.eyebrow:
-                self.eyebrow_decomposer = tha3.poser.modes.separable_float.load_eyebrow_decomposer(
-                    'data/models/separable_float/eyebrow_decomposer.pt')
-                self.eyebrow_morphing_combiner = tha3.poser.modes.separable_float.load_eyebrow_morphing_combiner(
-                    'data/models/separable_float/eyebrow_morphing_combiner.pt')
-
-            self.face_morpher = tha3.poser.modes.separable_float.load_face_morpher(
-                'data/models/separable_float/face_morpher.pt')
-            self.two_algo_face_body_rotator = tha3.poser.modes.separable_float.load_two_algo_generator(
-                'data/models/separable_float/two_algo_face_body_rotator.pt')
-            self.editor = tha3.poser.modes.separable_float.load_editor('data/models/separable_float/editor.pt')
-        elif args.model == "separable_half":
-            if args.eyebrow:
-                self.eyebrow_decomposer = tha3.poser.modes.separable_half.load_eyebrow_decomposer(
-                    'data/models/separable_half/eyebrow_decomposer.pt')
-                self.eyebrow_morphing_combiner = tha3.poser.modes.separable_half.load_eyebrow_morphing_combiner(
-                    'data/models/separable_half/eyebrow_morphing_combiner.pt')
-
-            self.face_morpher = tha3.poser.modes.separable_half.load_face_morpher(
-                'data/models/separable_half/face_morpher.pt')
-            self.two_algo_face_body_rotator = tha3.poser.modes.separable_half.load_two_algo_generator(
-                'data/models/separable_half/two_algo_face_body_rotator.pt')
-            self.editor = tha3.poser.modes.separable_half.load_editor('data/models/separable_half/editor.pt')
-        elif args.model == "standard_bf16":
-            if args.eyebrow:
-                self.eyebrow_decomposer = tha3.poser.modes.standard_bfloat16.load_eyebrow_decomposer(
-                    'data/models/standard_bf16/eyebrow_decomposer.safetensors')
-                self.eyebrow_morphing_combiner = tha3.poser.modes.standard_bfloat16.load_eyebrow_morphing_combiner(
-                    'data/models/standard_bf16/eyebrow_morphing_combiner.safetensors')
-
-            self.face_morpher = tha3.poser.modes.standard_bfloat16.load_face_morpher(
-                'data/models/standard_bf16/face_morpher.safetensors')
-            self.two_algo_face_body_rotator = tha3.poser.modes.standard_bfloat16.load_two_algo_generator(
-                'data/models/standard_bf16/two_algo_face_body_rotator.safetensors')
-            self.editor = tha3.poser.modes.standard_bfloat16.load_editor('data/models/standard_bf16/editor.safetensors')
-        else:
-            raise RuntimeError("Invalid model: '%s'" % args.model)
-        self.face_cache = OrderedDict()
-        self.tot = 0
-        self.hit = 0
+        if model is None:
+            model = args.model
+        if model not in MODEL_MODES:
+            raise RuntimeError("Invalid model: '%s'" % model)
+        mode_name, ext = MODEL_MODES[model]
+        mode = importlib.import_module(mode_name)
+        self.model_name = model
+
+        # int8 models quantize the float weights once the character image is known, see create_session
+        weights = QUANTIZED_MODELS.get(model, model)
+        self.quantized = False
+        self.weight_files = []
+
+        def load(name, file_name):
+            if pretrained:
+                self.weight_files.append(f'data/models/{weights}/{file_name}.{ext}')
+                return getattr(mode, 'load_' + name)(self.weight_files[-1])
+            return getattr(mode, 'create_' + name)()
 
-    def forward(self, image, mouth_eye_vector, pose_vector, eyebrow_vector, mouth_eye_vector_c, eyebrow_vector_c,
-                ratio=None):
-        if args.perf == 'model':
-            tic = time.perf_counter()
-        x = image.clone()
         if args.eyebrow:
-            input_hash = hash(tuple(eyebrow_vector_c + mouth_eye_vector_c))
-        else:
-            input_hash = hash(tuple(mouth_eye_vector_c))
-        cached = self.face_cache.get(input_hash)
-        self.tot += 1
-        if cached is None:
-            face_image = x[:, :, 32:32 + 192, (32 + 128):(32 + 192 + 128)].clone()
+            self.eyebrow_decomposer = load('eyebrow_decomposer', 'eyebrow_decomposer')
+            self.eyebrow_morphing_combiner = load('eyebrow_morphing_combiner', 'eyebrow_morphing_combiner')
+        self.face_morpher = load('face_morpher', 'face_morpher')
+        self.two_algo_face_body_rotator = load('two_algo_generator', 'two_algo_face_body_rotator')
+        self.editor = load('editor', 'editor')
+        fuse_model(self)
+        memory_format = torch.channels_last if args.channels_last else torch.contiguous_format
+        use_input_buffer(self.two_algo_face_body_rotator, memory_format)
+        use_input_buffer(self.editor, memory_format)
+        self.incremental_editor = None
+        if args.incremental_editor:
+            self.incremental_editor = IncrementalEditor(self.editor, args.incremental_threshold, args.incremental_halo)
+        self.caches = None
+        self.pose_key_packer = PoseKeyPacker(simplify_view)
+        self.grid_change_applier = GridChangeApplier()
+
+    def pose_key(self, model_input):
+        """
+        Args:
+            model_input (numpy array): 45 simplified model parameters
+
+        Returns:
+            key (bytes): packed pose, eyebrow parameters zeroed when --eyebrow is off since they don't affect the output
+        """
+        if not args.eyebrow:
+            model_input = model_input.copy()
+            model_input[:12] = 0
+        return self.pose_key_packer(model_input)
+
+    def apply_backend(self, backend=None):
+        """
+        swap every network for its counterpart on an inference backend, call after moving the model to its device
+
+        Args:
+            backend (str): one of backends.BACKENDS, defaults to --backend
+        """
+        if backend is None:
+            backend = args.backend
+        if backend != 'eager' and self.model_name in QUANTIZED_MODELS:
+            raise RuntimeError("The int8 model '%s' only runs on the eager backend" % self.model_name)
+        if backend != 'eager' and self.incremental_editor is not None:
+            raise RuntimeError("--incremental_editor only runs on the eager backend")
+        for network in ['eyebrow_decomposer', 'eyebrow_morphing_combiner', 'face_morpher',
+                        'two_algo_face_body_rotator', 'editor']:
+            if hasattr(self, network):
+                setattr(self, network, create_backend(getattr(self, network), network, backend, self.model_name))
+        return self
+
+    def create_caches(self, device):
+        self.caches = {}
+        stages = CACHE_STAGES if args.rotator_grid_cache else [stage for stage in CACHE_STAGES if stage != 'rotator']
+        total = sum(CACHE_STAGE_SHARES[stage] for stage in stages)
+        for stage in stages:
+            share = CACHE_STAGE_SHARES[stage] / total
+            self.caches[stage] = TensorCache(device, int(args.gpu_cache_bytes * share),
+                                             int(args.gpu_cache_host_bytes * share))
+
+    def create_session(self, image):
+        session = CharacterSession(self, image)
+        if self.model_name in QUANTIZED_MODELS and not self.quantized:
+            quantize_model(self, session, load_calibration_poses(args.int8_calibration),
+                           get_int8_cache_file(self.model_name, session, args.int8_calibration, args.eyebrow,
+                                               self.weight_files))
+            self.quantized = True
+            session = CharacterSession(self, image)
+        return session
+
+    def forward(self, session, mouth_eye_vector, pose_vector, eyebrow_vector, pose_key, ratio=None):
+        """
+        render one pose, memoizing every network under the part of the pose it depends on
+        Args:
+            session (CharacterSession): the character from create_session
+            pose_key (bytes): TalkingAnime3.pose_key of the pose, int32 codes laid out as eyebrow, face and rotation
+        """
+        if args.perf:
+            tic = time.perf_counter_ns()
+        if self.caches is None:
+            self.create_caches(session.image.device)
+        face_key = pose_key[:39 * 4]
+        output_image = self.caches['editor'].get(pose_key)
+        if output_image is not None:
+            if ratio is not None:
+                ratio.value = self.caches['face_morpher'].hit_ratio
+            return output_image
+
+        mouth_eye_morp_image = self.caches['face_morpher'].get(face_key)
+        if mouth_eye_morp_image is None:
+            eyebrow_morp_image = None
             if args.eyebrow:
-                eyebrow_morp_image = self.eyebrow_decomposer(x[:, :, 64:192, 64 + 128:192 + 128].clone())
-                eyebrow_morp_image = \
-                self.eyebrow_morphing_combiner(eyebrow_morp_image[3], eyebrow_morp_image[0], eyebrow_vector)[2]
-                face_image[:, :, 32:32 + 128, 32:32 + 128] = eyebrow_morp_image
-            mouth_eye_morp_image = self.face_morpher(face_image, mouth_eye_vector)[0]
-            self.face_cache[input_hash] = mouth_eye_morp_image.detach().to('cpu')
-            if len(self.face_cache) > args.max_gpu_cache_len:
-                self.face_cache.popitem(last=False)
+                eyebrow_key = pose_key[:12 * 4]
+                eyebrow_morp_image = self.caches['eyebrow'].get(eyebrow_key)
+                if eyebrow_morp_image is None:
+                    eyebrow_morp_image = self.morph_eyebrow(session, eyebrow_vector)
+                    self.caches['eyebrow'].put(eyebrow_key, eyebrow_morp_image)
+            mouth_eye_morp_image = self.morph_face(session, eyebrow_vector, mouth_eye_vector, eyebrow_morp_image)
+            self.caches['face_morpher'].put(face_key, mouth_eye_morp_image)
+        if ratio is not None:
+            ratio.value = self.caches['face_morpher'].hit_ratio
+        if args.perf:
+            tic = sync_record('face_morpher', tic, mouth_eye_morp_image)
+        x, x_half = self.compose(session, mouth_eye_morp_image)
+        grid_change = None
+        if 'rotator' in self.caches:
+            rotation_key = pose_key[39 * 4:]
+            grid_change = self.caches['rotator'].get(rotation_key)
+        if grid_change is None:
+            rotate_image = self.two_algo_face_body_rotator(x_half, pose_vector)
+            warped_image, grid_change = rotate_image[1], rotate_image[2]
+            if 'rotator' in self.caches:
+                self.caches['rotator'].put(rotation_key, grid_change)
         else:
-            self.hit += 1
-            mouth_eye_morp_image = cached
-            self.face_cache.move_to_end(input_hash)
-        if args.debug and ratio is not None:
-            ratio.value = self.hit / self.tot
-        if args.perf == 'model':
-            print(" - face_morpher", (time.perf_counter() - tic) * 1000)
-            tic = time.perf_counter()
+            # same warp as the rotator would apply, only the face under it changed
+            warped_image = self.grid_change_applier.apply(grid_change, x_half)
+        if args.perf:
+            tic = sync_record('rotator', tic, x)
+        warped_image = interpolate(warped_image, size=(512, 512), mode='bilinear', align_corners=False)
+        grid_change = interpolate(grid_change, size=(512, 512), mode='bilinear', align_corners=False)
+        if self.incremental_editor is not None:
+            output_image = self.incremental_editor(x, warped_image, grid_change, pose_vector)
+        else:
+            output_image = self.editor(x, warped_image, grid_change, pose_vector)[0]
+        self.caches['editor'].put(pose_key, output_image)
+        if args.perf:
+            tic = sync_record('editor', tic, x)
+        return output_image
+
+    def editor_recompute_ratio(self):
+        return self.incremental_editor.recompute_ratio if self.incremental_editor is not None else 1.0
+
+    def cache_stats(self):
+        if self.caches is None:
+            return {}
+        return {stage: cache.stats() for stage, cache in self.caches.items()}
+
+    def compose(self, session, mouth_eye_morp_image):
+        """
+        Returns:
+            x (tensor): Nx4x512x512 character image with the morphed face pasted in
+            x_half (tensor): Nx4x256x256 rotator input, equal to downsampling x
+        """
+        n = mouth_eye_morp_image.shape[0]
+        x = session.image.expand(n, -1, -1, -1).clone()
         x[:, :, 32:32 + 192, (32 + 128):(32 + 192 + 128)] = mouth_eye_morp_image
-        x_half = interpolate(x, size=(256, 256), mode='bilinear', align_corners=False)
+        # the face box starts and ends on even pixels, so its half-size version only depends on the face pixels
+        x_half = session.image_half.expand(n, -1, -1, -1).clone()
+        x_half[:, :, 16:16 + 96, (16 + 64):(16 + 96 + 64)] = interpolate(
+            mouth_eye_morp_image, size=(96, 96), mode='bilinear', align_corners=False)
+        return x, x_half
+
+    def morph_eyebrow(self, session, eyebrow_vector):
+        n = eyebrow_vector.shape[0]
+        return self.eyebrow_morphing_combiner(session.eyebrow_background.expand(n, -1, -1, -1),
+                                              session.eyebrow_layer.expand(n, -1, -1, -1),
+                                              eyebrow_vector)[2]
+
+    def morph_face(self, session, eyebrow_vector, mouth_eye_vector, eyebrow_morp_image=None):
+        face_image = session.face_image.expand(mouth_eye_vector.shape[0], -1, -1, -1).clone()
+        if args.eyebrow:
+            if eyebrow_morp_image is None:
+                eyebrow_morp_image = self.morph_eyebrow(session, eyebrow_vector)
+            face_image[:, :, 32:32 + 128, 32:32 + 128] = eyebrow_morp_image
+        return self.face_morpher(face_image, mouth_eye_vector)[0]
+
+    def forward_batch(self, session, eyebrow_vector, mouth_eye_vector, pose_vector):
+        """
+        render N poses of one character in a single pass through every network, bypassing the caches
+        Args:
+            session (CharacterSession): the character from create_session
+            eyebrow_vector (tensor): Nx12 eyebrow parameters
+            mouth_eye_vector (tensor): Nx27 face parameters
+            pose_vector (tensor): Nx6 rotation parameters
+
+        Returns:
+            output_image (tensor): Nx4x512x512 rendered images
+        """
+        x, x_half = self.compose(session, self.morph_face(session, eyebrow_vector, mouth_eye_vector))
         rotate_image = self.two_algo_face_body_rotator(x_half, pose_vector)
-        if args.perf == 'model':
-            print(" - rotator", (time.perf_counter() - tic) * 1000)
-            tic = time.perf_counter()
-        output_image = self.editor(x,
-                                   interpolate(rotate_image[1], size=(512, 512), mode='bilinear', align_corners=False),
-                                   interpolate(rotate_image[2], size=(512, 512), mode='bilinear', align_corners=False),
-                                   pose_vector)[0]
-        if args.perf == 'model':
-            print(" - editor", (time.perf_counter() - tic) * 1000)
-            tic = time.perf_counter()
-        return output_image
+        return self.editor(x,
+                           interpolate(rotate_image[1], size=(512, 512), mode='bilinear', align_corners=False),
+                           interpolate(rotate_image[2], size=(512, 512), mode='bilinear', align_corners=False),
+                           pose_vector)[0]
+
+    def forward_poses(self, session, poses):
+        """
+        Args:
+            session (CharacterSession): the character from create_session
+            poses (tensor): Nx45 model inputs laid out as eyebrow, face and rotation parameters
+
+        Returns:
+            output_image (tensor): Nx4x512x512 rendered images
+        """
+        return self.forward_batch(session, poses[:, :12], poses[:, 12:39], poses[:, 39:45])
+
+
+class CharacterSession:
+    """
+    everything TalkingAnime3 derives from the character image alone, computed once when the character is loaded
+
+    Per frame only the pose-dependent networks run: the eyebrow layers, the face crop and the half-size base image
+    the rotator sees are all reused, with no per-frame check that the image is still the same.
+    """
+
+    @torch.no_grad()
+    def __init__(self, model, image):
+        self.image = image
+        self.image_half = interpolate(image, size=(256, 256), mode='bilinear', align_corners=False)
+        self.face_image = image[:, :, 32:32 + 192, (32 + 128):(32 + 192 + 128)].clone()
+        self.eyebrow_background = None
+        self.eyebrow_layer = None
+        if args.eyebrow:
+            eyebrow_decomposer_output = model.eyebrow_decomposer(image[:, :, 64:192, 64 + 128:192 + 128].clone())
+            self.eyebrow_background = eyebrow_decomposer_output[3]
+            self.eyebrow_layer = eyebrow_decomposer_output[0]
 
 
 class TalkingAnime(nn.Module):
@@ -184,3 +337,22 @@ class TalkingAnime(nn.Module):
         rotate_image = self.two_algo_face_rotator(x, pose_vector)[:2]
         output_image = self.combiner(rotate_image[0], rotate_image[1], pose_vector)
         return output_image
+
+
+if __name__ == '__main__':
+    from character_cache import get_model_dtype
+
+    dtype = get_model_dtype(args.model)
+    model = TalkingAnime3(pretrained=False).eval()
+    session = model.create_session(torch.zeros(1, 4, 512, 512, dtype=dtype))
+    rng = np.random.default_rng(0)
+    repeat = 2
+    with torch.no_grad():
+        for batch_size in [1, 2, 4, 8]:
+            poses = torch.from_numpy(rng.uniform(-1, 1, (batch_size, 45))).to(dtype)
+            model.forward_poses(session, poses)
+            tic = time.perf_counter()
+            for i in range(repeat):
+                model.forward_poses(session, poses)
+            elapsed = time.perf_counter() - tic
+            print("%s batch %d: %.2f frames/sec" % (args.model, batch_size, batch_size * repeat / elapsed))
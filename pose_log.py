@@ -0,0 +1,127 @@
+import json
+import struct
+import time
+
+import numpy as np
+
+POSE_LOG_MAGIC = b'EVTPOSE\0'
+POSE_LOG_VERSION = 1
+POSE_LOG_HEADER = struct.Struct('<8sHH')
+POSE_LOG_RECORD = struct.Struct('<d45f4fI')
+POSE_LOG_FLAG_RAW = 1
+POSE_LOG_FLUSH_INTERVAL = 1.0
+
+
+class PoseLogWriter:
+    """
+    append-only binary log of the per-frame pose, taken right before smoothing
+
+    Each record stores the time since the first record, the 45 unsmoothed model parameters (eyebrow, face and
+    rotation, laid out like model_input_arr), the 4 position parameters and optionally the raw tracker data as JSON.
+    The file is flushed every POSE_LOG_FLUSH_INTERVAL seconds, so a session that is killed keeps all but the last
+    second.
+    """
+
+    def __init__(self, file_name, record_raw=False):
+        self.file = open(file_name, 'wb')
+        self.record_raw = record_raw
+        self.start_time = None
+        self.flush_time = time.perf_counter()
+        self.file.write(POSE_LOG_HEADER.pack(POSE_LOG_MAGIC, POSE_LOG_VERSION,
+                                             POSE_LOG_FLAG_RAW if record_raw else 0))
+
+    def write(self, model_input, position_vector, raw_data=None):
+        now = time.perf_counter()
+        if self.start_time is None:
+            self.start_time = now
+        raw_bytes = b''
+        if self.record_raw and raw_data is not None:
+            raw_bytes = json.dumps(raw_data).encode('utf-8')
+        self.file.write(POSE_LOG_RECORD.pack(now - self.start_time, *model_input, *position_vector, len(raw_bytes)))
+        self.file.write(raw_bytes)
+        if now - self.flush_time >= POSE_LOG_FLUSH_INTERVAL:
+            self.file.flush()
+            self.flush_time = now
+
+    def close(self):
+        self.file.close()
+
+
+class PoseLogReader:
+    def __init__(self, file_name):
+        with open(file_name, 'rb') as f:
+            content = f.read()
+        magic, version, self.flags = POSE_LOG_HEADER.unpack_from(content)
+        if magic != POSE_LOG_MAGIC or version != POSE_LOG_VERSION:
+            raise RuntimeError("Invalid pose log: " + file_name)
+        self.timestamps = []
+        self.model_inputs = []
+        self.position_vectors = []
+        self.raw_data = []
+        offset = POSE_LOG_HEADER.size
+        while offset + POSE_LOG_RECORD.size <= len(content):
+            record = POSE_LOG_RECORD.unpack_from(content, offset)
+            offset += POSE_LOG_RECORD.size
+            raw_length = record[50]
+            self.timestamps.append(record[0])
+            self.model_inputs.append(np.array(record[1:46], dtype=np.float64))
+            self.position_vectors.append(list(record[46:50]))
+            self.raw_data.append(json.loads(content[offset:offset + raw_length]) if raw_length > 0 else None)
+            offset += raw_length
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    @property
+    def duration(self):
+        return self.timestamps[-1] if len(self.timestamps) > 0 else 0.0
+
+
+class PoseLogPlayer:
+    """
+    replay a pose log either at the recorded pace (speed 1.0 is realtime) or as fast as possible (speed 0)
+
+    At the recorded pace next() is polled like a live tracker by the clocked main loop: it never waits, returns the
+    newest record that is due and the same one again until the next is due. At speed 0 it returns every record once.
+    """
+
+    def __init__(self, file_name, speed=1.0):
+        self.log = PoseLogReader(file_name)
+        self.speed = speed
+        self.index = 0
+        self.start_time = None
+
+    def next(self):
+        """
+        Returns:
+            model_input (numpy array): 45 unsmoothed model parameters, None at the end of the log
+            position_vector (list): 4 unsmoothed position parameters, None at the end of the log
+            new (bool): True the first time a record is returned
+        """
+        if self.start_time is None:
+            self.start_time = time.perf_counter()
+        index = self.index
+        if self.speed > 0:
+            elapsed = (time.perf_counter() - self.start_time) * self.speed
+            while self.index < len(self.log) and self.log.timestamps[self.index] <= elapsed:
+                self.index += 1
+        elif self.index < len(self.log):
+            self.index += 1
+        if self.index == index and (self.index >= len(self.log) or self.index == 0):
+            return None, None, False
+        model_input = self.log.model_inputs[self.index - 1]
+        position_vector = list(self.log.position_vectors[self.index - 1])
+        return model_input, position_vector, self.index != index
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Print the length and rate of a pose log")
+    parser.add_argument('file', type=str, help="pose log written with --record")
+    pose_log_args = parser.parse_args()
+
+    log = PoseLogReader(pose_log_args.file)
+    print("%d frames, %.1fs, %.1f fps, raw data %s" % (
+        len(log), log.duration, len(log) / log.duration if log.duration > 0 else 0.0,
+        'included' if log.flags & POSE_LOG_FLAG_RAW else 'not included'))
@@ -0,0 +1,66 @@
+import time
+from multiprocessing import Value, Array, Condition
+
+import numpy as np
+
+
+class PoseMailbox:
+    """
+    single-slot shared-memory mailbox that only ever holds the newest pose
+
+    The producer overwrites the slot and notifies, the consumer blocks until the sequence number moves past the one
+    it last rendered. Posting the pose already in the slot is a no-op, so an idle avatar leaves the consumer asleep.
+    """
+
+    def __init__(self, size=45):
+        self.size = size
+        self.pose = Array('d', size, lock=False)
+        self.seq = Value('q', 0, lock=False)
+        self.timestamp = Value('d', 0.0, lock=False)
+        self.condition = Condition()
+        self._view = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_view'] = None
+        return state
+
+    @property
+    def view(self):
+        if self._view is None:
+            self._view = np.frombuffer(self.pose, dtype=np.float64)
+        return self._view
+
+    def put(self, pose):
+        """
+        Args:
+            pose (numpy array): pose vector of length size
+
+        Returns:
+            posted (bool): False if the mailbox already held this pose
+        """
+        with self.condition:
+            if self.seq.value > 0 and np.array_equal(self.view, pose):
+                return False
+            self.view[:] = pose
+            self.timestamp.value = time.perf_counter()
+            self.seq.value += 1
+            self.condition.notify_all()
+        return True
+
+    def get(self, last_seq, timeout=None):
+        """
+        block until a pose newer than last_seq is posted
+        Args:
+            last_seq (int): sequence number of the pose the caller already has, 0 for none
+            timeout (float): seconds to wait, None to wait forever
+
+        Returns:
+            seq (int): sequence number of the returned pose, last_seq on timeout
+            pose (numpy array): copy of the newest pose, None on timeout
+            timestamp (float): time.perf_counter() at which the pose was posted, None on timeout
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.seq.value != last_seq, timeout):
+                return last_seq, None, None
+            return self.seq.value, self.view.copy(), self.timestamp.value
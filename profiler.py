@@ -0,0 +1,176 @@
+import json
+import time
+from multiprocessing import RawArray, RawValue
+
+import numpy as np
+
+STAGES = [
+    'input',
+    'smoothing',
+    'simplify',
+    'cache_lookup',
+    'handoff',
+    'face_morpher',
+    'rotator',
+    'editor',
+    'd2h_copy',
+    'postprocess',
+    'warp_affine',
+    'anime4k',
+    'alpha_split',
+    'send',
+    'debug_output',
+]
+STAGE_INDEX = {name: i for i, name in enumerate(STAGES)}
+
+SPAN_FIELDS = 3
+
+
+class SpanProfiler:
+    """
+    low-overhead span recorder backed by one shared-memory ring per process
+
+    Every process binds to its own region and is the only writer of it, so recording a span is a few array stores
+    with no lock. The reader drains all regions, prints percentile summaries every `interval` seconds and can keep
+    the spans for a Chrome trace (chrome://tracing, Perfetto) export.
+    """
+
+    def __init__(self, processes=('main', 'model'), capacity=65536, interval=5.0, keep_trace=False):
+        self.processes = list(processes)
+        self.capacity = capacity
+        self.interval = interval
+        self.keep_trace = keep_trace
+        self.spans = [RawArray('q', capacity * SPAN_FIELDS) for _ in self.processes]
+        self.written = [RawValue('q', 0) for _ in self.processes]
+        self.region = None
+        self.read = [0] * len(self.processes)
+        self.window = [[] for _ in STAGES]
+        self.trace = []
+        self.report_time = time.perf_counter()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['window'] = [[] for _ in STAGES]
+        state['trace'] = []
+        return state
+
+    def bind(self, process):
+        self.region = self.processes.index(process)
+        global current
+        current = self
+
+    def record(self, stage, start):
+        """
+        Args:
+            stage (str): name from STAGES
+            start (int): time.perf_counter_ns() at the beginning of the span
+
+        Returns:
+            end (int): time.perf_counter_ns() at the end of the span, to chain into the next stage
+        """
+        end = time.perf_counter_ns()
+        self.record_span(stage, start, end)
+        return end
+
+    def record_span(self, stage, start, end):
+        """
+        record a span measured elsewhere, e.g. on a helper thread of this process which mustn't write the region itself
+        """
+        spans = self.spans[self.region]
+        written = self.written[self.region]
+        base = (written.value % self.capacity) * SPAN_FIELDS
+        spans[base] = STAGE_INDEX[stage]
+        spans[base + 1] = start
+        spans[base + 2] = end - start
+        written.value += 1
+
+    def drain(self):
+        for region in range(len(self.processes)):
+            written = self.written[region].value
+            start = max(self.read[region], written - self.capacity)
+            spans = self.spans[region]
+            for i in range(start, written):
+                base = (i % self.capacity) * SPAN_FIELDS
+                stage, span_start, duration = spans[base], spans[base + 1], spans[base + 2]
+                self.window[stage].append(duration)
+                if self.keep_trace:
+                    self.trace.append((region, stage, span_start, duration))
+            self.read[region] = written
+
+    def summary(self):
+        """
+        Returns:
+            summary (dict): stage name -> count, p50, p95, p99 and max in milliseconds for the current window
+        """
+        result = {}
+        for stage, durations in enumerate(self.window):
+            if len(durations) == 0:
+                continue
+            p50, p95, p99 = np.percentile(durations, [50, 95, 99]) / 1e6
+            result[STAGES[stage]] = {
+                'count': len(durations),
+                'p50': p50,
+                'p95': p95,
+                'p99': p99,
+                'max': max(durations) / 1e6,
+            }
+        return result
+
+    def report(self, force=False):
+        now = time.perf_counter()
+        if not force and now - self.report_time < self.interval:
+            return
+        self.drain()
+        summary = self.summary()
+        if len(summary) > 0:
+            print("%-14s %7s %8s %8s %8s %8s" % ('stage', 'count', 'p50', 'p95', 'p99', 'max'))
+            for stage, stats in summary.items():
+                print("%-14s %7d %8.2f %8.2f %8.2f %8.2f" % (
+                    stage, stats['count'], stats['p50'], stats['p95'], stats['p99'], stats['max']))
+        self.window = [[] for _ in STAGES]
+        self.report_time = now
+
+    def export_chrome_trace(self, file_name):
+        self.drain()
+        events = [{
+            'name': STAGES[stage],
+            'ph': 'X',
+            'ts': span_start / 1e3,
+            'dur': duration / 1e3,
+            'pid': region,
+            'tid': 0,
+        } for region, stage, span_start, duration in self.trace]
+        events += [{
+            'name': 'process_name',
+            'ph': 'M',
+            'pid': region,
+            'args': {'name': process},
+        } for region, process in enumerate(self.processes)]
+        with open(file_name, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+current = None
+
+
+def record(stage, start):
+    if current is None:
+        return time.perf_counter_ns()
+    return current.record(stage, start)
+
+
+def record_span(stage, start, end):
+    if current is not None:
+        current.record_span(stage, start, end)
+
+
+if __name__ == '__main__':
+    profiler = SpanProfiler(interval=0)
+    profiler.bind('main')
+    repeat = 100000
+    tic = time.perf_counter()
+    t = time.perf_counter_ns()
+    for i in range(repeat):
+        t = record('input', t)
+    print("record: %.3f us/span" % ((time.perf_counter() - tic) * 1e6 / repeat))
+    profiler.report(force=True)
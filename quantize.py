@@ -0,0 +1,206 @@
+import hashlib
+import os
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.ao.quantization import QConfig, QuantStub, DeQuantStub, HistogramObserver, \
+    default_per_channel_weight_observer, prepare, convert
+
+from args import args
+from character_cache import CACHE_DIR
+from tha3.nn.common.poser_encoder_decoder_00 import PoserEncoderDecoder00
+from tha3.nn.common.resize_conv_encoder_decoder import ResizeConvEncoderDecoder
+from tha3.nn.common.resize_conv_unet import ResizeConvUNet
+
+QUANTIZED_MODELS = {
+    'standard_int8': 'standard_float',
+    'separable_int8': 'separable_float',
+}
+QUANTIZED_BODIES = (ResizeConvUNet, ResizeConvEncoderDecoder, PoserEncoderDecoder00)
+QUANTIZED_NETWORKS = ['eyebrow_decomposer', 'eyebrow_morphing_combiner', 'two_algo_face_body_rotator', 'editor']
+CALIBRATION_POSES = 32
+CALIBRATION_BATCH = 4
+INT8_CACHE_DIR = os.path.join(CACHE_DIR, 'int8')
+
+
+def is_quantized_model(model):
+    return model in QUANTIZED_MODELS
+
+
+def create_qconfig():
+    # reduce_range keeps the x86 int8 kernels from overflowing their 16 bit accumulators
+    return QConfig(activation=HistogramObserver.with_args(reduce_range=True),
+                   weight=default_per_channel_weight_observer)
+
+
+def wrap_convs(module, qconfig):
+    """
+    put every plain Conv2d under module between a quant and a dequant stub, norms and activations stay float
+
+    Returns:
+        count (int): number of wrapped convolutions
+    """
+    count = 0
+    for name, child in module.named_children():
+        if type(child) is nn.Conv2d:
+            wrapped = nn.Sequential(QuantStub(), child, DeQuantStub())
+            wrapped.qconfig = qconfig
+            setattr(module, name, wrapped)
+            count += 1
+        else:
+            count += wrap_convs(child, qconfig)
+    return count
+
+
+def prepare_model(model):
+    """
+    insert observers into the conv-heavy bodies of every network model has
+
+    Returns:
+        count (int): number of convolutions that will run in int8
+    """
+    torch.backends.quantized.engine = 'x86' if 'x86' in torch.backends.quantized.supported_engines else 'qnnpack'
+    qconfig = create_qconfig()
+    count = 0
+    for network in QUANTIZED_NETWORKS:
+        if not hasattr(model, network):
+            continue
+        module = getattr(model, network)
+        for body in [m for m in module.modules() if isinstance(m, QUANTIZED_BODIES)]:
+            count += wrap_convs(body, qconfig)
+        prepare(module, inplace=True)
+    return count
+
+
+def convert_model(model):
+    for network in QUANTIZED_NETWORKS:
+        if hasattr(model, network):
+            convert(getattr(model, network), inplace=True)
+
+
+def load_calibration_poses(file_name=None, count=CALIBRATION_POSES):
+    """
+    Args:
+        file_name (str): pose log written by --record, evenly sampled. Without one, random poses are used.
+        count (int): number of poses
+
+    Returns:
+        poses (numpy array): Nx45 model inputs
+    """
+    if file_name is not None:
+        from pose_log import PoseLogReader
+        model_inputs = PoseLogReader(file_name).model_inputs
+        if len(model_inputs) > 0:
+            indices = np.linspace(0, len(model_inputs) - 1, min(count, len(model_inputs))).astype(int)
+            return np.array([model_inputs[i] for i in indices], dtype=np.float32)
+    rng = np.random.default_rng(0)
+    poses = rng.uniform(-1, 1, (count, 45)).astype(np.float32)
+    poses[:, :39] = np.abs(poses[:, :39])
+    return poses
+
+
+def get_int8_cache_file(model_name, session, calibration_file=None, eyebrow=False, weight_files=()):
+    """
+    Args:
+        eyebrow (bool): whether the model has the eyebrow networks, they are part of the quantized state
+        weight_files (list): float weight files the model was loaded from
+
+    Returns:
+        file name (str): quantized weights and scales of model_name calibrated for the character of session
+    """
+    digest = hashlib.sha1(session.image.detach().cpu().numpy().tobytes())
+    digest.update(b'eyebrow' if eyebrow else b'no_eyebrow')
+    for weight_file in weight_files:
+        digest.update(os.path.abspath(weight_file).encode('utf-8'))
+        digest.update(str(os.path.getmtime(weight_file)).encode('utf-8'))
+    if calibration_file is not None:
+        digest.update(os.path.abspath(calibration_file).encode('utf-8'))
+        digest.update(str(os.path.getmtime(calibration_file)).encode('utf-8'))
+    return os.path.join(INT8_CACHE_DIR, '%s_%s.pt' % (model_name, digest.hexdigest()[:16]))
+
+
+@torch.no_grad()
+def quantize_model(model, session, poses, cache_file=None):
+    """
+    turn the float networks of model into int8 ones, calibrating activation ranges on session's character
+
+    Args:
+        model (TalkingAnime3): float model on the CPU
+        session (CharacterSession): the character to calibrate on
+        poses (numpy array): Nx45 calibration poses
+        cache_file (str): where the calibrated state is kept, calibration is skipped if it already exists
+    """
+    count = prepare_model(model)
+    if cache_file is not None and os.path.exists(cache_file):
+        convert_model(model)
+        model.load_state_dict(torch.load(cache_file))
+        print("Loaded %d int8 convolutions from %s" % (count, cache_file))
+        return
+    print("Calibrating %d int8 convolutions on %d poses ... " % (count, len(poses)), end="")
+    poses = torch.from_numpy(np.asarray(poses, dtype=np.float32)).to(session.image.device)
+    for i in range(0, len(poses), CALIBRATION_BATCH):
+        model.forward_poses(session, poses[i:i + CALIBRATION_BATCH])
+    convert_model(model)
+    print("DONE!!!")
+    if cache_file is not None:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        temp_file_name = cache_file + '.tmp'
+        torch.save(model.state_dict(), temp_file_name)
+        os.replace(temp_file_name, cache_file)
+
+
+if __name__ == '__main__':
+    import copy
+    import time
+
+    from models import TalkingAnime3
+    from utils import ingest_character_image, psnr
+
+    # python quantize.py --model separable_int8 --character y --int8_calibration pose.log
+    # falls back to random weights, image and poses when the float models, character or log aren't there
+    base_model = QUANTIZED_MODELS.get(args.model, 'standard_float')
+    pretrained = os.path.exists(f'data/models/{base_model}')
+    torch.manual_seed(0)
+    float_model = TalkingAnime3(base_model, pretrained=pretrained).eval()
+    character_image = f'data/images/{args.character}.png'
+    if os.path.exists(character_image):
+        from PIL import Image
+        image, _ = ingest_character_image(Image.open(character_image))
+        image = torch.from_numpy(image).float().unsqueeze(0) * 2.0 - 1
+    else:
+        image = torch.rand(1, 4, 512, 512) * 2 - 1
+    poses = load_calibration_poses(args.int8_calibration)
+    calibration_poses, test_poses = poses[::2], torch.from_numpy(poses[1::2])
+
+    int8_model = copy.deepcopy(float_model)
+    float_session = float_model.create_session(image)
+    tic = time.perf_counter()
+    quantize_model(int8_model, float_session, calibration_poses)
+    print("calibration: %.1f s, %s weights" % (time.perf_counter() - tic, 'pretrained' if pretrained else 'random'))
+    int8_session = int8_model.create_session(image)
+
+    with torch.no_grad():
+        scores = [psnr(float_model.forward_poses(float_session, pose[None]),
+                       int8_model.forward_poses(int8_session, pose[None])) for pose in test_poses]
+    print("PSNR vs fp32: mean %.2f dB, min %.2f dB over %d poses" % (np.mean(scores), np.min(scores), len(scores)))
+
+    from benchmark import create_inputs
+    with torch.no_grad():
+        for network in QUANTIZED_NETWORKS + ['poser']:
+            if network != 'poser' and not hasattr(float_model, network):
+                continue
+            timings = []
+            for model, session in [(float_model, float_session), (int8_model, int8_session)]:
+                if network == 'poser':
+                    run = lambda: model.forward_poses(session, test_poses[:1])
+                else:
+                    inputs = create_inputs(network, 1, torch.float, torch.device('cpu'))
+                    run = lambda: getattr(model, network)(*inputs)
+                run()
+                tic = time.perf_counter()
+                for i in range(3):
+                    run()
+                timings.append((time.perf_counter() - tic) * 1000 / 3)
+            print("%-28s fp32 %9.2f ms  int8 %9.2f ms  %5.2fx" % (network, timings[0], timings[1],
+                                                                    timings[0] / timings[1]))
@@ -0,0 +1,242 @@
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import mediapipe as mp
+import numpy as np
+import torch
+
+from args import args
+from character_cache import get_character_file, get_model_dtype, load_evtchar
+from models import TalkingAnime3
+from quantize import is_quantized_model
+from pose import get_pose
+from simplify import simplify
+from utils import PoseSmoother, convert_webcam_pose, postprocess_model_output
+
+IMG_WIDTH = 512
+
+# int8 models only have CPU kernels
+device = torch.device('cuda') if torch.cuda.is_available() and not is_quantized_model(args.model) else \
+    torch.device('cpu')
+
+
+class VideoReader(threading.Thread):
+    def __init__(self, file_name, max_queued=64):
+        super().__init__(daemon=True)
+        self.capture = cv2.VideoCapture(file_name)
+        if not self.capture.isOpened():
+            raise RuntimeError("Can't open input video: " + file_name)
+        self.fps = self.capture.get(cv2.CAP_PROP_FPS) or 30.0
+        self.frame_count = int(self.capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.queue = queue.Queue(max_queued)
+
+    def run(self):
+        while True:
+            ret, frame = self.capture.read()
+            if not ret:
+                break
+            self.queue.put(frame)
+        self.capture.release()
+        self.queue.put(None)
+
+    def __iter__(self):
+        while True:
+            frame = self.queue.get()
+            if frame is None:
+                return
+            yield frame
+
+
+face_mesh = threading.local()
+
+
+def detect_pose(frame):
+    if not hasattr(face_mesh, 'instance'):
+        # frames reach each worker out of order, so landmark tracking between frames would be wrong
+        face_mesh.instance = mp.solutions.face_mesh.FaceMesh(static_image_mode=args.render_workers > 1,
+                                                             refine_landmarks=True)
+    results = face_mesh.instance.process(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+    if results.multi_face_landmarks is None:
+        return None
+    return get_pose(results.multi_face_landmarks[0].landmark)
+
+
+def iterate_poses(frames, workers):
+    with ThreadPoolExecutor(workers) as executor:
+        pending = deque()
+        for frame in frames:
+            pending.append(executor.submit(detect_pose, frame))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while len(pending) > 0:
+            yield pending.popleft().result()
+
+
+def iterate_model_inputs(poses):
+    pose_queue = []
+    pose_smoother = PoseSmoother()
+    model_input_arr = simplify(tuple([0.0] * 45))
+    for pose in poses:
+        if pose is not None:
+            if len(pose_queue) < 3:
+                pose_queue.append(pose)
+                pose_queue.append(pose)
+                pose_queue.append(pose)
+            else:
+                pose_queue.pop(0)
+                pose_queue.append(pose)
+            np_pose = np.average(np.array(pose_queue), axis=0, weights=[0.6, 0.3, 0.1])
+            eyebrow_vector_c, mouth_eye_vector_c, pose_vector_c = convert_webcam_pose(np_pose)
+            pose_vector_c[3] = pose_vector_c[1]
+            pose_vector_c[4] = pose_vector_c[2]
+            model_input_arr = pose_smoother.forward(eyebrow_vector_c, mouth_eye_vector_c, pose_vector_c)
+            model_input_arr = simplify(tuple(model_input_arr))
+        # frames without a detected face keep the previous pose so the output stays in sync with the source
+        yield model_input_arr
+
+
+class FrameWriter(threading.Thread):
+    def __init__(self, output_path, output_format, fps, extra_image, max_queued=16):
+        super().__init__(daemon=True)
+        self.output_path = output_path
+        self.output_format = output_format
+        self.fps = fps
+        self.extra_image = extra_image
+        self.queue = queue.Queue(max_queued)
+        self.video_writer = None
+        self.written = 0
+        self.rm = cv2.getRotationMatrix2D((IMG_WIDTH / 2, IMG_WIDTH / 2), 0, 1)
+        self.rm[0, 2] += args.output_w / 2 - IMG_WIDTH / 2
+        self.rm[1, 2] += args.output_h / 2 - IMG_WIDTH / 2
+
+    def put(self, output_image):
+        self.queue.put(output_image)
+
+    def run(self):
+        while True:
+            output_image = self.queue.get()
+            if output_image is None:
+                break
+            self.write(output_image)
+        if self.video_writer is not None:
+            self.video_writer.release()
+
+    def write(self, postprocessed_image):
+        if self.extra_image is not None:
+            postprocessed_image = cv2.vconcat([postprocessed_image, self.extra_image])
+        postprocessed_image = cv2.warpAffine(postprocessed_image, self.rm, (args.output_w, args.output_h))
+        if self.output_format == 'png':
+            cv2.imwrite(os.path.join(self.output_path, '%06d.png' % self.written),
+                        cv2.cvtColor(postprocessed_image, cv2.COLOR_RGBA2BGRA))
+        else:
+            if self.video_writer is None:
+                self.video_writer = cv2.VideoWriter(self.output_path, cv2.VideoWriter_fourcc(*'mp4v'), self.fps,
+                                                    (args.output_w, args.output_h))
+            self.video_writer.write(cv2.cvtColor(postprocessed_image, cv2.COLOR_RGBA2BGR))
+        self.written += 1
+
+
+class Progress:
+    def __init__(self, total, source_fps, interval=1.0):
+        self.total = total
+        self.source_fps = source_fps
+        self.interval = interval
+        self.start_time = time.perf_counter()
+        self.report_time = self.start_time
+        self.frames = 0
+        self.rendered = 0
+
+    def update(self, frames, rendered):
+        self.frames += frames
+        self.rendered += rendered
+        now = time.perf_counter()
+        if now - self.report_time >= self.interval:
+            self.report_time = now
+            self.report(now)
+
+    def report(self, now, final=False):
+        elapsed = now - self.start_time
+        fps = self.frames / elapsed if elapsed > 0 else 0.0
+        eta = (self.total - self.frames) / fps if fps > 0 and self.total > self.frames else 0.0
+        print("%s %d/%d frames, %d rendered, %.1f fps (%.2fx realtime), eta %.0fs" % (
+            'Done:' if final else 'Rendering:', self.frames, self.total, self.rendered, fps, fps / self.source_fps,
+            eta))
+
+
+@torch.no_grad()
+def render_batch(model, session, dtype, batch, writer, rendered):
+    """
+    render the distinct poses of a batch in one forward pass and queue every frame for the writer
+    Args:
+        batch (list): model input arrays in frame order
+        rendered (dict): outputs of the previous batch keyed by model input, reused and replaced
+
+    Returns:
+        rendered (dict): outputs of this batch keyed by model input
+        count (int): number of poses that went through the model
+    """
+    keys = [tuple(model_input_arr) for model_input_arr in batch]
+    missing = [key for key in dict.fromkeys(keys) if key not in rendered]
+    outputs = {key: rendered[key] for key in keys if key in rendered}
+    if len(missing) > 0:
+        poses = torch.tensor(missing, dtype=dtype, device=device)
+        output_images = postprocess_model_output(model.forward_poses(session, poses))
+        for key, output_image in zip(missing, output_images):
+            outputs[key] = output_image
+    for key in keys:
+        writer.put(outputs[key])
+    return outputs, len(missing)
+
+
+def main():
+    if args.input == 'cam':
+        raise RuntimeError("Offline rendering needs a video file passed with --input")
+    if args.render_format not in ['png', 'mp4']:
+        raise RuntimeError("Invalid render format: '%s'" % args.render_format)
+    output_dir = args.output_dir
+    if output_dir is None:
+        output_dir = os.path.splitext(os.path.basename(args.input))[0]
+    output_path = os.path.join('dst', args.character, output_dir)
+    if args.render_format == 'png':
+        os.makedirs(output_path, exist_ok=True)
+    else:
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        output_path += '.mp4'
+
+    character_file = get_character_file(f"data/images/{args.character}.png", args.model, IMG_WIDTH)
+    input_image, extra_image = load_evtchar(character_file)
+    input_image = input_image.to(device)
+    dtype = get_model_dtype(args.model)
+    model = TalkingAnime3().to(device).eval().apply_backend()
+    session = model.create_session(input_image)
+
+    reader = VideoReader(args.input)
+    writer = FrameWriter(output_path, args.render_format, reader.fps, extra_image)
+    progress = Progress(reader.frame_count, reader.fps)
+    reader.start()
+    writer.start()
+    print("Rendering", args.input, "to", output_path)
+
+    rendered = {}
+    batch = []
+    for model_input_arr in iterate_model_inputs(iterate_poses(reader, args.render_workers)):
+        batch.append(model_input_arr)
+        if len(batch) == args.render_batch:
+            rendered, count = render_batch(model, session, dtype, batch, writer, rendered)
+            progress.update(len(batch), count)
+            batch = []
+    if len(batch) > 0:
+        rendered, count = render_batch(model, session, dtype, batch, writer, rendered)
+        progress.update(len(batch), count)
+    writer.put(None)
+    writer.join()
+    progress.report(time.perf_counter(), final=True)
+
+
+if __name__ == '__main__':
+    main()
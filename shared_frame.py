@@ -0,0 +1,154 @@
+from multiprocessing import Value, Array, shared_memory
+
+import numpy as np
+
+
+class SharedFrameRing:
+    """
+    single-producer ring of preallocated frames in shared memory
+
+    The producer writes each frame into the slot after the latest one and publishes it by bumping the sequence
+    number, so consumers always see the newest complete frame without pickling it. A slot's sequence number is
+    cleared while the producer writes into it, and read_latest checks it again after copying the frame out (a
+    seqlock), so a reader that was too slow to copy before the slot came round again retries instead of returning a
+    torn frame.
+    """
+
+    def __init__(self, shape, slots=3, dtype=np.uint8):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.slots = slots
+        self.frame_bytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self.shm = shared_memory.SharedMemory(create=True, size=self.frame_bytes * slots)
+        self.slot_seq = Array('q', slots, lock=False)
+        self.slot_time = Array('d', slots, lock=False)
+        self.latest_seq = Value('q', 0, lock=False)
+        self._frames = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_frames'] = None
+        return state
+
+    @property
+    def frames(self):
+        if self._frames is None:
+            self._frames = np.ndarray((self.slots,) + self.shape, dtype=self.dtype, buffer=self.shm.buf)
+        return self._frames
+
+    def acquire_write(self):
+        """
+        Returns:
+            seq (int): sequence number to pass to commit
+            frame (numpy array): slot to fill in place
+        """
+        seq = self.latest_seq.value + 1
+        # readers of the frame that was in this slot must see it's being overwritten
+        self.slot_seq[seq % self.slots] = 0
+        return seq, self.frames[seq % self.slots]
+
+    def commit(self, seq, timestamp=0.0):
+        self.slot_time[seq % self.slots] = timestamp
+        self.slot_seq[seq % self.slots] = seq
+        self.latest_seq.value = seq
+
+    def write(self, image, timestamp=0.0):
+        seq, frame = self.acquire_write()
+        np.copyto(frame, image)
+        self.commit(seq, timestamp)
+        return seq
+
+    def read_latest(self, out=None):
+        """
+        Args:
+            out (numpy array): buffer of the ring's shape and dtype to copy the frame into, allocated if None
+
+        Returns:
+            seq (int): sequence number of the newest frame, 0 if nothing was written yet
+            frame (numpy array): copy of the newest frame, None if nothing was written yet
+            timestamp (float): value passed to commit for that frame, None if nothing was written yet
+        """
+        while True:
+            seq = self.latest_seq.value
+            if seq == 0:
+                return 0, None, None
+            slot = seq % self.slots
+            if self.slot_seq[slot] != seq:
+                # overwritten since latest_seq was read, there is a newer frame
+                continue
+            if out is None:
+                out = np.empty(self.shape, dtype=self.dtype)
+            np.copyto(out, self.frames[slot])
+            timestamp = self.slot_time[slot]
+            if self.slot_seq[slot] == seq:
+                return seq, out, timestamp
+
+    def timestamp(self, seq):
+        """
+        Returns:
+            timestamp (float): value passed to commit for frame seq, None if its slot was reused since
+        """
+        slot = seq % self.slots
+        timestamp = self.slot_time[slot]
+        if seq == 0 or self.slot_seq[slot] != seq:
+            return None
+        return timestamp
+
+    def close(self):
+        self._frames = None
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+if __name__ == '__main__':
+    import time
+    from multiprocessing import Process, Queue
+
+    frame = np.random.default_rng(0).integers(0, 256, (512, 512, 4), dtype=np.uint8)
+    repeat = 200
+
+    queue = Queue()
+    tic = time.perf_counter()
+    for i in range(repeat):
+        queue.put(frame)
+        queue.get()
+    print("Queue: %.3f ms/frame" % ((time.perf_counter() - tic) * 1000 / repeat))
+
+    ring = SharedFrameRing(frame.shape)
+    out = np.empty_like(frame)
+    tic = time.perf_counter()
+    for i in range(repeat):
+        ring.write(frame)
+        ring.read_latest(out)
+    print("SharedFrameRing: %.3f ms/frame" % ((time.perf_counter() - tic) * 1000 / repeat))
+    assert np.array_equal(ring.read_latest()[1], frame)
+    # a slot being written is never handed out, and timestamps of reused slots aren't either
+    seq, slot_frame = ring.acquire_write()
+    assert ring.read_latest()[0] == seq - 1 and ring.timestamp(seq - 1) is not None
+    assert ring.timestamp(seq - ring.slots) is None
+    ring.close()
+    ring.unlink()
+
+    # a writer process filling every frame with one value, any mixed copy would be a torn read
+    ring = SharedFrameRing((256, 256, 4), slots=2)
+
+    def produce(ring, frames):
+        for i in range(1, frames + 1):
+            seq, slot_frame = ring.acquire_write()
+            slot_frame[:] = i % 256
+            ring.commit(seq, float(i))
+
+    producer = Process(target=produce, args=(ring, 5000))
+    producer.start()
+    reads = 0
+    while producer.is_alive():
+        seq, read_frame, timestamp = ring.read_latest()
+        if read_frame is not None:
+            assert (read_frame == int(timestamp) % 256).all(), "torn frame %d" % seq
+            reads += 1
+    producer.join()
+    print("%d reads against a concurrent writer, none torn" % reads)
+    ring.close()
+    ring.unlink()
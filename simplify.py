@@ -2,7 +2,7 @@ import functools
 import math
 import numpy as np
 from args import args
-import tha2
+import tha2.poser.modes.mode_20_wx
 
 ifm_converter = tha2.poser.modes.mode_20_wx.IFacialMocapPoseConverter20()
 
@@ -0,0 +1,230 @@
+import queue
+import threading
+import time
+from collections import deque
+
+PIPELINE_CAPACITY = 2
+
+
+class PipelineItem:
+    """
+    one frame travelling through a StagePipeline with the per frame values its stages need
+    """
+
+    __slots__ = ('frame', 'context', 'spans')
+
+    def __init__(self, frame, context):
+        self.frame = frame
+        self.context = context
+        # (stage, start, end) in perf_counter_ns for every stage the frame went through
+        self.spans = []
+
+
+class Stage:
+    def __init__(self, name, func, workers, capacity, drop_oldest):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.capacity = capacity
+        self.drop_oldest = drop_oldest
+        self.queue = queue.Queue(capacity)
+        # a ticket is taken together with the item, so items leave in the order they entered
+        self.ticket_lock = threading.Lock()
+        self.order = threading.Condition()
+        self.next_ticket = 0
+        self.tickets = 0
+        self.busy = 0
+        self.processed = 0
+        self.dropped = 0
+        self.threads = []
+
+
+class StagePipeline:
+    """
+    chain of frame stages, each with its own worker threads and a bounded queue in front of it
+
+    A stage is func(frame, context) -> frame, None drops the frame. Stages with several workers process frames in
+    parallel but hand them on in order. When a stage's queue is full, a drop_oldest stage discards the oldest queued
+    frame to make room, which keeps a real time output at the newest frame, and any other stage blocks the one
+    before it (backpressure). Finished frames wait in a short queue for completed() on the submitting thread.
+    """
+
+    def __init__(self):
+        self.stages = []
+        self.finished = deque(maxlen=PIPELINE_CAPACITY * 4)
+        self.error = None
+
+    def add_stage(self, name, func, workers=1, capacity=PIPELINE_CAPACITY, drop_oldest=False):
+        self.stages.append(Stage(name, func, workers, capacity, drop_oldest))
+        return self
+
+    def start(self):
+        for index, stage in enumerate(self.stages):
+            for i in range(stage.workers):
+                thread = threading.Thread(target=self.run, args=(index,), name='%s-%d' % (stage.name, i),
+                                          daemon=True)
+                thread.start()
+                stage.threads.append(thread)
+        return self
+
+    def submit(self, frame, context=None):
+        """
+        Args:
+            frame (numpy array): frame for the first stage, owned by the pipeline from now on
+            context (dict): per frame values passed to every stage and returned by completed()
+        """
+        if self.error is not None:
+            raise RuntimeError("Pipeline stage failed") from self.error
+        self.put(0, PipelineItem(frame, context or {}))
+
+    def put(self, index, item):
+        if index == len(self.stages):
+            self.finished.append(item)
+            return
+        stage = self.stages[index]
+        while True:
+            try:
+                stage.queue.put_nowait(item)
+                return
+            except queue.Full:
+                if not stage.drop_oldest:
+                    stage.queue.put(item)
+                    return
+            try:
+                stage.queue.get_nowait()
+                stage.dropped += 1
+            except queue.Empty:
+                pass
+
+    def run(self, index):
+        stage = self.stages[index]
+        while True:
+            with stage.ticket_lock:
+                item = stage.queue.get()
+                if item is None:
+                    break
+                ticket = stage.tickets
+                stage.tickets += 1
+                stage.busy += 1
+            start = time.perf_counter_ns()
+            try:
+                item.frame = stage.func(item.frame, item.context)
+            except Exception as e:
+                self.error = e
+                item.frame = None
+            item.spans.append((stage.name, start, time.perf_counter_ns()))
+            with stage.order:
+                while stage.next_ticket != ticket:
+                    stage.order.wait()
+                if item.frame is not None:
+                    self.put(index + 1, item)
+                stage.busy -= 1
+                stage.processed += 1
+                stage.next_ticket += 1
+                stage.order.notify_all()
+
+    def completed(self):
+        """
+        Returns:
+            items (list): PipelineItems that went through every stage since the last call, oldest first
+        """
+        items = []
+        while len(self.finished) > 0:
+            items.append(self.finished.popleft())
+        return items
+
+    def occupancy(self):
+        """
+        Returns:
+            occupancy (dict): stage name -> queued frames, capacity, busy and total workers, processed and dropped
+        """
+        return {stage.name: {
+            'queued': stage.queue.qsize(),
+            'capacity': stage.capacity,
+            'busy': stage.busy,
+            'workers': stage.workers,
+            'processed': stage.processed,
+            'dropped': stage.dropped,
+        } for stage in self.stages}
+
+    def close(self):
+        for stage in self.stages:
+            for thread in stage.threads:
+                stage.queue.put(None)
+            for thread in stage.threads:
+                thread.join()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    import cv2
+    import numpy as np
+
+    parser = argparse.ArgumentParser(description="Compare a serial and a pipelined output chain on synthetic frames")
+    parser.add_argument('--frames', type=int, default=120)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--fps', type=float, default=60.0, help="rate of the source frames")
+    parser.add_argument('--send_ms', type=float, default=8.0, help="simulated blocking time of the output device")
+    pipeline_args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    frames = [rng.integers(0, 256, (512, 512, 4), dtype=np.uint8) for _ in range(8)]
+    rm = cv2.getRotationMatrix2D((256, 256), 3, 1.1)
+
+    def warp(frame, context):
+        return cv2.warpAffine(frame, rm, (1024, 1024))
+
+    def alpha_split(frame, context):
+        alpha_image = cv2.cvtColor(cv2.merge([frame[:, :, 3]] * 3), cv2.COLOR_RGB2RGBA)
+        return cv2.hconcat([frame, alpha_image])
+
+    def send(frame, context):
+        time.sleep(pipeline_args.send_ms / 1000)
+        return frame
+
+    def run_serial():
+        # the source has a new frame every 1 / fps seconds, the serial chain takes the newest one whenever it's free
+        latencies = []
+        start = time.perf_counter()
+        end = start + pipeline_args.frames / pipeline_args.fps
+        last = -1
+        while time.perf_counter() < end:
+            index = int((time.perf_counter() - start) * pipeline_args.fps)
+            if index == last:
+                time.sleep(max(start + (index + 1) / pipeline_args.fps - time.perf_counter(), 0))
+                continue
+            last = index
+            send(alpha_split(warp(frames[index % len(frames)], None), None), None)
+            latencies.append(time.perf_counter() - (start + index / pipeline_args.fps))
+        return len(latencies), time.perf_counter() - start, latencies
+
+    def run_pipelined():
+        pipeline = StagePipeline()
+        pipeline.add_stage('warp_affine', warp, pipeline_args.workers, drop_oldest=True)
+        pipeline.add_stage('alpha_split', alpha_split, pipeline_args.workers)
+        pipeline.add_stage('send', send, 1, drop_oldest=True)
+        pipeline.start()
+        latencies = []
+        start = time.perf_counter()
+        for i in range(pipeline_args.frames):
+            pipeline.submit(frames[i % len(frames)], {'time': time.perf_counter_ns()})
+            for item in pipeline.completed():
+                latencies.append((item.spans[-1][2] - item.context['time']) / 1e9)
+            time.sleep(max(start + (i + 1) / pipeline_args.fps - time.perf_counter(), 0))
+        while sum(stats['queued'] + stats['busy'] for stats in pipeline.occupancy().values()) > 0:
+            time.sleep(0.001)
+        for item in pipeline.completed():
+            latencies.append((item.spans[-1][2] - item.context['time']) / 1e9)
+        elapsed = time.perf_counter() - start
+        occupancy = pipeline.occupancy()
+        pipeline.close()
+        return len(latencies), elapsed, latencies, occupancy
+
+    sent, elapsed, latencies = run_serial()
+    print("serial:    %5.1f fps out, latency %.1f ms" % (sent / elapsed, np.mean(latencies) * 1000))
+    sent, elapsed, latencies, occupancy = run_pipelined()
+    print("pipelined: %5.1f fps out, latency %.1f ms, %d of %d source frames" % (
+        sent / elapsed, np.mean(latencies) * 1000, sent, pipeline_args.frames))
+    for name, stats in occupancy.items():
+        print(" - %-12s %s" % (name, stats))
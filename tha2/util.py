@@ -8,6 +8,9 @@ import torch
 from matplotlib import cm
 from torch import Tensor
 
+from tha3.color import numpy_srgb_to_linear as srgb_to_linear, numpy_linear_to_srgb as linear_to_srgb, \
+    image_uint8_srgb_to_linear
+
 
 def is_power2(x):
     return x != 0 and ((x & (x - 1)) == 0)
@@ -24,16 +27,6 @@ def torch_load(file_name):
         return torch.load(f)
 
 
-def srgb_to_linear(x):
-    x = numpy.clip(x, 0.0, 1.0)
-    return numpy.where(x <= 0.04045, x / 12.92, ((x + 0.055) / 1.055) ** 2.4)
-
-
-def linear_to_srgb(x):
-    x = numpy.clip(x, 0.0, 1.0)
-    return numpy.where(x <= 0.003130804953560372, x * 12.92, 1.055 * (x ** (1.0 / 2.4)) - 0.055)
-
-
 def image_linear_to_srgb(image):
     assert image.shape[2] == 3 or image.shape[2] == 4
     if image.shape[2] == 3:
@@ -162,8 +155,9 @@ def extract_numpy_image_from_filelike(file):
 
 
 def extract_numpy_image_from_PIL_image(pil_image):
-    image = numpy.asarray(pil_image) / 255.0
-    image[:, :, 0:3] = srgb_to_linear(image[:, :, 0:3])
+    raw_image = numpy.asarray(pil_image)
+    image = raw_image / 255.0
+    image[:, :, 0:3] = image_uint8_srgb_to_linear(raw_image[:, :, 0:3])
     return image
 
 
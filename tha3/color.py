@@ -0,0 +1,112 @@
+import numpy
+import torch
+
+SRGB_TO_LINEAR_THRESHOLD = 0.04045
+LINEAR_TO_SRGB_THRESHOLD = 0.003130804953560372
+LINEAR_TO_SRGB_LUT_SIZE = 65536
+
+
+def numpy_srgb_to_linear(x):
+    x = numpy.clip(x, 0.0, 1.0)
+    return numpy.where(x <= SRGB_TO_LINEAR_THRESHOLD, x / 12.92, ((x + 0.055) / 1.055) ** 2.4)
+
+
+def numpy_linear_to_srgb(x):
+    x = numpy.clip(x, 0.0, 1.0)
+    return numpy.where(x <= LINEAR_TO_SRGB_THRESHOLD, x * 12.92, 1.055 * (x ** (1.0 / 2.4)) - 0.055)
+
+
+def torch_srgb_to_linear(x: torch.Tensor):
+    x = torch.clip(x, 0.0, 1.0)
+    return torch.where(torch.le(x, SRGB_TO_LINEAR_THRESHOLD), x / 12.92, ((x + 0.055) / 1.055) ** 2.4)
+
+
+def torch_linear_to_srgb(x):
+    x = torch.clip(x, 0.0, 1.0)
+    return torch.where(torch.le(x, LINEAR_TO_SRGB_THRESHOLD), x * 12.92, 1.055 * (x ** (1.0 / 2.4)) - 0.055)
+
+
+# every 8 bit value through the formula once, so lookups give exactly numpy_srgb_to_linear(x / 255.0)
+UINT8_SRGB_TO_LINEAR = numpy_srgb_to_linear(numpy.arange(256) / 255.0)
+
+
+def create_linear_to_srgb_lut(size=LINEAR_TO_SRGB_LUT_SIZE):
+    """
+    Returns:
+        lut (numpy array): uint8 sRGB levels of size evenly spaced linear values in [0, 1], truncated like the
+            astype(uint8) / byte() that followed the formula
+    """
+    return numpy.floor(numpy_linear_to_srgb(numpy.arange(size) / (size - 1)) * 255).astype(numpy.uint8)
+
+
+LINEAR_TO_SRGB_UINT8 = create_linear_to_srgb_lut()
+
+
+def uint8_srgb_to_linear(image):
+    """
+    Args:
+        image (numpy array): uint8 sRGB values
+
+    Returns:
+        image (numpy array): float64 linear values in [0, 1], the same as numpy_srgb_to_linear(image / 255.0)
+    """
+    return UINT8_SRGB_TO_LINEAR[image]
+
+
+def image_uint8_srgb_to_linear(image):
+    """
+    numpy_srgb_to_linear(image / 255.0), through the 256 entry table when image is uint8
+    """
+    if image.dtype == numpy.uint8:
+        return uint8_srgb_to_linear(image)
+    return numpy_srgb_to_linear(image / 255.0)
+
+
+def linear_to_uint8_srgb(x):
+    """
+    Args:
+        x (numpy array): float linear values, clipped to [0, 1]
+
+    Returns:
+        image (numpy array): uint8 sRGB values, at most one level off the formula
+    """
+    index = numpy.rint(numpy.clip(x, 0.0, 1.0) * (len(LINEAR_TO_SRGB_UINT8) - 1)).astype(numpy.intp)
+    return LINEAR_TO_SRGB_UINT8[index]
+
+
+if __name__ == '__main__':
+    import time
+
+    def measure(func, *inputs, repeat=10):
+        func(*inputs)
+        tic = time.perf_counter()
+        for i in range(repeat):
+            func(*inputs)
+        return (time.perf_counter() - tic) * 1000 / repeat
+
+    rng = numpy.random.default_rng(0)
+    image = rng.integers(0, 256, (512, 512, 4), dtype=numpy.uint8)
+    linear = rng.random((512, 512, 4))
+
+    # 8 bit input: the table has to be bit exact
+    assert numpy.array_equal(uint8_srgb_to_linear(image), numpy_srgb_to_linear(image / 255.0))
+    assert numpy.array_equal(image_uint8_srgb_to_linear(image.astype(numpy.int32)), uint8_srgb_to_linear(image))
+    # torch and numpy formulas agree, and sRGB round trips back to the same 8 bit values
+    assert numpy.allclose(torch_srgb_to_linear(torch.from_numpy(linear)).numpy(), numpy_srgb_to_linear(linear))
+    assert numpy.allclose(torch_linear_to_srgb(torch.from_numpy(linear)).numpy(), numpy_linear_to_srgb(linear))
+    assert numpy.array_equal(numpy.rint(numpy_linear_to_srgb(uint8_srgb_to_linear(image)) * 255), image)
+    # uint8 output: within one level of the formula, clipped like it
+    formula = (numpy_linear_to_srgb(linear) * 255).astype(numpy.uint8)
+    diff = numpy.abs(linear_to_uint8_srgb(linear).astype(int) - formula)
+    assert diff.max() <= 1
+    ends = numpy.array([-1.0, 0.0, 1.0, 2.0])
+    assert numpy.array_equal(linear_to_uint8_srgb(ends), (numpy_linear_to_srgb(ends) * 255).astype(numpy.uint8))
+    print("uint8 output: %.3f%% of values one level off the formula" % ((diff > 0).mean() * 100))
+
+    before = measure(lambda x: numpy_srgb_to_linear(x / 255.0), image)
+    after = measure(uint8_srgb_to_linear, image)
+    print("uint8 sRGB -> linear: formula %.2f ms, table %.2f ms (%.1fx)" % (before, after, before / after))
+    before = measure(lambda x: (numpy_linear_to_srgb(x) * 255).astype(numpy.uint8), linear)
+    after = measure(linear_to_uint8_srgb, linear)
+    print("linear -> uint8 sRGB: formula %.2f ms, table %.2f ms (%.1fx)" % (before, after, before / after))
+    print("%d pixels per frame" % (image.shape[0] * image.shape[1]))
@@ -6,6 +6,7 @@ from torch import Tensor
 from torch.nn import Module, Sequential, Tanh, Sigmoid
 
 from tha3.nn.image_processing_util import GridChangeApplier, apply_color_change
+from tha3.nn.pose_input_buffer import can_reuse_buffers
 from tha3.nn.common.resize_conv_unet import ResizeConvUNet, ResizeConvUNetArgs
 from tha3.util import numpy_linear_to_srgb
 from tha3.module.module_factory import ModuleFactory
@@ -80,6 +81,8 @@ class Editor07(Module):
             initialization_method='zero',
             use_spectral_norm=False)
         self.grid_change_applier = GridChangeApplier()
+        # set to a PoseInputBuffer to reuse the concatenated input across calls
+        self.input_buffer = None
 
     def forward(self,
                 input_original_image: Tensor,
@@ -87,9 +90,12 @@ class Editor07(Module):
                 input_grid_change: Tensor,
                 pose: Tensor,
                 *args) -> List[Tensor]:
-        n, c = pose.shape
-        pose = pose.view(n, c, 1, 1).repeat(1, 1, self.args.image_size, self.args.image_size)
-        feature = torch.cat([input_original_image, input_warped_image, input_grid_change, pose], dim=1)
+        if self.input_buffer is not None and can_reuse_buffers():
+            feature = self.input_buffer.fill([input_original_image, input_warped_image, input_grid_change], pose)
+        else:
+            n, c = pose.shape
+            pose = pose.view(n, c, 1, 1).repeat(1, 1, self.args.image_size, self.args.image_size)
+            feature = torch.cat([input_original_image, input_warped_image, input_grid_change, pose], dim=1)
 
         feature = self.body.forward(feature)[-1]
         output_grid_change = input_grid_change + self.grid_change_creator(feature)
@@ -26,7 +26,6 @@ def apply_grid_change(grid_change, image: Tensor) -> Tensor:
 
 class GridChangeApplier:
     def __init__(self):
-        self.last_n = None
         self.last_device = None
         self.last_identity = None
 
@@ -35,7 +34,7 @@ class GridChangeApplier:
         device = grid_change.device
         grid_change = torch.transpose(grid_change.view(n, 2, h * w), 1, 2).view(n, h, w, 2)
 
-        if n == self.last_n and device == self.last_device:
+        if device == self.last_device and grid_change.dtype == self.last_identity.dtype:
             identity = self.last_identity
         else:
             identity = torch.tensor(
@@ -43,11 +42,11 @@ class GridChangeApplier:
                 dtype=grid_change.dtype,
                 device=device,
                 requires_grad=False) \
-                .unsqueeze(0).repeat(n, 1, 1)
+                .unsqueeze(0)
             self.last_identity = identity
-            self.last_n = n
             self.last_device = device
-        base_grid = affine_grid(identity, [n, c, h, w], align_corners=align_corners)
+        # expanded from a batch of one so a traced or exported graph keeps a dynamic batch size
+        base_grid = affine_grid(identity.expand(n, 2, 3), [n, c, h, w], align_corners=align_corners)
 
         grid = base_grid + grid_change
         resampled_image = grid_sample(image, grid, mode='bilinear', padding_mode='border', align_corners=align_corners)
@@ -0,0 +1,48 @@
+from typing import List
+
+import torch
+from torch import Tensor
+
+
+class PoseInputBuffer:
+    """
+    reusable network input holding some images followed by a pose broadcast over every pixel
+
+    Networks like Editor07 feed torch.cat([images..., pose.repeat(...)]) to their first conv, which allocates both
+    the repeated pose and the concatenation every frame. Here both are written into one buffer that is kept across
+    calls, the pose through an expanded view so the full resolution repeat never exists on its own.
+    """
+
+    def __init__(self, memory_format=torch.contiguous_format):
+        self.memory_format = memory_format
+        self.buffer = None
+
+    def fill(self, images: List[Tensor], pose: Tensor) -> Tensor:
+        n, c = pose.shape
+        h, w = images[0].shape[2:]
+        shape = (n, sum(image.shape[1] for image in images) + c, h, w)
+        buffer = self.buffer
+        if buffer is None or buffer.shape != shape or buffer.dtype != pose.dtype or buffer.device != pose.device:
+            buffer = torch.empty(shape, dtype=pose.dtype, device=pose.device, memory_format=self.memory_format)
+            self.buffer = buffer
+        offset = 0
+        for image in images:
+            buffer[:, offset:offset + image.shape[1]].copy_(image)
+            offset += image.shape[1]
+        buffer[:, offset:].copy_(pose.view(n, c, 1, 1).expand(n, c, h, w))
+        return buffer
+
+
+def can_reuse_buffers() -> bool:
+    # traced or compiled graphs must see the plain ops, a buffer would be baked into them as a constant
+    return not torch.jit.is_tracing() and not torch.compiler.is_compiling()
+
+
+def use_input_buffer(module, memory_format=torch.contiguous_format):
+    """
+    switch an Editor07 or TwoAlgoFaceBodyRotator05 to its inference layout: weights and activations in memory_format
+    and a PoseInputBuffer in place of the per call concatenation
+    """
+    module.to(memory_format=memory_format)
+    module.input_buffer = PoseInputBuffer(memory_format)
+    return module
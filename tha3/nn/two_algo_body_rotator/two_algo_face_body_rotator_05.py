@@ -5,6 +5,7 @@ from torch import Tensor
 from torch.nn import Module, Sequential, Tanh
 
 from tha3.nn.image_processing_util import GridChangeApplier
+from tha3.nn.pose_input_buffer import can_reuse_buffers
 from tha3.nn.common.resize_conv_encoder_decoder import ResizeConvEncoderDecoder, ResizeConvEncoderDecoderArgs
 from tha3.module.module_factory import ModuleFactory
 from tha3.nn.conv import create_conv3_from_block_args, create_conv3
@@ -73,11 +74,16 @@ class TwoAlgoFaceBodyRotator05(Module):
             initialization_method='zero',
             use_spectral_norm=False)
         self.grid_change_applier = GridChangeApplier()
+        # set to a PoseInputBuffer to reuse the concatenated input across calls
+        self.input_buffer = None
 
     def forward(self, image: Tensor, pose: Tensor, *args) -> List[Tensor]:
-        n, c = pose.shape
-        pose = pose.view(n, c, 1, 1).repeat(1, 1, self.args.image_size, self.args.image_size)
-        feature = torch.cat([image, pose], dim=1)
+        if self.input_buffer is not None and can_reuse_buffers():
+            feature = self.input_buffer.fill([image], pose)
+        else:
+            n, c = pose.shape
+            pose = pose.view(n, c, 1, 1).repeat(1, 1, self.args.image_size, self.args.image_size)
+            feature = torch.cat([image, pose], dim=1)
 
         feature = self.encoder_decoder.forward(feature)[-1]
         grid_change = self.grid_change_creator(feature)
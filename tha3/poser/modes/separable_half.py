@@ -52,23 +52,24 @@ class FiveStepPoserComputationProtocol(CachedComputationProtocol):
         super().__init__()
         self.eyebrow_morphed_image_index = eyebrow_morphed_image_index
         self.cached_batch_0 = None
+        self.cached_batch_0_id = None
         self.cached_eyebrow_decomposer_output = None
 
     def compute_func(self) -> TensorListCachedComputationFunc:
         def func(modules: Dict[str, Module],
                  batch: List[Tensor],
                  outputs: Dict[str, List[Tensor]]):
-            if self.cached_batch_0 is None:
-                new_batch_0 = True
-            elif batch[0].shape[0] != self.cached_batch_0.shape[0]:
-                new_batch_0 = True
-            else:
-                new_batch_0 = torch.max((batch[0] - self.cached_batch_0).abs()).item() > 0
+            # the same tensor with an unchanged version counter can't hold a different image, which avoids comparing
+            # every pixel (and a device sync) per frame. Holding on to cached_batch_0 keeps its storage from being
+            # reused by another image.
+            batch_0_id = (batch[0].data_ptr(), batch[0].shape, batch[0].stride(), batch[0]._version)
+            new_batch_0 = self.cached_batch_0 is None or batch_0_id != self.cached_batch_0_id
             if not new_batch_0:
                 outputs[Network.eyebrow_decomposer.outputs_key] = self.cached_eyebrow_decomposer_output
             output = self.get_output(Branch.all_outputs.name, modules, batch, outputs)
             if new_batch_0:
                 self.cached_batch_0 = batch[0]
+                self.cached_batch_0_id = batch_0_id
                 self.cached_eyebrow_decomposer_output = outputs[Network.eyebrow_decomposer.outputs_key]
             return output
 
@@ -142,7 +143,7 @@ class FiveStepPoserComputationProtocol(CachedComputationProtocol):
             raise RuntimeError("Unsupported key: " + key)
 
 
-def load_eyebrow_decomposer(file_name: str):
+def create_eyebrow_decomposer():
     factory = EyebrowDecomposer03Factory(
         EyebrowDecomposer03Args(
             image_size=128,
@@ -156,14 +157,18 @@ def load_eyebrow_decomposer(file_name: str):
                 use_spectral_norm=False,
                 normalization_layer_factory=InstanceNorm2dFactory(),
                 nonlinearity_factory=ReLUFactory(inplace=True))))
+    return factory.create().half()
+
+
+def load_eyebrow_decomposer(file_name: str):
     print("Loading the eyebrow decomposer ... ", end="")
-    module = factory.create().half()
+    module = create_eyebrow_decomposer()
     module.load_state_dict(torch_load(file_name))
     print("DONE!!!")
     return module
 
 
-def load_eyebrow_morphing_combiner(file_name: str):
+def create_eyebrow_morphing_combiner():
     factory = EyebrowMorphingCombiner03Factory(
         EyebrowMorphingCombiner03Args(
             image_size=128,
@@ -178,14 +183,18 @@ def load_eyebrow_morphing_combiner(file_name: str):
                 use_spectral_norm=False,
                 normalization_layer_factory=InstanceNorm2dFactory(),
                 nonlinearity_factory=ReLUFactory(inplace=True))))
+    return factory.create().half()
+
+
+def load_eyebrow_morphing_combiner(file_name: str):
     print("Loading the eyebrow morphing conbiner ... ", end="")
-    module = factory.create().half()
+    module = create_eyebrow_morphing_combiner()
     module.load_state_dict(torch_load(file_name))
     print("DONE!!!")
     return module
 
 
-def load_face_morpher(file_name: str):
+def create_face_morpher():
     factory = FaceMorpher09Factory(
         FaceMorpher09Args(
             image_size=192,
@@ -200,15 +209,19 @@ def load_face_morpher(file_name: str):
                 use_spectral_norm=False,
                 normalization_layer_factory=InstanceNorm2dFactory(),
                 nonlinearity_factory=ReLUFactory(inplace=False))))
+    return factory.create().half()
+
+
+def load_face_morpher(file_name: str):
     print("Loading the face morpher ... ", end="")
-    module = factory.create().half()
+    module = create_face_morpher()
     module.load_state_dict(torch_load(file_name))
     print("DONE!!!")
     return module
 
 
-def load_two_algo_generator(file_name) -> Module:
-    module = TwoAlgoFaceBodyRotator05(
+def create_two_algo_generator() -> Module:
+    return TwoAlgoFaceBodyRotator05(
         TwoAlgoFaceBodyRotator05Args(
             image_size=256,
             image_channels=4,
@@ -224,14 +237,18 @@ def load_two_algo_generator(file_name) -> Module:
                 use_spectral_norm=False,
                 normalization_layer_factory=InstanceNorm2dFactory(),
                 nonlinearity_factory=LeakyReLUFactory(inplace=False, negative_slope=0.1)))).half()
+
+
+def load_two_algo_generator(file_name) -> Module:
     print("Loading the face-body rotator ... ", end="")
+    module = create_two_algo_generator()
     module.load_state_dict(torch_load(file_name))
     print("DONE!!!")
     return module
 
 
-def load_editor(file_name) -> Module:
-    module = Editor07(
+def create_editor() -> Module:
+    return Editor07(
         Editor07Args(
             image_size=512,
             image_channels=4,
@@ -247,7 +264,11 @@ def load_editor(file_name) -> Module:
                 use_spectral_norm=False,
                 normalization_layer_factory=InstanceNorm2dFactory(),
                 nonlinearity_factory=LeakyReLUFactory(inplace=False, negative_slope=0.1)))).half()
+
+
+def load_editor(file_name) -> Module:
     print("Loading the combiner ... ", end="")
+    module = create_editor()
     module.load_state_dict(torch_load(file_name))
     print("DONE!!!")
     return module
@@ -8,31 +8,14 @@ import torch
 from matplotlib import cm
 from torch import Tensor
 
+from tha3.color import numpy_srgb_to_linear, numpy_linear_to_srgb, torch_srgb_to_linear, torch_linear_to_srgb, \
+    image_uint8_srgb_to_linear
+
 
 def is_power2(x):
     return x != 0 and ((x & (x - 1)) == 0)
 
 
-def numpy_srgb_to_linear(x):
-    x = numpy.clip(x, 0.0, 1.0)
-    return numpy.where(x <= 0.04045, x / 12.92, ((x + 0.055) / 1.055) ** 2.4)
-
-
-def numpy_linear_to_srgb(x):
-    x = numpy.clip(x, 0.0, 1.0)
-    return numpy.where(x <= 0.003130804953560372, x * 12.92, 1.055 * (x ** (1.0 / 2.4)) - 0.055)
-
-
-def torch_srgb_to_linear(x: torch.Tensor):
-    x = torch.clip(x, 0.0, 1.0)
-    return torch.where(torch.le(x, 0.04045), x / 12.92, ((x + 0.055) / 1.055) ** 2.4)
-
-
-def torch_linear_to_srgb(x):
-    x = torch.clip(x, 0.0, 1.0)
-    return torch.where(torch.le(x, 0.003130804953560372), x * 12.92, 1.055 * (x ** (1.0 / 2.4)) - 0.055)
-
-
 def image_linear_to_srgb(image):
     assert image.shape[2] == 3 or image.shape[2] == 4
     if image.shape[2] == 3:
@@ -129,6 +112,12 @@ def rgba_to_numpy_image(torch_image: Tensor, min_pixel_value=-1.0, max_pixel_val
     return rgba_image
 
 
+def clear_transparent_pixels(image):
+    # search for transparent pixels(alpha==0) and change them to [0 0 0 0] to avoid the color influence to the model
+    image[image[..., 3] <= 0] = 0
+    return image
+
+
 def extract_numpy_image_from_filelike_with_pytorch_layout(file, has_alpha=True, scale=2.0, offset=-1.0):
     try:
         pil_image = PIL.Image.open(file)
@@ -144,16 +133,12 @@ def extract_numpy_image_from_PIL_image_with_pytorch_layout(pil_image, has_alpha=
         num_channel = 3
     image_size = pil_image.width
 
-    # search for transparent pixels(alpha==0) and change them to [0 0 0 0] to avoid the color influence to the model
-    for i, px in enumerate(pil_image.getdata()):
-        if px[3] <= 0:
-            y = i // image_size
-            x = i % image_size
-            pil_image.putpixel((x, y), (0, 0, 0, 0))
-
-    raw_image = numpy.asarray(pil_image)
-    image = (raw_image / 255.0).reshape(image_size, image_size, num_channel)
-    image[:, :, 0:3] = numpy_srgb_to_linear(image[:, :, 0:3])
+    raw_image = numpy.array(pil_image)
+    if has_alpha:
+        raw_image = clear_transparent_pixels(raw_image)
+    raw_image = raw_image.reshape(image_size, image_size, num_channel)
+    image = raw_image / 255.0
+    image[:, :, 0:3] = image_uint8_srgb_to_linear(raw_image[:, :, 0:3])
     image = image \
                 .reshape(image_size * image_size, num_channel) \
                 .transpose() \
@@ -179,11 +164,10 @@ def extract_numpy_image_from_filelike(file):
     pil_image = PIL.Image.open(file)
     image_width = pil_image.width
     image_height = pil_image.height
-    if pil_image.mode == "RGBA":
-        image = (numpy.asarray(pil_image) / 255.0).reshape(image_height, image_width, 4)
-    else:
-        image = (numpy.asarray(pil_image) / 255.0).reshape(image_height, image_width, 3)
-    image[:, :, 0:3] = numpy_srgb_to_linear(image[:, :, 0:3])
+    num_channel = 4 if pil_image.mode == "RGBA" else 3
+    raw_image = numpy.asarray(pil_image).reshape(image_height, image_width, num_channel)
+    image = raw_image / 255.0
+    image[:, :, 0:3] = image_uint8_srgb_to_linear(raw_image[:, :, 0:3])
     return image
 
 
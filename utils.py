@@ -1,49 +1,44 @@
 import torch
 import numpy as np
+from PIL import Image
 
+from tha3.color import create_linear_to_srgb_lut, image_uint8_srgb_to_linear, linear_to_uint8_srgb
+from tha3.util import clear_transparent_pixels
 
-def linear_rgb2srgb(image):
-    """
-    convert linear rgb image to srgb image
-    Args:
-        image (numpy array): linear rgb color space image
-
-    Returns:
-        image (numpy array): srgb color space image
-    """
-    return np.where(image <= 0.04045, image / 12.92, ((image + 0.055) / 1.055) ** 2.4)
 
-
-def srgb2linear_rgb(image):
+def preprocessing_image(image):
     """
-    convert srgb image to linear rgb image
+    convert image(numpy array, unit8) to tensor
     Args:
-        image (numpy array): srgb color space image
-
+        image (numpy array): character image (256x256, alpha channel included)
     Returns:
-        image (numpy array): linear rgb color space image
+        tensor
     """
-    return np.where(image <= 0.003130804953560372, image * 12.92, 1.055 * (image ** (1.0 / 2.4)) - 0.055)
+    linear_image = clear_transparent_pixels(image_uint8_srgb_to_linear(np.asarray(image)))
+    return np.ascontiguousarray(linear_image.transpose(2, 0, 1))
 
 
-def preprocessing_image(image):
+def ingest_character_image(image, width=512):
     """
-    convert image(numpy array, unit8) to tensor
+    resize a character image to the model width and split it into the model input and the body strip below it
     Args:
-        image (numpy array): character image (256x256, alpha channel included)
+        image (PIL image): character image (alpha channel included, may be taller than wide)
+        width (int): model input width
+
     Returns:
-        tensor
+        input_image (numpy array): preprocessed square model input (CxHxW, float)
+        extra_image (numpy array): uint8 RGBA strip below the model input, None if the image is not taller than wide
     """
-    np_image = np.array(image) / 255
-    clipped_image = np.clip(np_image, 0, 1)
-    srgb_image = linear_rgb2srgb(clipped_image)
-    h, w, c = srgb_image.shape
-    linear_image = srgb_image.reshape(h * w, c)
-    for pixel in linear_image:
-        if pixel[3] == 0.0:
-            pixel[0:3] = 0.0
-    reshaped_image = linear_image.transpose().reshape(c, h, w)
-    return reshaped_image
+    image = image.convert('RGBA')
+    w_ratio = image.size[0] / width
+    image = image.resize((width, int(image.size[1] / w_ratio)))
+    np_image = clear_transparent_pixels(np.array(image))
+    square_image = np.zeros((width, width, 4), dtype=np.uint8)
+    square_image[:min(width, np_image.shape[0])] = np_image[:width]
+    extra_image = None
+    if np_image.shape[0] > width:
+        extra_image = np.ascontiguousarray(np_image[width:])
+    return preprocessing_image(square_image), extra_image
 
 
 def postprocessing_image(tensor):
@@ -58,13 +53,169 @@ def postprocessing_image(tensor):
     reshaped_tensor = tensor.permute(1, 2, 0)
     np_image = reshaped_tensor.numpy()
     np_image = (np_image + 1) / 2
-    srgb_image = np_image[..., :3]
-    alpha_image = np_image[..., 3]
-    clipped_image = np.clip(srgb_image, 0, 1)
-    rgb_image = srgb2linear_rgb(clipped_image)
-    rgba_image = np.concatenate([rgb_image, alpha_image[..., np.newaxis]], axis=2)
-    rgba_image = rgba_image * 255
-    return rgba_image.astype(np.uint8)
+    rgb_image = linear_to_uint8_srgb(np_image[..., :3])
+    alpha_image = (np_image[..., 3] * 255).astype(np.uint8)
+    return np.concatenate([rgb_image, alpha_image[..., np.newaxis]], axis=2)
+
+
+OUTPUT_LUT_SIZE = 65536
+
+
+def create_output_lut(size=OUTPUT_LUT_SIZE, device=None):
+    """
+    Returns:
+        lut (tensor): 4*size uint8 levels of [0, 1] sampled evenly, through linear to sRGB for the three color
+            channels and directly for alpha, one channel after the other
+    """
+    srgb = create_linear_to_srgb_lut(size)
+    alpha = np.floor(np.arange(size) / (size - 1) * 255).astype(np.uint8)
+    return torch.from_numpy(np.concatenate([srgb, srgb, srgb, alpha])).to(device)
+
+
+class FramePostprocessor:
+    """
+    turn model outputs into displayable uint8 frames on the device they were rendered on
+
+    [-1, 1] to [0, 1], linear to sRGB and quantization are one lookup in a per channel table, indexed by a clamp and
+    a scale of the output, and only the lookup result, a quarter of the bytes of the float output, is permuted to HWC
+    and leaves the device.
+    """
+
+    def __init__(self, size=OUTPUT_LUT_SIZE):
+        self.size = size
+        self.lut = None
+        self.offset = None
+
+    def prepare(self, device):
+        if self.lut is not None and self.lut.device == device:
+            return
+        self.lut = create_output_lut(self.size, device)
+        # channel c looks up entries c*size to c*size+size-1, rounding to the nearest sample
+        self.offset = (torch.arange(4, dtype=torch.float32, device=device) * self.size +
+                       ((self.size - 1) / 2 + 0.5)).view(4, 1, 1)
+
+    def __call__(self, image):
+        """
+        Args:
+            image (tensor): ...x4xHxW model output in [-1, 1] on any device
+
+        Returns:
+            image (tensor): ...xHxWx4 uint8 sRGB frame on the same device
+        """
+        self.prepare(image.device)
+        index = torch.clamp(image.float(), -1.0, 1.0).mul_((self.size - 1) / 2).add_(self.offset).long()
+        return torch.take(self.lut, index).movedim(-3, -1).contiguous()
+
+
+frame_postprocessor = FramePostprocessor()
+
+
+def postprocess_model_output(image):
+    """
+    convert model outputs to displayable frames
+    Args:
+        image (tensor): 4xHxW or Nx4xHxW float model output in [-1, 1], on any device
+
+    Returns:
+        image (numpy array): HxWx4 or NxHxWx4 uint8 sRGB frame
+    """
+    return frame_postprocessor(image.detach()).cpu().numpy()
+
+
+def psnr(a, b):
+    """
+    Args:
+        a (tensor): model output in [-1, 1]
+        b (tensor): model output in [-1, 1]
+
+    Returns:
+        psnr (float): in dB over the [0, 1] range
+    """
+    mse = (((a.float() - b.float()) / 2) ** 2).mean().item()
+    return float('inf') if mse == 0 else 10 * np.log10(1 / mse)
+
+
+class EMASmoother:
+    def __init__(self, rate=0.5, dimension=45, precision=8, threshold=0.0, tag=""):
+        self.rate = rate
+        self.dimension = dimension
+        self.precision = precision
+        self.threshold = threshold * threshold
+        self.tag = tag
+        self.initial = False
+        self.value = np.zeros(dimension)
+
+    def forward(self, value):
+        npvalue = np.asarray(value)
+        if self.initial:
+            offset = np.square(self.value - npvalue).sum()
+            # print(self.tag, offset)
+            if offset > self.threshold:
+                self.value = self.value * (1 - self.rate) + npvalue * self.rate
+        else:
+            self.value = npvalue
+            self.initial = True
+        self.value = self.value.round(self.precision)
+        return self.value
+
+
+class PoseSmoother:
+    def __init__(self):
+        self.eyebrow_smoother = EMASmoother(0.4, 12, 8, 0.1, "eyebrow")
+        self.eye_mouth_smoother = EMASmoother(0.9, 27, 8, 5e-2, "eyemouth")
+        self.pose_smoother = EMASmoother(0.2, 6, 8, 4e-2, "pose")
+
+    def forward(self, eyebrow_vector_c, mouth_eye_vector_c, pose_vector_c):
+        """
+        smooth the three parameter groups and join them into one model input
+        Args:
+            eyebrow_vector_c (list): 12 eyebrow parameters
+            mouth_eye_vector_c (list): 27 face parameters
+            pose_vector_c (list): 6 rotation parameters
+
+        Returns:
+            model input (numpy array): 45 smoothed parameters
+        """
+        eyebrow_smoothed = self.eyebrow_smoother.forward(eyebrow_vector_c)
+        mouth_eye_smoothed = self.eye_mouth_smoother.forward(mouth_eye_vector_c)
+        pose_smoothed = self.pose_smoother.forward(pose_vector_c)
+        return np.concatenate((eyebrow_smoothed, mouth_eye_smoothed, pose_smoothed), axis=0)
+
+
+def convert_webcam_pose(np_pose):
+    """
+    map a mediapipe pose (see pose.get_pose) onto the model parameter groups
+    Args:
+        np_pose (numpy array): averaged pose vector from get_pose
+
+    Returns:
+        eyebrow_vector_c (list), mouth_eye_vector_c (list), pose_vector_c (list)
+    """
+    eye_l_h_temp = np_pose[0]
+    eye_r_h_temp = np_pose[1]
+    mouth_ratio = np_pose[2]
+    eye_y_ratio = np_pose[3]
+    eye_x_ratio = np_pose[4]
+    x_angle = np_pose[5]
+    y_angle = np_pose[6]
+    z_angle = np_pose[7]
+
+    eyebrow_vector_c = [0.0] * 12
+    mouth_eye_vector_c = [0.0] * 27
+    pose_vector_c = [0.0] * 6
+
+    mouth_eye_vector_c[2] = eye_l_h_temp
+    mouth_eye_vector_c[3] = eye_r_h_temp
+
+    mouth_eye_vector_c[14] = mouth_ratio * 1.5
+
+    mouth_eye_vector_c[25] = eye_y_ratio
+    mouth_eye_vector_c[26] = eye_x_ratio
+
+    pose_vector_c[0] = (x_angle - 1.5) * 1.6
+    pose_vector_c[1] = y_angle * 2.0  # temp weight
+    pose_vector_c[2] = (z_angle + 1.5) * 2  # temp weight
+    return eyebrow_vector_c, mouth_eye_vector_c, pose_vector_c
 
 
 def get_distance(a, b):
@@ -78,3 +229,71 @@ def get_distance(a, b):
         L2 distance (float)
     """
     return np.sqrt((a.x - b.x) ** 2 + (a.y - b.y) ** 2)
+
+
+if __name__ == '__main__':
+    import time
+
+    from tha3.color import torch_linear_to_srgb
+
+
+    def legacy_ingest_character_image(image, width=512):
+        image = image.convert('RGBA')
+        w_ratio = image.size[0] / width
+        image = image.resize((width, int(image.size[1] / w_ratio)))
+        for i, px in enumerate(image.getdata()):
+            if px[3] <= 0:
+                image.putpixel((i % width, i // width), (0, 0, 0, 0))
+        np_image = np.array(image.crop((0, 0, width, width))) / 255
+        srgb_image = np.where(np_image <= 0.04045, np_image / 12.92, ((np_image + 0.055) / 1.055) ** 2.4)
+        h, w, c = srgb_image.shape
+        linear_image = srgb_image.reshape(h * w, c)
+        for pixel in linear_image:
+            if pixel[3] == 0.0:
+                pixel[0:3] = 0.0
+        extra_image = None
+        if image.size[1] > width:
+            extra_image = np.array(image.crop((0, width, image.size[0], image.size[1])))
+        return linear_image.transpose().reshape(c, h, w), extra_image
+
+
+    def legacy_postprocess_model_output(image):
+        image = (image.float().cpu() + 1.0) / 2.0
+        image = torch.cat([torch_linear_to_srgb(image[0:3, :, :]), image[3:4, :, :]], dim=0)
+        c, h, w = image.shape
+        image = 255.0 * torch.transpose(image.reshape(c, h * w), 0, 1).reshape(h, w, c)
+        return image.byte().numpy()
+
+
+    rng = np.random.default_rng(0)
+    for size in [(512, 1024), (1024, 2048), (2048, 4096)]:
+        raw = rng.integers(0, 256, (size[1], size[0], 4), dtype=np.uint8)
+        raw[..., 3] *= rng.random((size[1], size[0])) < 0.5
+        character = Image.fromarray(raw, mode='RGBA')
+
+        tic = time.perf_counter()
+        legacy_input, legacy_extra = legacy_ingest_character_image(character)
+        legacy_time = time.perf_counter() - tic
+
+        tic = time.perf_counter()
+        input_image, extra_image = ingest_character_image(character)
+        ingest_time = time.perf_counter() - tic
+
+        assert np.array_equal(legacy_input, input_image)
+        assert np.array_equal(legacy_extra, extra_image)
+        print("%dx%d: before %.1f ms, after %.1f ms (%.0fx)" % (
+            size[0], size[1], legacy_time * 1000, ingest_time * 1000, legacy_time / ingest_time))
+
+    devices = ['cpu'] + (['cuda'] if torch.cuda.is_available() else [])
+    for device in devices:
+        output = torch.rand(4, 512, 512, generator=torch.Generator().manual_seed(0)).to(device) * 2 - 1
+        timings = []
+        for postprocess in [legacy_postprocess_model_output, postprocess_model_output]:
+            postprocess(output)
+            tic = time.perf_counter()
+            for i in range(50):
+                frame = postprocess(output)
+            timings.append((time.perf_counter() - tic) * 1000 / 50)
+        diff = np.abs(legacy_postprocess_model_output(output).astype(int) - frame.astype(int))
+        print("postprocess on %s: before %.2f ms, after %.2f ms (%.1fx), max diff %d, %.2f%% of values differ" % (
+            device, timings[0], timings[1], timings[0] / timings[1], diff.max(), (diff > 0).mean() * 100))
@@ -0,0 +1,162 @@
+import heapq
+import os
+import time
+
+import numpy as np
+
+from args import args
+from simplify import simplify, simplify_view
+
+NEIGHBOUR_WEIGHT = 0.25
+PLAN_TOP_POSES = 4096
+PLAN_NEIGHBOUR_POSES = 64
+
+
+class PoseHistogram:
+    """
+    how often each simplified pose was requested live, kept next to the frame store so it builds up over sessions
+    """
+
+    def __init__(self, file_name, key_size, save_interval=30.0):
+        self.file_name = file_name
+        self.record_dtype = np.dtype([('key', 'V%d' % key_size), ('count', '<u4')])
+        self.save_interval = save_interval
+        self.save_time = time.perf_counter()
+        self.counts = {}
+        self.changed = 0
+        if os.path.exists(file_name):
+            for record in np.fromfile(file_name, dtype=self.record_dtype):
+                self.counts[record['key'].tobytes()] = int(record['count'])
+
+    def add(self, key):
+        self.counts[key] = self.counts.get(key, 0) + 1
+        self.changed += 1
+
+    def top(self, count):
+        return heapq.nlargest(count, self.counts.items(), key=lambda item: item[1])
+
+    def save(self, force=False):
+        now = time.perf_counter()
+        if self.changed == 0 or not force and now - self.save_time < self.save_interval:
+            return
+        records = np.empty(len(self.counts), dtype=self.record_dtype)
+        for i, (key, count) in enumerate(self.counts.items()):
+            records[i] = (key, min(count, 0xffffffff))
+        temp_file_name = self.file_name + '.tmp'
+        records.tofile(temp_file_name)
+        os.replace(temp_file_name, self.file_name)
+        self.save_time = now
+        self.changed = 0
+
+
+class HitRateMeter:
+    """
+    hit rate of live poses per time window, to see the warm-up paying off over a session
+    """
+
+    def __init__(self, window=10.0):
+        self.window = window
+        self.start_time = time.perf_counter()
+        self.window_start = self.start_time
+        self.hits = 0
+        self.total = 0
+        self.history = []
+
+    def update(self, hit):
+        """
+        Returns:
+            finished (bool): True if this update closed a window and appended it to history
+        """
+        now = time.perf_counter()
+        finished = now - self.window_start >= self.window
+        if finished:
+            self.history.append((self.window_start - self.start_time, self.hits / self.total if self.total else 0.0))
+            self.window_start = now
+            self.hits = 0
+            self.total = 0
+        self.hits += hit
+        self.total += 1
+        return finished
+
+    @property
+    def last(self):
+        return self.history[-1][1] if len(self.history) > 0 else 0.0
+
+
+class WarmupPlanner:
+    """
+    pick which simplify lattice points to render while the live pose is idle
+
+    The most requested poses missing from the store come first, then their lattice neighbours (one grid step away
+    on one parameter) weighted down by NEIGHBOUR_WEIGHT, since tracking noise mostly moves one parameter at a time.
+    Neighbours are pushed back through simplify so they are poses the live path can actually produce.
+    """
+
+    def __init__(self, histogram, store, packer, replan_interval=30.0):
+        self.histogram = histogram
+        self.store = store
+        self.packer = packer
+        self.replan_interval = replan_interval
+        self.plan_time = None
+        self.queue = []
+        self.queued = set()
+        self.variable = np.flatnonzero(simplify_view > 0)
+        if not args.eyebrow:
+            self.variable = self.variable[self.variable >= 12]
+
+    def unpack(self, key):
+        return np.frombuffer(key, dtype=np.int32) / self.packer.steps
+
+    def push(self, priority, key):
+        if key in self.queued or key in self.store.index:
+            return
+        self.queued.add(key)
+        heapq.heappush(self.queue, (-priority, key))
+
+    def neighbours(self, key):
+        pose = self.unpack(key)
+        for i in self.variable:
+            for step in [-1, 1]:
+                neighbour = pose.copy()
+                neighbour[i] += step / self.packer.steps[i]
+                yield self.packer(simplify(tuple(neighbour)))
+
+    def plan(self):
+        self.queue = []
+        self.queued = set()
+        top = self.histogram.top(PLAN_TOP_POSES)
+        for key, count in top:
+            self.push(count, key)
+        for key, count in top[:PLAN_NEIGHBOUR_POSES]:
+            for neighbour in self.neighbours(key):
+                self.push(count * NEIGHBOUR_WEIGHT, neighbour)
+        self.plan_time = time.perf_counter()
+
+    def pending(self):
+        if self.store.full:
+            # nothing rendered now could be stored
+            return False
+        if self.plan_time is None or time.perf_counter() - self.plan_time >= self.replan_interval:
+            self.plan()
+        return len(self.queue) > 0
+
+    def next_batch(self, size):
+        """
+        Returns:
+            keys (list): store keys of the poses to render, empty when there is nothing left
+            poses (numpy array): Nx45 model inputs matching keys
+        """
+        keys = []
+        while len(self.queue) > 0 and len(keys) < size:
+            _, key = heapq.heappop(self.queue)
+            self.queued.discard(key)
+            if key not in self.store.index:
+                keys.append(key)
+        return keys, np.array([self.unpack(key) for key in keys]).reshape(-1, len(self.packer.steps))
+
+    def requeue(self, keys):
+        """
+        put back poses next_batch handed out that weren't rendered, ahead of everything else
+        """
+        for key in keys:
+            self.push(float('inf'), key)